@@ -5,6 +5,7 @@ from typing import List, Optional
 import requests
 from pydantic import BaseModel
 from utils.pipelines.main import get_last_assistant_message
+from utils.pipelines.translation import TranslationCache
 
 
 class Pipeline:
@@ -19,6 +20,11 @@ class Pipeline:
         OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY")
         TRANSLATE_MODEL: str = os.getenv("TRANSLATE_MODEL", "gpt-4o-mini")
 
+        # Translation cache, TRANSLATE_CACHE_TTL in seconds (0 = never expire)
+        TRANSLATE_CACHE_SIZE: int = int(os.getenv("TRANSLATE_CACHE_SIZE", "2048"))
+        TRANSLATE_CACHE_TTL: int = int(os.getenv("TRANSLATE_CACHE_TTL", "0"))
+        TRANSLATE_CACHE_PATH: str = os.getenv("TRANSLATE_CACHE_PATH", "")
+
         # Translate languages
         # Assistant message will be translated from SOURCE_LANGUAGE to TARGET_LANGUAGE
         # SOURCE_LANGUAGE: Optional[str] = os.getenv("SOURCE_LANGUAGE", "en")
@@ -34,22 +40,37 @@ class Pipeline:
         if not self.valves.ENABLE_TRANSLATE_FILTER:
             self.valves.pipelines = []
 
+        self.translation_cache = None
+
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
+        self.set_translation_cache()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        if self.translation_cache:
+            self.translation_cache.close()
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        if self.translation_cache:
+            self.translation_cache.close()
+        self.set_translation_cache()
         pass
 
+    def set_translation_cache(self):
+        self.translation_cache = TranslationCache(
+            max_size=self.valves.TRANSLATE_CACHE_SIZE,
+            ttl=self.valves.TRANSLATE_CACHE_TTL,
+            path=self.valves.TRANSLATE_CACHE_PATH,
+        )
+
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"outlet:{__name__}")
 
@@ -63,7 +84,7 @@ class Pipeline:
         print(f"Before translate: {assistant_message}")
 
         # Translate assistant message
-        translated_assistant_message = self.translate(assistant_message)
+        translated_assistant_message = await self.translate(assistant_message)
 
         print(f"After translate: {translated_assistant_message}")
 
@@ -80,7 +101,20 @@ class Pipeline:
         print(f"Combined message: {body}")
         return body
 
-    def translate(self, text: str) -> str:
+    async def translate(self, text: str) -> str:
+        try:
+            # The prompt below translates both ways between English and Traditional Chinese.
+            return await self.translation_cache.translate(
+                text,
+                "auto",
+                "en|zh-TW",
+                f"llm:{self.valves.OPENAI_API_BASE_URL}:{self.valves.TRANSLATE_MODEL}",
+                self.request_translation,
+            )
+        except Exception as e:
+            return f"Error: {e}"
+
+    def request_translation(self, text: str, source: str, target: str) -> str:
         headers = {
             "Authorization": f"Bearer {self.valves.OPENAI_API_KEY}",
             "Content-Type": "application/json",
@@ -97,20 +131,16 @@ class Pipeline:
             "model": self.valves.TRANSLATE_MODEL,
         }
 
-        try:
-            r = requests.post(
-                url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
-                json=payload,
-                headers=headers,
-                stream=True,
-            )
-
-            r.raise_for_status()
-            response = r.json()
-            return response["choices"][0]["message"]["content"]
+        r = requests.post(
+            url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
+            json=payload,
+            headers=headers,
+            stream=True,
+        )
 
-        except Exception as e:
-            return f"Error: {e}"
+        r.raise_for_status()
+        response = r.json()
+        return response["choices"][0]["message"]["content"]
 
     def combine_messages(self, original: str, translated: str) -> str:
         """
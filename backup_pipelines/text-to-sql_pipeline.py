@@ -5,6 +5,8 @@ from langchain_community.utilities.sql_database import SQLDatabase
 from langchain_playground.TextToSQL import text_to_sql
 from pydantic import BaseModel
 
+from utils.pipelines.sql import create_pooled_engine
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -17,15 +19,21 @@ class Pipeline:
     def __init__(self):
         self.name = "Text-to-SQL"
         self.valves = self.Valves()
-        self.db = SQLDatabase.from_uri("sqlite:///databases/Chinook.db")
+        self.engine = None
+        self.db = None
         pass
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        # Opened once with a connection pool; the schema is reflected here rather than at import time.
+        self.engine = create_pooled_engine("sqlite:///databases/Chinook.db")
+        self.db = SQLDatabase(self.engine)
         pass
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        if self.engine:
+            self.engine.dispose()
         pass
 
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
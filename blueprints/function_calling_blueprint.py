@@ -10,6 +10,7 @@ from utils.pipelines.main import (
     add_or_update_system_message,
     get_tools_specs,
 )
+from utils.pipelines.response_cache import ResponseCache, make_response_cache_key
 
 # System prompt for function calling
 DEFAULT_SYSTEM_PROMPT = (
@@ -39,6 +40,10 @@ class Pipeline:
         TASK_MODEL: str
         TEMPLATE: str
 
+        # Reuse the task model's answer for identical tool-routing prompts
+        TASK_RESPONSE_CACHE: bool = False
+        TASK_RESPONSE_CACHE_TTL: int = 3600
+
     def __init__(self, prompt: str | None = None) -> None:
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -52,6 +57,7 @@ class Pipeline:
         self.name = "Function Calling Blueprint"
         self.prompt = prompt or DEFAULT_SYSTEM_PROMPT
         self.tools: object = None
+        self.task_cache = None
 
         # Initialize valves
         self.valves = self.Valves(
@@ -78,8 +84,19 @@ And answer according to the language of the user's question.""",
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
+        self.set_task_cache()
         pass
 
+    async def on_valves_updated(self):
+        self.set_task_cache()
+
+    def set_task_cache(self):
+        self.task_cache = (
+            ResponseCache(ttl=self.valves.TASK_RESPONSE_CACHE_TTL or None)
+            if self.valves.TASK_RESPONSE_CACHE
+            else None
+        )
+
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
@@ -139,22 +156,35 @@ And answer according to the language of the user's question.""",
 
     def run_completion(self, system_prompt: str, content: str) -> dict:
         r = None
+        messages = [
+            {
+                "role": "system",
+                "content": system_prompt,
+            },
+            {
+                "role": "user",
+                "content": content,
+            },
+        ]
+        cache_key = None
         try:
+            if self.task_cache:
+                cache_key = make_response_cache_key(
+                    self.valves.TASK_MODEL,
+                    messages,
+                    {},
+                    namespace=self.valves.OPENAI_API_BASE_URL,
+                )
+                cached = self.task_cache.get(cache_key, self.valves.TASK_MODEL)
+                if cached is not None:
+                    return json.loads(cached)
+
             # Call the OpenAI API to get the function response
             r = requests.post(
                 url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
                 json={
                     "model": self.valves.TASK_MODEL,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": system_prompt,
-                        },
-                        {
-                            "role": "user",
-                            "content": content,
-                        },
-                    ],
+                    "messages": messages,
                     # TODO: dynamically add response_format?
                     # "response_format": {"type": "json_object"},
                 },
@@ -173,6 +203,8 @@ And answer according to the language of the user's question.""",
             if content != "":
                 result = json.loads(content)
                 print(result)
+                if cache_key:
+                    self.task_cache.set(cache_key, content, self.valves.TASK_MODEL)
                 return result
 
         except Exception as e:
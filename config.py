@@ -13,3 +13,31 @@ except ImportError:
 
 API_KEY = os.getenv("PIPELINES_API_KEY", "0p3n-w3bu!")
 PIPELINES_DIR = os.getenv("PIPELINES_DIR", "./pipelines")
+
+# Limits for /chat/completions request bodies
+MAX_REQUEST_BODY_SIZE = int(
+    os.getenv("PIPELINES_MAX_REQUEST_BODY_SIZE", str(64 * 1024 * 1024))
+)
+MAX_REQUEST_MESSAGES = int(os.getenv("PIPELINES_MAX_REQUEST_MESSAGES", "10000"))
+
+# Exact-match response cache, used by pipelines that opt in with a
+# `response_cache` valve. A TTL of 0 keeps entries until they are evicted.
+RESPONSE_CACHE_SIZE = int(os.getenv("PIPELINES_RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("PIPELINES_RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PATH = os.getenv("PIPELINES_RESPONSE_CACHE_PATH", "")
+
+# Embedding cache shared by every pipeline, keyed by (model, text hash).
+# Set the path to an empty string to keep embeddings in memory only. The file keeps
+# at most EMBEDDING_CACHE_DISK_SIZE embeddings (0 = unbounded), least recently used go first.
+EMBEDDING_CACHE_SIZE = int(os.getenv("PIPELINES_EMBEDDING_CACHE_SIZE", "50000"))
+EMBEDDING_CACHE_PATH = os.getenv(
+    "PIPELINES_EMBEDDING_CACHE_PATH", os.path.join(PIPELINES_DIR, "embeddings.db")
+)
+EMBEDDING_CACHE_DISK_SIZE = int(os.getenv("PIPELINES_EMBEDDING_CACHE_DISK_SIZE", "200000"))
+
+# Local models (sentence-transformers, cross-encoders, Detoxify) are loaded once per
+# process and shared. Models no pipeline holds are unloaded right away, and idle ones
+# when the loaded ones exceed the budget (0 = unlimited). MODEL_THREADS torch threads per forward pass, 0 = cores / concurrency.
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("PIPELINES_MODEL_MEMORY_BUDGET_MB", "0"))
+MODEL_CONCURRENCY = int(os.getenv("PIPELINES_MODEL_CONCURRENCY", "2"))
+MODEL_THREADS = int(os.getenv("PIPELINES_MODEL_THREADS", "0"))
@@ -1,7 +1,8 @@
 import os
-from typing import List, Optional
+from typing import List, Literal, Optional
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
+from utils.pipelines.context import fit_messages, get_context_limit
 import time
 
 
@@ -20,6 +21,11 @@ class Pipeline:
         target_user_roles: List[str] = ["user"]
         max_turns: Optional[int] = None
 
+        # Trim the history to this many tokens instead of forwarding all of it.
+        # 0 uses the target model's context window (minus max_tokens), None disables trimming.
+        max_context_tokens: Optional[int] = None
+        context_strategy: Literal["drop", "truncate"] = "drop"
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -61,4 +67,15 @@ class Pipeline:
                     f"Conversation turn limit exceeded. Max turns: {self.valves.max_turns}"
                 )
 
+        if self.valves.max_context_tokens is not None:
+            max_tokens = self.valves.max_context_tokens or (
+                get_context_limit(body.get("model", ""))
+                - (body.get("max_tokens") or 0)
+            )
+            body["messages"] = fit_messages(
+                body.get("messages", []),
+                max_tokens,
+                strategy=self.valves.context_strategy,
+            )
+
         return body
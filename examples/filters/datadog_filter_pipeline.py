@@ -9,10 +9,12 @@ requirements: ddtrace
 environment_variables: DD_LLMOBS_AGENTLESS_ENABLED, DD_LLMOBS_ENABLED, DD_LLMOBS_APP_NAME, DD_API_KEY, DD_SITE 
 """
 
-from typing import List, Optional
+from typing import List, Literal, Optional
 import os
+import time
 
 from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.telemetry import TelemetryExporter
 from pydantic import BaseModel
 from ddtrace.llmobs import LLMObs
 
@@ -34,6 +36,14 @@ class Pipeline:
         dd_site: str
         ml_app: str
 
+        # Telemetry export queue
+        export_queue_size: int = 1000
+        export_batch_size: int = 64
+        export_flush_interval: float = 1.0
+        export_drop_policy: Literal["drop_newest", "drop_oldest", "block"] = (
+            "drop_oldest"
+        )
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -58,27 +68,58 @@ class Pipeline:
 
         # DataDog LLMOBS docs: https://docs.datadoghq.com/tracing/llm_observability/sdk/
         self.LLMObs = LLMObs()
-        self.llm_span = None
-        self.chat_generations = {}
+        # Open LLM spans, keyed by chat_id so concurrent requests don't overwrite each other.
+        self.llm_spans = {}
+        self.exporter = None
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
         self.set_dd()
+        self.set_exporter()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        if self.exporter:
+            await self.exporter.stop()
+            self.exporter = None
         self.LLMObs.flush()
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        if self.exporter:
+            await self.exporter.stop()
         self.set_dd()
+        self.set_exporter()
         pass
 
+    def set_exporter(self):
+        self.exporter = TelemetryExporter(
+            self.finish_spans,
+            max_queue_size=self.valves.export_queue_size,
+            max_batch_size=self.valves.export_batch_size,
+            flush_interval=self.valves.export_flush_interval,
+            drop_policy=self.valves.export_drop_policy,
+            on_flush=self.LLMObs.flush,
+        )
+        self.exporter.start()
+
+    def finish_spans(self, events: List[dict]):
+        # Runs in the exporter's worker thread; LLMObs is flushed once per batch.
+        for event in events:
+            self.LLMObs.annotate(
+                span=event["span"],
+                output_data=event["output_data"],
+            )
+            event["span"].finish(finish_time=event["finish_time"])
+
+    def get_chat_id(self, body: dict) -> Optional[str]:
+        return body.get("chat_id") or body.get("metadata", {}).get("chat_id")
+
     def set_dd(self):
         self.LLMObs.enable(
             ml_app=self.valves.ml_app,
@@ -91,31 +132,43 @@ class Pipeline:
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"inlet:{__name__}")
 
-        self.llm_span = self.LLMObs.llm(
+        chat_id = self.get_chat_id(body)
+
+        llm_span = self.LLMObs.llm(
             model_name=body["model"],
             name=f"filter:{__name__}",
             model_provider="open-webui",
-            session_id=body["chat_id"],
+            session_id=chat_id,
             ml_app=self.valves.ml_app
         )
 
         self.LLMObs.annotate(
-            span = self.llm_span,
+            span = llm_span,
             input_data = get_last_user_message(body["messages"]),
         )
 
+        # A retried request for the same chat replaces its unfinished span.
+        previous_span = self.llm_spans.pop(chat_id, None)
+        if previous_span:
+            previous_span.finish()
+        self.llm_spans[chat_id] = llm_span
+
         return body
 
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"outlet:{__name__}")
 
-        self.LLMObs.annotate(
-            span = self.llm_span,
-            output_data = get_last_assistant_message(body["messages"]),
-        )
+        llm_span = self.llm_spans.pop(self.get_chat_id(body), None)
+        if llm_span is None:
+            return body
 
-        self.llm_span.finish()
-        self.LLMObs.flush()
+        await self.exporter.submit(
+            {
+                "span": llm_span,
+                "output_data": get_last_assistant_message(body["messages"]),
+                "finish_time": time.time(),
+            }
+        )
 
         return body
@@ -12,6 +12,9 @@ from typing import List, Optional
 from schemas import OpenAIChatMessage
 from pydantic import BaseModel
 from detoxify import Detoxify
+from utils.pipelines.batching import MicroBatcher
+from utils.pipelines.cache import LRUCache, hash_text
+from utils.pipelines.models import model_registry
 import os
 
 
@@ -27,6 +30,17 @@ class Pipeline:
         # The lower the number, the higher the priority.
         priority: int = 0
 
+        # Concurrent messages are scored together in one forward pass.
+        # Raise these for throughput under load, lower them for latency.
+        batch_max_size: int = 16
+        batch_max_wait_ms: float = 10.0
+
+        # Scores are memoized by message hash. cache_ttl is in seconds (0 = never expire);
+        # set cache_path to an SQLite file to keep scores across restarts.
+        cache_size: int = 4096
+        cache_ttl: int = 0
+        cache_path: str = ""
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -47,6 +61,8 @@ class Pipeline:
         )
 
         self.model = None
+        self.batcher = None
+        self.cache = None
 
         pass
 
@@ -54,18 +70,55 @@ class Pipeline:
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
 
-        self.model = Detoxify("original")
+        # Shared with any other pipeline using the same weights, and loaded on first use.
+        self.model = model_registry.acquire("detoxify:original", lambda: Detoxify("original"))
+        self.set_batcher()
+        self.set_cache()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        if self.model:
+            self.model.release()
+        if self.batcher:
+            await self.batcher.close()
+        if self.cache:
+            self.cache.close()
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        if self.batcher:
+            await self.batcher.close()
+        if self.cache:
+            self.cache.close()
+        self.set_batcher()
+        self.set_cache()
         pass
 
+    def set_cache(self):
+        self.cache = LRUCache(
+            max_size=self.valves.cache_size,
+            ttl=self.valves.cache_ttl,
+            path=self.valves.cache_path,
+        )
+
+    def set_batcher(self):
+        self.batcher = MicroBatcher(
+            self.predict_batch,
+            max_batch_size=self.valves.batch_max_size,
+            max_wait_ms=self.valves.batch_max_wait_ms,
+        )
+
+    def predict_batch(self, texts: List[str]) -> List[dict]:
+        # Detoxify returns {label: [score per text]}; split it back into one dict per text.
+        scores = self.model.run(lambda model: model.predict(texts))
+        return [
+            {label: values[i] for label, values in scores.items()}
+            for i in range(len(texts))
+        ]
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # This filter is applied to the form data before it is sent to the OpenAI API.
         print(f"inlet:{__name__}")
@@ -73,8 +126,13 @@ class Pipeline:
         print(body)
         user_message = body["messages"][-1]["content"]
 
-        # Filter out toxic messages
-        toxicity = self.model.predict(user_message)
+        # Filter out toxic messages. Keys are namespaced by filter and model, so that
+        # filters sharing a cache_path never read each other's verdicts.
+        cache_key = hash_text("detoxify", self.model.key, user_message)
+        toxicity = self.cache.get(cache_key)
+        if toxicity is None:
+            toxicity = await self.batcher.submit(user_message)
+            self.cache.set(cache_key, toxicity)
         print(toxicity)
 
         if toxicity["toxicity"] > 0.5:
@@ -8,11 +8,13 @@ description: A pipeline for dynamically processing images when current model is
 requirements: pydantic, aiohttp
 """
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel
+import asyncio
 import json
 import aiohttp
-from utils.pipelines.main import get_last_user_message
+from utils.pipelines.cache import LRUCache, hash_text
+from utils.pipelines.images import image_store
 
 class Pipeline:
     class Valves(BaseModel):
@@ -21,6 +23,14 @@ class Pipeline:
         vision_model: str = "llava"
         ollama_base_url: str = ""
         model_to_override: str = ""
+        # Prompt used for images whose message has no text of its own
+        description_prompt: str = "Describe this image in detail."
+        # Maximum number of concurrent requests to the vision model
+        max_concurrency: int = 4
+        # Number of image descriptions cached by image content hash
+        cache_size: int = 1024
+        # Downscale images to fit this many pixels on their long edge before sending them (0 = keep as is)
+        max_image_dimension: int = 0
 
     def __init__(self):
         self.type = "filter"
@@ -30,15 +40,34 @@ class Pipeline:
                 "pipelines": ["*"],  # Connect to all pipelines
             }
         )
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.cache: Optional[LRUCache] = None
+        # Descriptions currently being generated, so identical images are only sent once
+        self.inflight: Dict[str, asyncio.Task] = {}
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        self.semaphore = asyncio.Semaphore(max(1, self.valves.max_concurrency))
+        self.cache = LRUCache(max_size=self.valves.cache_size)
         pass
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
         pass
 
+    async def on_valves_updated(self):
+        self.semaphore = asyncio.Semaphore(max(1, self.valves.max_concurrency))
+        pass
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
     async def process_images_with_llava(self, images: List[str], content: str, vision_model: str, ollama_base_url: str) -> str:
         url = f"{ollama_base_url}/api/chat"
         payload = {
@@ -52,8 +81,8 @@ class Pipeline:
             ]
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
+        async with self.semaphore:
+            async with self.get_session().post(url, json=payload) as response:
                 if response.status == 200:
                     content = []
                     async for line in response.content:
@@ -64,28 +93,81 @@ class Pipeline:
                     print(f"Failed to process images with LLava, status code: {response.status}")
                     return ""
 
+    async def describe_image(self, image: str, prompt: str) -> str:
+        """
+        Describes a single image, reusing the cached description of identical
+        image content and prompt from earlier turns.
+        """
+        cache_key = hash_text(self.valves.vision_model, prompt, image)
+        description = self.cache.get(cache_key)
+        if description is not None:
+            return description
+
+        task = self.inflight.get(cache_key)
+        if task is None:
+            if self.valves.max_image_dimension:
+                image = (
+                    await asyncio.to_thread(
+                        image_store.load_base64,
+                        image,
+                        max_dimension=self.valves.max_image_dimension,
+                    )
+                ).base64
+            task = asyncio.create_task(
+                self.process_images_with_llava(
+                    [image], prompt, self.valves.vision_model, self.valves.ollama_base_url
+                )
+            )
+            self.inflight[cache_key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(cache_key, None))
+
+        description = await asyncio.shield(task)
+        # Failed calls come back empty; leave them uncached so they are retried next turn
+        if description:
+            self.cache.set(cache_key, description)
+        return description
+
+    def get_message_text(self, message: dict) -> str:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(
+                item.get("text", "") for item in content if item.get("type") == "text"
+            )
+        return content.strip() or self.valves.description_prompt
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"pipe:{__name__}")
 
-        images = []
-
         # Ensure the body is a dictionary
         if isinstance(body, str):
             body = json.loads(body)
         
         model = body.get("model", "")
 
-        # Get the content of the most recent message
-        user_message = get_last_user_message(body["messages"])
-
         if model in self.valves.model_to_override:
-            messages = body.get("messages", [])
-            for message in messages:
-                if "images" in message:
-                    images.extend(message["images"])
-                    raw_llava_response = await self.process_images_with_llava(images, user_message, self.valves.vision_model,self.valves.ollama_base_url)
-                    llava_response = f"REPEAT THIS BACK: {raw_llava_response}"
-                    message["content"] = llava_response
-                    message.pop("images", None)  # This will safely remove the 'images' key if it exists
+            messages = [
+                message for message in body.get("messages", []) if message.get("images")
+            ]
+
+            # Describe every image once, all of them concurrently
+            descriptions = await asyncio.gather(
+                *[
+                    asyncio.gather(
+                        *[
+                            self.describe_image(image, self.get_message_text(message))
+                            for image in message["images"]
+                        ]
+                    )
+                    for message in messages
+                ]
+            )
+
+            for message, image_descriptions in zip(messages, descriptions):
+                raw_llava_response = "\n\n".join(
+                    description for description in image_descriptions if description
+                )
+                llava_response = f"REPEAT THIS BACK: {raw_llava_response}"
+                message["content"] = llava_response
+                message.pop("images", None)  # This will safely remove the 'images' key if it exists
         
         return body
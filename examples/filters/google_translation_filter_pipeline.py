@@ -17,9 +17,17 @@ import requests
 import os
 import time
 import asyncio
-from functools import lru_cache
 
 from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.translation import (
+    TranslationCache,
+    clean_table_delimiters,
+    split_text_around_table,
+)
+
+# Attempts per translation request; waits 1s, 2s, ... between them
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = 10
 
 class Pipeline:
     class Valves(BaseModel):
@@ -29,6 +37,11 @@ class Pipeline:
         target_user: Optional[str] = "en"
         source_assistant: Optional[str] = "en"
         target_assistant: Optional[str] = "uk"
+        # Translations are cached by (source, target, backend, text). cache_ttl is in
+        # seconds (0 = never expire); cache_path enables a persistent SQLite tier.
+        cache_size: int = 2048
+        cache_ttl: int = 0
+        cache_path: str = ""
 
     def __init__(self):
         self.type = "filter"
@@ -40,22 +53,42 @@ class Pipeline:
         )
 
         # Initialize translation cache
-        self.translation_cache = {}
-        self.code_blocks = []  # List to store code blocks
+        self.translation_cache = None
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        self.set_translation_cache()
         pass
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        if self.translation_cache:
+            self.translation_cache.close()
         pass
 
     async def on_valves_updated(self):
+        if self.translation_cache:
+            self.translation_cache.close()
+        self.set_translation_cache()
         pass
 
-    # @lru_cache(maxsize=128)  # LRU cache to store translation results
-    def translate(self, text: str, source: str, target: str) -> str:
+    def set_translation_cache(self):
+        self.translation_cache = TranslationCache(
+            max_size=self.valves.cache_size,
+            ttl=self.valves.cache_ttl,
+            path=self.valves.cache_path,
+        )
+
+    async def translate(self, text: str, source: str, target: str) -> str:
+        try:
+            return await self.translation_cache.translate(
+                text, source, target, "google", self.request_translation
+            )
+        except Exception as e:
+            print(f"Error translating text: {e}")
+            return text
+
+    def request_translation(self, text: str, source: str, target: str) -> str:
         url = "https://translate.googleapis.com/translate_a/single"
         params = {
             "client": "gtx",
@@ -65,32 +98,19 @@ class Pipeline:
             "q": text,
         }
         
-        try:
-            r = requests.get(url, params=params)
-            r.raise_for_status()
-            result = r.json()
-            translated_text = ''.join([sentence[0] for sentence in result[0]])
-            return translated_text
-        except requests.exceptions.RequestException as e:
-            print(f"Network error: {e}")
-            time.sleep(1)
-            return self.translate(text, source, target)
-        except Exception as e:
-            print(f"Error translating text: {e}")
-            return text
-
-    def split_text_around_table(self, text: str) -> List[str]:
-        table_regex = r'((?:^.*?\|.*?\n)+)(?=\n[^\|\s].*?\|)'
-        matches = re.split(table_regex, text, flags=re.MULTILINE)
-
-        if len(matches) > 1:
-            return [matches[0], matches[1]]
-        else:
-            return [text, ""]
-
-    def clean_table_delimiters(self, text: str) -> str:
-        # Remove extra spaces from table delimiters
-        return re.sub(r'(\|\s*-+\s*)+', lambda m: m.group(0).replace(' ', '-'), text)
+        for attempt in range(MAX_RETRIES):
+            try:
+                r = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
+                r.raise_for_status()
+                result = r.json()
+                translated_text = ''.join([sentence[0] for sentence in result[0]])
+                return translated_text
+            except requests.exceptions.RequestException as e:
+                print(f"Network error (attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+                if attempt + 1 == MAX_RETRIES:
+                    # translate() then returns the text untranslated, without caching it.
+                    raise
+                time.sleep(2 ** attempt)
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"inlet:{__name__}")
@@ -102,30 +122,26 @@ class Pipeline:
 
         # Find and store code blocks
         code_block_regex = r'```[\s\S]+?```'
-        self.code_blocks = re.findall(code_block_regex, user_message)
+        code_blocks = re.findall(code_block_regex, user_message)
         # Replace code blocks with placeholders
         user_message_no_code = re.sub(code_block_regex, '__CODE_BLOCK__', user_message)
 
-        parts = self.split_text_around_table(user_message_no_code)
+        parts = split_text_around_table(user_message_no_code)
         text_before_table, table_text = parts
 
-        # Check translation cache for text before table
-        translated_before_table = self.translation_cache.get(text_before_table)
-        if translated_before_table is None:
-            translated_before_table = self.translate(
-                text_before_table,
-                self.valves.source_user,
-                self.valves.target_user,
-            )
-            self.translation_cache[text_before_table] = translated_before_table
+        translated_before_table = await self.translate(
+            text_before_table,
+            self.valves.source_user,
+            self.valves.target_user,
+        )
 
         translated_user_message = translated_before_table + table_text
 
         # Clean table delimiters
-        translated_user_message = self.clean_table_delimiters(translated_user_message)
+        translated_user_message = clean_table_delimiters(translated_user_message)
 
         # Restore code blocks
-        for code_block in self.code_blocks:
+        for code_block in code_blocks:
             translated_user_message = translated_user_message.replace('__CODE_BLOCK__', code_block, 1)
 
         print(f"Translated user message: {translated_user_message}")
@@ -148,30 +164,26 @@ class Pipeline:
 
         # Find and store code blocks
         code_block_regex = r'```[\s\S]+?```'
-        self.code_blocks = re.findall(code_block_regex, assistant_message)
+        code_blocks = re.findall(code_block_regex, assistant_message)
         # Replace code blocks with placeholders
         assistant_message_no_code = re.sub(code_block_regex, '__CODE_BLOCK__', assistant_message)
 
-        parts = self.split_text_around_table(assistant_message_no_code)
+        parts = split_text_around_table(assistant_message_no_code)
         text_before_table, table_text = parts
 
-        # Check translation cache for text before table
-        translated_before_table = self.translation_cache.get(text_before_table)
-        if translated_before_table is None:
-            translated_before_table = self.translate(
-                text_before_table,
-                self.valves.source_assistant,
-                self.valves.target_assistant,
-            )
-            self.translation_cache[text_before_table] = translated_before_table
+        translated_before_table = await self.translate(
+            text_before_table,
+            self.valves.source_assistant,
+            self.valves.target_assistant,
+        )
 
         translated_assistant_message = translated_before_table + table_text
 
         # Clean table delimiters
-        translated_assistant_message = self.clean_table_delimiters(translated_assistant_message)
+        translated_assistant_message = clean_table_delimiters(translated_assistant_message)
 
         # Restore code blocks
-        for code_block in self.code_blocks:
+        for code_block in code_blocks:
             translated_assistant_message = translated_assistant_message.replace('__CODE_BLOCK__', code_block, 1)
 
         print(f"Translated assistant message: {translated_assistant_message}")
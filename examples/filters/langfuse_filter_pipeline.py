@@ -8,12 +8,15 @@ description: A filter pipeline that uses Langfuse.
 requirements: langfuse
 """
 
-from typing import List, Optional
+from typing import List, Literal, Optional
+from datetime import datetime, timezone
 import os
 import uuid
 import json
 
 from utils.pipelines.main import get_last_assistant_message
+from utils.pipelines.telemetry import TelemetryExporter
+from utils.pipelines.tokenizer import estimate_usage
 from pydantic import BaseModel
 from langfuse import Langfuse
 from langfuse.api.resources.commons.errors.unauthorized_error import UnauthorizedError
@@ -34,6 +37,15 @@ class Pipeline:
         public_key: str
         host: str
         debug: bool = False
+        # Count tokens locally when the backend did not report usage
+        estimate_usage: bool = True
+        # Telemetry export queue
+        export_queue_size: int = 1000
+        export_batch_size: int = 64
+        export_flush_interval: float = 1.0
+        export_drop_policy: Literal["drop_newest", "drop_oldest", "block"] = (
+            "drop_oldest"
+        )
 
     def __init__(self):
         self.type = "filter"
@@ -50,7 +62,9 @@ class Pipeline:
         )
 
         self.langfuse = None
-        # Keep track of the trace and the last-created generation for each chat_id
+        self.exporter = None
+        # Keep track of the trace id and the last-created generation id for each chat_id.
+        # The Langfuse calls themselves are made by the exporter's background task.
         self.chat_traces = {}
         self.chat_generations = {}
         self.suppressed_logs = set()
@@ -67,15 +81,54 @@ class Pipeline:
     async def on_startup(self):
         self.log(f"on_startup triggered for {__name__}")
         self.set_langfuse()
+        await self.set_exporter()
 
     async def on_shutdown(self):
         self.log(f"on_shutdown triggered for {__name__}")
-        if self.langfuse:
-            self.langfuse.flush()
+        if self.exporter:
+            await self.exporter.stop()
+            self.exporter = None
 
     async def on_valves_updated(self):
         self.log("Valves updated, resetting Langfuse client.")
+        if self.exporter:
+            await self.exporter.stop()
         self.set_langfuse()
+        await self.set_exporter()
+
+    async def set_exporter(self):
+        self.exporter = TelemetryExporter(
+            self.export_events,
+            max_queue_size=self.valves.export_queue_size,
+            max_batch_size=self.valves.export_batch_size,
+            flush_interval=self.valves.export_flush_interval,
+            drop_policy=self.valves.export_drop_policy,
+            on_flush=self.flush_langfuse,
+        )
+        self.exporter.start()
+
+    def flush_langfuse(self):
+        if self.langfuse:
+            self.langfuse.flush()
+
+    def export_events(self, events: List[dict]):
+        """Replays queued trace/generation events against the Langfuse client."""
+        if not self.langfuse:
+            return
+
+        for event in events:
+            kind = event["type"]
+            payload = event["payload"]
+
+            if self.valves.debug:
+                print(
+                    f"[DEBUG] Langfuse {kind} request: {json.dumps(payload, indent=2, default=str)}"
+                )
+
+            if kind == "trace":
+                self.langfuse.trace(**payload)
+            elif kind == "generation":
+                self.langfuse.generation(**payload)
 
     def set_langfuse(self):
         try:
@@ -152,51 +205,45 @@ class Pipeline:
             # Create a new trace and generation
             self.log(f"Creating new chat trace for chat_id: {chat_id}")
 
-            trace_payload = {
-                "name": f"filter:{__name__}",
-                "input": body,
-                "user_id": user_email,
-                "metadata": {"chat_id": chat_id},
-                "session_id": chat_id,
-            }
-
-            if self.valves.debug:
-                print(f"[DEBUG] Langfuse trace request: {json.dumps(trace_payload, indent=2)}")
-
-            trace = self.langfuse.trace(**trace_payload)
-
-            generation_payload = {
-                "name": chat_id,
-                "model": body["model"],
-                "input": body["messages"],
-                "metadata": {"interface": "open-webui"},
-            }
-
-            if self.valves.debug:
-                print(f"[DEBUG] Langfuse generation request: {json.dumps(generation_payload, indent=2)}")
-
-            generation = trace.generation(**generation_payload)
-
-            self.chat_traces[chat_id] = trace
-            self.chat_generations[chat_id] = generation
-            self.log(f"Trace and generation objects successfully created for chat_id: {chat_id}")
-
+            trace_id = str(uuid.uuid4())
+            await self.exporter.submit(
+                {
+                    "type": "trace",
+                    "payload": {
+                        "id": trace_id,
+                        "name": f"filter:{__name__}",
+                        "input": body,
+                        "user_id": user_email,
+                        "metadata": {"chat_id": chat_id},
+                        "session_id": chat_id,
+                    },
+                }
+            )
+            generation_name = chat_id
+            self.chat_traces[chat_id] = trace_id
         else:
             # Re-use existing trace but create a new generation for each new message
             self.log(f"Re-using existing chat trace for chat_id: {chat_id}")
-            trace = self.chat_traces[chat_id]
-
-            new_generation_payload = {
-                "name": f"{chat_id}:{str(uuid.uuid4())}",
-                "model": body["model"],
-                "input": body["messages"],
-                "metadata": {"interface": "open-webui"},
+            trace_id = self.chat_traces[chat_id]
+            generation_name = f"{chat_id}:{str(uuid.uuid4())}"
+
+        generation_id = str(uuid.uuid4())
+        await self.exporter.submit(
+            {
+                "type": "generation",
+                "payload": {
+                    "id": generation_id,
+                    "trace_id": trace_id,
+                    "name": generation_name,
+                    "model": body["model"],
+                    "input": body["messages"],
+                    "metadata": {"interface": "open-webui"},
+                    "start_time": datetime.now(timezone.utc),
+                },
             }
-            if self.valves.debug:
-                print(f"[DEBUG] Langfuse new_generation request: {json.dumps(new_generation_payload, indent=2)}")
-
-            new_generation = trace.generation(**new_generation_payload)
-            self.chat_generations[chat_id] = new_generation
+        )
+        self.chat_generations[chat_id] = generation_id
+        self.log(f"Trace and generation queued for chat_id: {chat_id}")
 
         return body
 
@@ -214,8 +261,8 @@ class Pipeline:
             self.log(f"[WARNING] No matching chat trace found for chat_id: {chat_id}, attempting to re-register.")
             return await self.inlet(body, user)
 
-        trace = self.chat_traces[chat_id]
-        generation = self.chat_generations[chat_id]
+        trace_id = self.chat_traces[chat_id]
+        generation_id = self.chat_generations[chat_id]
 
         # Get the last assistant message from the conversation
         assistant_message = get_last_assistant_message(body["messages"])
@@ -251,20 +298,38 @@ class Pipeline:
                     }
                     self.log(f"Usage data extracted: {usage}")
 
+        if usage is None and self.valves.estimate_usage:
+            estimated = estimate_usage(
+                body["messages"][:-1] if assistant_message_obj else body["messages"],
+                assistant_message or "",
+                body.get("model", ""),
+            )
+            usage = {
+                "input": estimated["prompt_tokens"],
+                "output": estimated["completion_tokens"],
+                "unit": "TOKENS",
+            }
+            self.log(f"Usage data estimated: {usage}")
+
         # Optionally update the trace with the final assistant output
-        trace.update(output=assistant_message)
+        await self.exporter.submit(
+            {"type": "trace", "payload": {"id": trace_id, "output": assistant_message}}
+        )
 
         # End the generation with the final assistant message and updated conversation
-        generation_payload = {
-            "input": body["messages"],  # include the entire conversation
-            "metadata": {"interface": "open-webui"},
-            "usage": usage,
-        }
-
-        if self.valves.debug:
-            print(f"[DEBUG] Langfuse generation end request: {json.dumps(generation_payload, indent=2)}")
-
-        generation.end(**generation_payload)
-        self.log(f"Generation ended for chat_id: {chat_id}")
+        await self.exporter.submit(
+            {
+                "type": "generation",
+                "payload": {
+                    "id": generation_id,
+                    "trace_id": trace_id,
+                    "input": body["messages"],  # include the entire conversation
+                    "metadata": {"interface": "open-webui"},
+                    "usage": usage,
+                    "end_time": datetime.now(timezone.utc),
+                },
+            }
+        )
+        self.log(f"Generation end queued for chat_id: {chat_id}")
 
         return body
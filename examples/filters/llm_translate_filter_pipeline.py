@@ -1,10 +1,15 @@
-from typing import List, Optional
+from typing import Iterator, List, Optional
 from schemas import OpenAIChatMessage
 from pydantic import BaseModel
 import requests
 import os
 
 from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.translation import (
+    StreamedReplies,
+    TranslationCache,
+    translate_stream,
+)
 
 
 class Pipeline:
@@ -33,6 +38,17 @@ class Pipeline:
         source_assistant: Optional[str] = "en"
         target_assistant: Optional[str] = "es"
 
+        # Translations are cached by (source, target, backend, text). cache_ttl is in
+        # seconds (0 = never expire); cache_path enables a persistent SQLite tier.
+        cache_size: int = 2048
+        cache_ttl: int = 0
+        cache_path: str = ""
+
+        # Translate the assistant reply while it streams instead of in outlet.
+        # Segments are translated concurrently, up to stream_max_concurrency at a time.
+        stream_translation: bool = False
+        stream_max_concurrency: int = 4
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -55,23 +71,74 @@ class Pipeline:
             }
         )
 
+        self.translation_cache = None
+        # Replies translated while streaming, which outlet leaves alone
+        self.streamed_replies = StreamedReplies()
+
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
+        self.set_translation_cache()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        if self.translation_cache:
+            self.translation_cache.close()
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        if self.translation_cache:
+            self.translation_cache.close()
+        self.set_translation_cache()
         pass
 
-    def translate(self, text: str, source: str, target: str) -> str:
+    def set_translation_cache(self):
+        self.translation_cache = TranslationCache(
+            max_size=self.valves.cache_size,
+            ttl=self.valves.cache_ttl,
+            path=self.valves.cache_path,
+        )
+
+    async def translate(self, text: str, source: str, target: str) -> str:
+        try:
+            return await self.translation_cache.translate(
+                text,
+                source,
+                target,
+                self.get_backend(),
+                self.request_translation,
+            )
+        except Exception as e:
+            return f"Error: {e}"
+
+    def get_backend(self) -> str:
+        return f"llm:{self.valves.OPENAI_API_BASE_URL}:{self.valves.TASK_MODEL}"
+
+    def outlet_stream_enabled(self, body: dict) -> bool:
+        # Only opted-in filters are put on the server's output streams.
+        return self.valves.stream_translation
+
+    def outlet_stream(self, stream: Iterator[str], body: dict) -> Iterator[str]:
+        # Called by the server on the pipe's output stream, from a worker thread.
+        translated = translate_stream(
+            stream,
+            lambda text: self.translation_cache.translate_sync(
+                text,
+                self.valves.source_assistant,
+                self.valves.target_assistant,
+                self.get_backend(),
+                self.request_translation,
+            ),
+            max_concurrency=self.valves.stream_max_concurrency,
+        )
+        return self.streamed_replies.track(translated)
+
+    def request_translation(self, text: str, source: str, target: str) -> str:
         headers = {}
         headers["Authorization"] = f"Bearer {self.valves.OPENAI_API_KEY}"
         headers["Content-Type"] = "application/json"
@@ -88,20 +155,17 @@ class Pipeline:
         }
         print(payload)
 
-        try:
-            r = requests.post(
-                url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
-                json=payload,
-                headers=headers,
-                stream=False,
-            )
+        r = requests.post(
+            url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
+            json=payload,
+            headers=headers,
+            stream=False,
+        )
 
-            r.raise_for_status()
-            response = r.json()
-            print(response)
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            return f"Error: {e}"
+        r.raise_for_status()
+        response = r.json()
+        print(response)
+        return response["choices"][0]["message"]["content"]
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"inlet:{__name__}")
@@ -112,7 +176,7 @@ class Pipeline:
         print(f"User message: {user_message}")
 
         # Translate user message
-        translated_user_message = self.translate(
+        translated_user_message = await self.translate(
             user_message,
             self.valves.source_user,
             self.valves.target_user,
@@ -137,10 +201,14 @@ class Pipeline:
         messages = body["messages"]
         assistant_message = get_last_assistant_message(messages)
 
+        if self.streamed_replies.seen(assistant_message):
+            # Already translated by outlet_stream while streaming
+            return body
+
         print(f"Assistant message: {assistant_message}")
 
         # Translate assistant message
-        translated_assistant_message = self.translate(
+        translated_assistant_message = await self.translate(
             assistant_message,
             self.valves.source_assistant,
             self.valves.target_assistant,
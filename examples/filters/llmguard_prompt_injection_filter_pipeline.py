@@ -13,8 +13,16 @@ from schemas import OpenAIChatMessage
 from pydantic import BaseModel
 from llm_guard.input_scanners import PromptInjection
 from llm_guard.input_scanners.prompt_injection import MatchType
+from utils.pipelines.batching import MicroBatcher
+from utils.pipelines.cache import LRUCache, hash_text
 import os
 
+
+# Scanner settings, also part of the cache key
+THRESHOLD = 0.8
+MATCH_TYPE = MatchType.FULL
+
+
 class Pipeline:
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
@@ -39,6 +47,17 @@ class Pipeline:
             # The lower the number, the higher the priority.
             priority: int = 0
 
+            # Concurrent prompts are collected and scanned together in one worker call.
+            # Raise these for throughput under load, lower them for latency.
+            batch_max_size: int = 16
+            batch_max_wait_ms: float = 10.0
+
+            # Scores are memoized by message hash. cache_ttl is in seconds (0 = never expire);
+            # set cache_path to an SQLite file to keep scores across restarts.
+            cache_size: int = 4096
+            cache_ttl: int = 0
+            cache_path: str = ""
+
         # Initialize
         self.valves = Valves(
             **{
@@ -47,6 +66,8 @@ class Pipeline:
         )
 
         self.model = None
+        self.batcher = None
+        self.cache = None
 
         pass
 
@@ -54,26 +75,65 @@ class Pipeline:
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
 
-        self.model = PromptInjection(threshold=0.8, match_type=MatchType.FULL)
+        self.model = PromptInjection(threshold=THRESHOLD, match_type=MATCH_TYPE)
+        self.set_batcher()
+        self.set_cache()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        if self.batcher:
+            await self.batcher.close()
+        if self.cache:
+            self.cache.close()
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        if self.batcher:
+            await self.batcher.close()
+        if self.cache:
+            self.cache.close()
+        self.set_batcher()
+        self.set_cache()
         pass
 
+    def set_cache(self):
+        self.cache = LRUCache(
+            max_size=self.valves.cache_size,
+            ttl=self.valves.cache_ttl,
+            path=self.valves.cache_path,
+        )
+
+    def set_batcher(self):
+        self.batcher = MicroBatcher(
+            self.scan_batch,
+            max_batch_size=self.valves.batch_max_size,
+            max_wait_ms=self.valves.batch_max_wait_ms,
+        )
+
+    def scan_batch(self, prompts: List[str]) -> List[tuple]:
+        # LLM Guard scanners only take one prompt at a time, so the batch is
+        # scanned back to back in a single worker call off the event loop.
+        return [self.model.scan(prompt) for prompt in prompts]
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # This filter is applied to the form data before it is sent to the OpenAI API.
         print(f"inlet:{__name__}")
 
         user_message = body["messages"][-1]["content"]
 
-        # Filter out prompt injection messages
-        sanitized_prompt, is_valid, risk_score = self.model.scan(user_message)
+        # Filter out prompt injection messages. Keys are namespaced by filter and scanner
+        # settings, so that filters sharing a cache_path never read each other's verdicts.
+        cache_key = hash_text(
+            "llm-guard:prompt-injection", THRESHOLD, MATCH_TYPE.value, user_message
+        )
+        scan_result = self.cache.get(cache_key)
+        if scan_result is None:
+            scan_result = await self.batcher.submit(user_message)
+            self.cache.set(cache_key, scan_result)
+        sanitized_prompt, is_valid, risk_score = scan_result
 
         if risk_score > 0.8: 
             raise Exception("Prompt injection detected")
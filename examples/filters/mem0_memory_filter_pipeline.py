@@ -8,11 +8,15 @@ description: A filter that processes user messages and stores them as long term
 requirements: pydantic, ollama, mem0ai
 """
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel
+import asyncio
 import json
 from mem0 import Memory
-import threading
+
+from utils.pipelines.cache import LRUCache, hash_text
+from utils.pipelines.embeddings import get_embedding_service
+from utils.pipelines.retrieval import mmr_select
 
 class Pipeline:
     class Valves(BaseModel):
@@ -21,6 +25,28 @@ class Pipeline:
 
         store_cycles: int = 5 # Number of messages from the user before the data is processed and added to the memory
         mem_zero_user: str = "user" # Memories belongs to this user, only used by mem0 for internal organization of memories
+        separate_user_memories: bool = False # Store and search memories per Open WebUI user instead of under mem_zero_user
+
+        # Memory writes are queued and processed in the background by write_workers tasks.
+        # When the queue is full the oldest pending write is dropped.
+        write_queue_size: int = 100
+        write_workers: int = 1
+        # Seconds to wait on shutdown for pending writes to finish before dropping them
+        write_drain_timeout: float = 30.0
+        # Seconds to wait for the memory lookup before continuing without it
+        search_timeout: float = 2.0
+
+        # Retrieval: up to top_k memories scoring at least score_threshold are injected,
+        # picked from search_candidates results with MMR (mmr_lambda 1.0 disables de-duplication)
+        # and capped at memory_token_budget (approx. 4 characters per token).
+        top_k: int = 3
+        score_threshold: float = 0.0
+        search_candidates: int = 10
+        mmr_lambda: float = 0.7
+        memory_token_budget: int = 500
+        # Recent search results per user, invalidated when that user's memories change
+        query_cache_size: int = 256
+        query_cache_ttl: int = 300
 
         # Default values for the mem0 vector store
         vector_store_qdrant_name: str = "memories"
@@ -41,8 +67,13 @@ class Pipeline:
     def __init__(self):
         self.type = "filter"
         self.name = "Memory Filter"
-        self.user_messages = []
-        self.thread = None
+        # Pending messages per user, flushed to memory every store_cycles messages
+        self.user_messages: Dict[str, List[str]] = {}
+        self.write_queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.query_cache: Optional[LRUCache] = None
+        # Bumped whenever a user's memories change, so their cached searches go stale
+        self.memory_generations: Dict[str, int] = {}
         self.valves = self.Valves(
             **{
                 "pipelines": ["*"],  # Connect to all pipelines
@@ -52,16 +83,163 @@ class Pipeline:
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        self.set_query_cache()
+        self.start_workers()
         pass
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        await self.drain_writes()
+        await self.stop_workers()
+        pass
+
+    async def on_valves_updated(self):
+        # Rebuild the queue, workers and cache with the new sizes. Writes still
+        # pending in the old queue are carried over to the new one.
+        await self.stop_workers()
+        pending = []
+        while self.write_queue and not self.write_queue.empty():
+            pending.append(self.write_queue.get_nowait())
+        self.set_query_cache()
+        self.start_workers()
+        for message_text, mem_user in pending:
+            self.enqueue_write(message_text, mem_user)
         pass
 
+    def set_query_cache(self):
+        self.query_cache = LRUCache(
+            max_size=self.valves.query_cache_size, ttl=self.valves.query_cache_ttl
+        )
+
+    def start_workers(self):
+        self.write_queue = asyncio.Queue(maxsize=max(1, self.valves.write_queue_size))
+        self.workers = [
+            asyncio.create_task(self.write_worker())
+            for _ in range(max(1, self.valves.write_workers))
+        ]
+
+    async def drain_writes(self):
+        if not self.write_queue or not self.workers:
+            return
+        try:
+            await asyncio.wait_for(
+                self.write_queue.join(), timeout=self.valves.write_drain_timeout
+            )
+        except asyncio.TimeoutError:
+            print(
+                f"Dropping {self.write_queue.qsize()} pending memory writes after waiting "
+                f"{self.valves.write_drain_timeout}s"
+            )
+
+    async def stop_workers(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def write_worker(self):
+        while True:
+            message_text, mem_user = await self.write_queue.get()
+            try:
+                print("Text to be processed in to a memory:")
+                print(message_text)
+                await asyncio.to_thread(self.m.add, data=message_text, user_id=mem_user)
+                self.memory_generations[mem_user] = (
+                    self.memory_generations.get(mem_user, 0) + 1
+                )
+            except Exception as e:
+                print(f"Error adding memory: {e}")
+            finally:
+                self.write_queue.task_done()
+
+    def enqueue_write(self, message_text: str, mem_user: str):
+        if self.write_queue.full():
+            print("Memory write queue is full, dropping the oldest pending write")
+            self.write_queue.get_nowait()
+            self.write_queue.task_done()
+        self.write_queue.put_nowait((message_text, mem_user))
+
+    async def search_memories(self, query: str, mem_user: str) -> list:
+        cache_key = hash_text(
+            mem_user, str(self.memory_generations.get(mem_user, 0)), query
+        )
+        memories = self.query_cache.get(cache_key)
+        if memories is not None:
+            return memories
+
+        try:
+            memories = await asyncio.wait_for(
+                asyncio.to_thread(self.retrieve_memories, query, mem_user),
+                timeout=self.valves.search_timeout,
+            )
+            self.query_cache.set(cache_key, memories)
+            return memories
+        except asyncio.TimeoutError:
+            print("Memory search timed out, continuing without memories")
+        except Exception as e:
+            print(f"Error searching memories: {e}")
+        return []
+
+    def get_memory_vectors(self, memory_ids: List[str]) -> List[Optional[List[float]]]:
+        # The vectors mem0 stored with the memories, fetched in one round trip instead of re-embedding them.
+        vector_store = self.m.vector_store
+        points = vector_store.client.retrieve(
+            collection_name=vector_store.collection_name,
+            ids=memory_ids,
+            with_vectors=True,
+            with_payload=False,
+        )
+        vectors = {str(point.id): point.vector for point in points}
+        return [vectors.get(str(memory_id)) for memory_id in memory_ids]
+
+    def retrieve_memories(self, query: str, mem_user: str) -> List[str]:
+        """
+        Fetches search_candidates memories in one round trip, drops the ones below
+        score_threshold, de-duplicates them with MMR and fits them into the token budget.
+        """
+        results = self.m.search(
+            query, user_id=mem_user, limit=max(self.valves.search_candidates, self.valves.top_k)
+        )
+        if isinstance(results, dict):
+            # Newer mem0 versions wrap the hits in {"results": [...]}
+            results = results.get("results", [])
+
+        candidates = [
+            result
+            for result in results
+            if (result.get("score") or 0) >= self.valves.score_threshold
+        ]
+
+        if self.valves.mmr_lambda < 1 and len(candidates) > 1:
+            try:
+                vectors = self.get_memory_vectors([result["id"] for result in candidates])
+                if all(vector is not None for vector in vectors):
+                    order = mmr_select(
+                        [result.get("score") or 0 for result in candidates],
+                        vectors,
+                        k=self.valves.top_k,
+                        lambda_mult=self.valves.mmr_lambda,
+                    )
+                    candidates = [candidates[i] for i in order]
+            except Exception as e:
+                print(f"Error de-duplicating memories: {e}")
+
+        memories = []
+        budget = self.valves.memory_token_budget * 4
+        for result in candidates[: self.valves.top_k]:
+            memory = str(result["memory"])
+            if len(memory) > budget:
+                break
+            memories.append(memory)
+            budget -= len(memory)
+
+        return memories
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         print(f"pipe:{__name__}")
 
-        user = self.valves.mem_zero_user
+        user_id = (user or {}).get("id") or self.valves.mem_zero_user
+        mem_user = user_id if self.valves.separate_user_memories else self.valves.mem_zero_user
         store_cycles = self.valves.store_cycles
 
         if isinstance(body, str):
@@ -70,30 +248,22 @@ class Pipeline:
         all_messages = body["messages"]
         last_message = all_messages[-1]["content"]
 
-        self.user_messages.append(last_message)
+        user_messages = self.user_messages.setdefault(user_id, [])
+        user_messages.append(last_message)
 
-        if len(self.user_messages) == store_cycles:
+        if len(user_messages) >= store_cycles:
 
             message_text = ""
-            for message in self.user_messages:
+            for message in user_messages:
                 message_text += message + " "
 
-            if self.thread and self.thread.is_alive():
-                print("Waiting for previous memory to be done")
-                self.thread.join()
-
-            self.thread = threading.Thread(target=self.m.add, kwargs={"data":message_text,"user_id":user})
-
-            print("Text to be processed in to a memory:")
-            print(message_text)
-
-            self.thread.start()
-            self.user_messages.clear()
+            self.enqueue_write(message_text, mem_user)
+            user_messages.clear()
 
-        memories = self.m.search(last_message, user_id=user)
+        memories = await self.search_memories(last_message, mem_user)
 
         if(memories):
-            fetched_memory = memories[0]["memory"]
+            fetched_memory = "\n".join(f"- {memory}" for memory in memories)
         else:
             fetched_memory = ""
 
@@ -101,7 +271,7 @@ class Pipeline:
         print(fetched_memory)
 
         if fetched_memory:
-            all_messages.insert(0, {"role":"system", "content":"This is your inner voice talking, you remember this about the person you chatting with "+str(fetched_memory)})
+            all_messages.insert(0, {"role":"system", "content":"This is your inner voice talking, you remember this about the person you chatting with:\n"+str(fetched_memory)})
 
         print("Final body to send to the LLM:")
         print(body)
@@ -137,4 +307,17 @@ class Pipeline:
             },
         }
 
-        return Memory.from_config(config)
\ No newline at end of file
+        memory = Memory.from_config(config)
+
+        # mem0 embeds the query on every search and each memory on every write. Route
+        # both through the shared embedding service, so repeated texts are embedded
+        # once and the vectors are persisted across restarts.
+        embed_text = memory.embedding_model.embed
+        service = get_embedding_service(
+            f"ollama:{self.valves.ollama_embedder_model}",
+            lambda texts: [embed_text(text) for text in texts],
+        )
+        memory.embedding_model.embed = (
+            lambda text, *args, **kwargs: service.embed_one(text).tolist()
+        )
+        return memory
\ No newline at end of file
@@ -9,12 +9,37 @@ requirements: presidio-analyzer, presidio-anonymizer
 """
 
 import os
+import re
+import asyncio
 from typing import List, Optional
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
-from presidio_analyzer import AnalyzerEngine
+from presidio_analyzer import AnalyzerEngine, PatternRecognizer
 from presidio_anonymizer import AnonymizerEngine
 from presidio_anonymizer.entities import OperatorConfig
+from utils.pipelines.cache import LRUCache, hash_text
+
+# Cheap signal for the NER recognizers: any digit (dates and times) or a
+# capitalized word (names, places, nationalities), wherever it appears, unless
+# it is one of the common words that capitalized usually just start a sentence.
+NER_SIGNAL_PATTERN = re.compile(r"\d|\b[A-Z][a-z]+\b")
+NER_SIGNAL_STOPWORDS = {
+    "a", "about", "after", "all", "also", "an", "and", "any", "are", "as", "at",
+    "be", "because", "but", "by", "can", "could", "create", "describe", "did", "do",
+    "does", "explain", "find", "for", "from", "give", "hello", "help", "hey", "hi",
+    "how", "if", "in", "is", "it", "its", "just", "let", "list", "make", "my", "no",
+    "not", "now", "of", "ok", "okay", "on", "or", "our", "please", "show", "so",
+    "some", "summarize", "tell", "thanks", "that", "the", "then", "there", "these",
+    "they", "this", "those", "to", "we", "what", "when", "where", "which", "who",
+    "why", "with", "would", "write", "yes", "you", "your",
+}
+
+
+def has_ner_signal(text: str) -> bool:
+    return any(
+        match.group().lower() not in NER_SIGNAL_STOPWORDS
+        for match in NER_SIGNAL_PATTERN.finditer(text)
+    )
 
 class Pipeline:
     class Valves(BaseModel):
@@ -27,6 +52,16 @@ class Pipeline:
             "DATE_TIME", "NRP", "MEDICAL_LICENSE", "URL"
         ]
         language: str = "en"
+        # Redactions are memoized by message hash, so earlier turns are not re-analyzed.
+        # cache_ttl is in seconds (0 = never expire); cache_path enables an SQLite tier.
+        cache_size: int = 4096
+        cache_ttl: int = 0
+        cache_path: str = ""
+        # Skip analysis for messages where neither the combined regex of the enabled
+        # pattern recognizers nor the NER signal (a digit, or a capitalized word other
+        # than a common sentence starter) fires. Faster, but names written in lowercase
+        # are not redacted in messages without any other signal.
+        prescreen_enabled: bool = False
 
     def __init__(self):
         self.type = "filter"
@@ -43,18 +78,122 @@ class Pipeline:
 
         self.analyzer = AnalyzerEngine()
         self.anonymizer = AnonymizerEngine()
+        self.cache = None
+        self.prescreen_pattern = None
+        self.prescreen_ner = False
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
+        self.set_cache()
+        self.set_prescreen()
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        if self.cache:
+            self.cache.close()
+
+    async def on_valves_updated(self):
+        if self.cache:
+            self.cache.close()
+        self.set_cache()
+        self.set_prescreen()
+
+    def set_cache(self):
+        self.cache = LRUCache(
+            max_size=self.valves.cache_size,
+            ttl=self.valves.cache_ttl,
+            path=self.valves.cache_path,
+        )
+
+    def set_prescreen(self):
+        """
+        Compiles the regexes of all enabled pattern recognizers into one pattern.
+        Any other recognizer (spaCy NER and friends) is gated by `has_ner_signal`.
+        """
+        regexes = []
+        self.prescreen_ner = False
+
+        for recognizer in self.analyzer.registry.get_recognizers(
+            language=self.valves.language, entities=self.valves.entities_to_redact
+        ):
+            if isinstance(recognizer, PatternRecognizer):
+                regexes.extend(pattern.regex for pattern in recognizer.patterns)
+            else:
+                self.prescreen_ner = True
+
+        try:
+            self.prescreen_pattern = re.compile(
+                "|".join(f"(?:{regex})" for regex in regexes),
+                re.DOTALL | re.MULTILINE | re.IGNORECASE,
+            ) if regexes else None
+        except re.error as e:
+            # Some recognizer regexes can't be combined (e.g. inline global flags),
+            # in which case every message goes through the full analyzer.
+            print(f"Could not compile Presidio pre-screen pattern: {e}")
+            self.prescreen_pattern = re.compile("")
+
+    def may_contain_pii(self, text: str) -> bool:
+        if not self.valves.prescreen_enabled:
+            return True
+        if self.prescreen_pattern and self.prescreen_pattern.search(text):
+            return True
+        return self.prescreen_ner and has_ner_signal(text)
+
+    def get_cache_key(self, text: str) -> str:
+        # The key covers the analyzer settings so valve changes never serve stale redactions.
+        return hash_text(
+            "presidio",
+            self.valves.language, ",".join(self.valves.entities_to_redact), text
+        )
+
+    def redact_messages(self, messages: List[dict]):
+        """
+        Redacts the given messages in place, analyzing only texts that are not cached yet.
+        """
+        cache_keys = [self.get_cache_key(message["content"]) for message in messages]
+        redactions = {}
+        pending = {}
+
+        for message, cache_key in zip(messages, cache_keys):
+            redacted = self.cache.get(cache_key)
+            if redacted is None:
+                pending.setdefault(cache_key, message["content"])
+            else:
+                redactions[cache_key] = redacted
+
+        if pending:
+            for cache_key, redacted in zip(
+                pending.keys(), self.redact_batch(list(pending.values()))
+            ):
+                self.cache.set(cache_key, redacted)
+                redactions[cache_key] = redacted
+
+        for message, cache_key in zip(messages, cache_keys):
+            message["content"] = redactions[cache_key]
+
+    def redact_batch(self, texts: List[str]) -> List[str]:
+        redacted = list(texts)
+        candidates = [i for i, text in enumerate(texts) if self.may_contain_pii(text)]
+
+        if len(candidates) > 1:
+            # Run the spaCy pipeline once over all new messages (nlp.pipe under the hood).
+            batch = self.analyzer.nlp_engine.process_batch(
+                [texts[i] for i in candidates], language=self.valves.language
+            )
+            for i, (_, nlp_artifacts) in zip(candidates, batch):
+                redacted[i] = self.redact_pii(texts[i], nlp_artifacts)
+        else:
+            for i in candidates:
+                redacted[i] = self.redact_pii(texts[i])
+
+        return redacted
 
-    def redact_pii(self, text: str) -> str:
+    def redact_pii(self, text: str, nlp_artifacts=None) -> str:
         results = self.analyzer.analyze(
             text=text,
             language=self.valves.language,
-            entities=self.valves.entities_to_redact
+            entities=self.valves.entities_to_redact,
+            nlp_artifacts=nlp_artifacts,
         )
 
         anonymized_text = self.anonymizer.anonymize(
@@ -73,9 +212,12 @@ class Pipeline:
         print(user)
 
         if user is None or user.get("role") != "admin" or self.valves.enabled_for_admins:
-            messages = body.get("messages", [])
-            for message in messages:
-                if message.get("role") == "user":
-                    message["content"] = self.redact_pii(message["content"])
+            messages = [
+                message
+                for message in body.get("messages", [])
+                if message.get("role") == "user"
+            ]
+            # Analysis is CPU bound, keep it off the event loop.
+            await asyncio.to_thread(self.redact_messages, messages)
 
         return body
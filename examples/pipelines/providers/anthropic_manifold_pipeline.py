@@ -17,6 +17,8 @@ from pydantic import BaseModel
 import sseclient
 
 from utils.pipelines.main import pop_system_message
+from utils.pipelines.images import image_store
+from utils.pipelines.context import fit_messages, get_context_limit
 
 REASONING_EFFORT_BUDGET_TOKEN_MAP = {
     "none": None,
@@ -30,9 +32,33 @@ REASONING_EFFORT_BUDGET_TOKEN_MAP = {
 MAX_COMBINED_TOKENS = 64000
 
 
+def get_budget_tokens(reasoning_effort) -> int:
+    """
+    Maps a reasoning effort level, or an integer budget, to thinking budget tokens.
+    """
+    reasoning_effort = reasoning_effort or "none"
+    budget_tokens = REASONING_EFFORT_BUDGET_TOKEN_MAP.get(reasoning_effort)
+
+    # Allow users to input an integer value representing budget tokens
+    if (
+        not budget_tokens
+        and reasoning_effort not in REASONING_EFFORT_BUDGET_TOKEN_MAP.keys()
+    ):
+        try:
+            budget_tokens = int(reasoning_effort)
+        except (TypeError, ValueError) as e:
+            print("Failed to convert reasoning effort to int", e)
+            budget_tokens = None
+    return budget_tokens
+
+
 class Pipeline:
     class Valves(BaseModel):
         ANTHROPIC_API_KEY: str = ""
+        # Images are downscaled to fit this many pixels on their long edge (0 = keep as is)
+        MAX_IMAGE_DIMENSION: int = 1568
+        # Drop the oldest turns so the prompt plus max_tokens fits the model's context window
+        TRIM_CONTEXT: bool = True
 
     def __init__(self):
         self.type = "manifold"
@@ -82,14 +108,15 @@ class Pipeline:
 
     def process_image(self, image_data):
         if image_data["url"].startswith("data:image"):
-            mime_type, base64_data = image_data["url"].split(",", 1)
-            media_type = mime_type.split(":")[1].split(";")[0]
+            image = image_store.load_url(
+                image_data["url"], self.valves.MAX_IMAGE_DIMENSION
+            )
             return {
                 "type": "image",
                 "source": {
                     "type": "base64",
-                    "media_type": media_type,
-                    "data": base64_data,
+                    "media_type": image.mime_type,
+                    "data": image.base64,
                 },
             }
         else:
@@ -106,6 +133,17 @@ class Pipeline:
             for key in ["user", "chat_id", "title"]:
                 body.pop(key, None)
 
+            # Clients may send "max_tokens": null
+            max_tokens = body.get("max_tokens") or 4096
+            budget_tokens = get_budget_tokens(body.get("reasoning_effort"))
+
+            if self.valves.TRIM_CONTEXT:
+                # Reserve room for the reply and, if requested, the thinking budget
+                reserved_tokens = max_tokens + (budget_tokens or 0)
+                messages = fit_messages(
+                    messages, get_context_limit(model_id) - reserved_tokens
+                )
+
             system_message, messages = pop_system_message(messages)
 
             processed_messages = []
@@ -156,7 +194,7 @@ class Pipeline:
             payload = {
                 "model": model_id,
                 "messages": processed_messages,
-                "max_tokens": body.get("max_tokens", 4096),
+                "max_tokens": max_tokens,
                 "temperature": body.get("temperature", 0.8),
                 "top_k": body.get("top_k", 40),
                 "top_p": body.get("top_p", 0.9),
@@ -167,23 +205,9 @@ class Pipeline:
 
             if body.get("stream", False):
                 supports_thinking = "claude-3-7" in model_id
-                reasoning_effort = body.get("reasoning_effort", "none")
-                budget_tokens = REASONING_EFFORT_BUDGET_TOKEN_MAP.get(reasoning_effort)
-
-                # Allow users to input an integer value representing budget tokens
-                if (
-                    not budget_tokens
-                    and reasoning_effort not in REASONING_EFFORT_BUDGET_TOKEN_MAP.keys()
-                ):
-                    try:
-                        budget_tokens = int(reasoning_effort)
-                    except ValueError as e:
-                        print("Failed to convert reasoning effort to int", e)
-                        budget_tokens = None
 
                 if supports_thinking and budget_tokens:
                     # Check if the combined tokens (budget_tokens + max_tokens) exceeds the limit
-                    max_tokens = payload.get("max_tokens", 4096)
                     combined_tokens = budget_tokens + max_tokens
 
                     if combined_tokens > MAX_COMBINED_TOKENS:
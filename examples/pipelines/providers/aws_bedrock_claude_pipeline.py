@@ -8,10 +8,8 @@ description: A pipeline for generating text and processing images using the AWS
 requirements: requests, boto3
 environment_variables: AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION_NAME
 """
-import base64
 import json
 import logging
-from io import BytesIO
 from typing import List, Union, Generator, Iterator
 
 import boto3
@@ -22,6 +20,7 @@ import os
 import requests
 
 from utils.pipelines.main import pop_system_message
+from utils.pipelines.images import image_store
 
 
 class Pipeline:
@@ -29,6 +28,8 @@ class Pipeline:
         AWS_ACCESS_KEY: str = ""
         AWS_SECRET_KEY: str = ""
         AWS_REGION_NAME: str = ""
+        # Images are downscaled to fit this many pixels on their long edge (0 = keep as is)
+        MAX_IMAGE_DIMENSION: int = 1568
 
     def __init__(self):
         self.type = "manifold"
@@ -118,6 +119,18 @@ class Pipeline:
         logging.info(f"pop_system_message: {json.dumps(messages)}")
 
         try:
+            # Decode and fetch every image in the conversation up front, remote ones concurrently
+            image_store.load_urls(
+                [
+                    item["image_url"]["url"]
+                    for message in messages
+                    if isinstance(message.get("content"), list)
+                    for item in message["content"]
+                    if item["type"] == "image_url"
+                ],
+                self.valves.MAX_IMAGE_DIMENSION,
+            )
+
             processed_messages = []
             image_count = 0
             for message in messages:
@@ -151,18 +164,10 @@ class Pipeline:
             return f"Error: {e}"
 
     def process_image(self, image: str):
-        img_stream = None
-        if image["url"].startswith("data:image"):
-            if ',' in image["url"]:
-                base64_string = image["url"].split(',')[1]
-            image_data = base64.b64decode(base64_string)
-
-            img_stream = BytesIO(image_data)
-        else:
-            img_stream = requests.get(image["url"]).content
+        image_data = image_store.load_url(image["url"], self.valves.MAX_IMAGE_DIMENSION)
         return {
-            "image": {"format": "png" if image["url"].endswith(".png") else "jpeg",
-                      "source": {"bytes": img_stream.read()}}
+            "image": {"format": image_data.format,
+                      "source": {"bytes": image_data.data}}
         }
 
     def stream_response(self, model_id: str, payload: dict) -> Generator:
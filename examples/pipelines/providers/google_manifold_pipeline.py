@@ -17,6 +17,8 @@ from pydantic import BaseModel, Field
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
 
+from utils.pipelines.images import image_store
+
 
 class Pipeline:
     """Google GenAI pipeline"""
@@ -26,6 +28,10 @@ class Pipeline:
 
         GOOGLE_API_KEY: str = ""
         USE_PERMISSIVE_SAFETY: bool = Field(default=False)
+        MAX_IMAGE_DIMENSION: int = Field(
+            default=0,
+            description="Downscale inline images to fit this many pixels on their long edge (0 = keep as is)",
+        )
 
     def __init__(self):
         self.type = "manifold"
@@ -117,8 +123,8 @@ class Pipeline:
                             elif content["type"] == "image_url":
                                 image_url = content["image_url"]["url"]
                                 if image_url.startswith("data:image"):
-                                    image_data = image_url.split(",")[1]
-                                    parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_data}})
+                                    image = image_store.load_url(image_url, self.valves.MAX_IMAGE_DIMENSION)
+                                    parts.append({"inline_data": {"mime_type": image.mime_type, "data": image.base64}})
                                 else:
                                     parts.append({"image_url": image_url})
                         contents.append({"role": message["role"], "parts": parts})
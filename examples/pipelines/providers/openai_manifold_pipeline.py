@@ -10,6 +10,10 @@ class Pipeline:
     class Valves(BaseModel):
         OPENAI_API_BASE_URL: str = "https://api.openai.com/v1"
         OPENAI_API_KEY: str = ""
+        # Serve identical deterministic requests (temperature 0 or a seed) from the server's response cache
+        response_cache: bool = False
+        # Also cache sampled requests, e.g. for title generation; "regenerate" then repeats answers
+        response_cache_sampled: bool = False
         pass
 
     def __init__(self):
@@ -8,49 +8,95 @@ description: A pipeline for retrieving relevant information from a knowledge bas
 requirements: haystack-ai, datasets>=2.6.1, sentence-transformers>=2.2.0
 """
 
-from typing import List, Union, Generator, Iterator
+from typing import List, Literal, Union, Generator, Iterator
 from schemas import OpenAIChatMessage
+from pydantic import BaseModel
 import os
 import asyncio
 
+from utils.pipelines.embedding_store import EmbeddingStore
+from utils.pipelines.ingestion import get_index_dir
+from utils.pipelines.embeddings import get_embedding_service, load_sentence_transformer
+from utils.pipelines.retrieval import load_cross_encoder
+from utils.pipelines.semantic_cache import SemanticCache
+
 
 class Pipeline:
+    class Valves(BaseModel):
+        # Answer paraphrased repeats of earlier questions from a semantic cache
+        semantic_cache: bool = False
+        semantic_cache_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+        semantic_cache_threshold: float = 0.92
+        semantic_cache_size: int = 1024
+        # Seconds a cached answer stays valid, 0 keeps it until evicted
+        semantic_cache_ttl: int = 0
+        # Fraction of cache hits that are re-run to estimate the cache's precision
+        semantic_cache_verify_rate: float = 0.0
+        # Storage type of the persisted document embeddings; int8 is 4x smaller than float32
+        embedding_dtype: Literal["float32", "float16", "int8"] = "float32"
+        # Hybrid retrieval: fuse hybrid_candidates dense and BM25 keyword results
+        # (reciprocal rank fusion), so exact terms such as ids and error codes match
+        hybrid_search: bool = False
+        hybrid_candidates: int = 20
+        rrf_k: int = 60
+        top_k: int = 10
+        # Local cross-encoder that reranks the rerank_top_n fused results, empty disables
+        rerank_model: str = ""
+        rerank_top_n: int = 20
+
     def __init__(self):
         self.basic_rag_pipeline = None
+        self.document_store = None
+        self.retriever = None
+        self.valves = self.Valves()
+        self.semantic_cache = None
+        # Local models held from the shared model registry, released on shutdown
+        self.semantic_cache_model = None
+        self.embedding_model = None
+        self.embedding_model_name = "sentence-transformers/all-MiniLM-L6-v2"
 
     async def on_startup(self):
         os.environ["OPENAI_API_KEY"] = "your_openai_api_key_here"
 
-        from haystack.components.embedders import SentenceTransformersDocumentEmbedder
-        from haystack.components.embedders import SentenceTransformersTextEmbedder
-        from haystack.components.retrievers.in_memory import InMemoryEmbeddingRetriever
         from haystack.components.builders import PromptBuilder
-        from haystack.components.generators import OpenAIGenerator
-
-        from haystack.document_stores.in_memory import InMemoryDocumentStore
-
-        from datasets import load_dataset
-        from haystack import Document
         from haystack import Pipeline
 
-        document_store = InMemoryDocumentStore()
-
-        dataset = load_dataset("bilgeyucel/seven-wonders", split="train")
-        docs = [Document(content=doc["content"], meta=doc["meta"]) for doc in dataset]
-
-        doc_embedder = SentenceTransformersDocumentEmbedder(
-            model="sentence-transformers/all-MiniLM-L6-v2"
+        from utils.pipelines.haystack import (
+            CachedTextEmbedder,
+            EmbeddingStoreRetriever,
+            embed_documents,
+            write_documents,
         )
-        doc_embedder.warm_up()
 
-        docs_with_embeddings = doc_embedder.run(docs)
-        document_store.write_documents(docs_with_embeddings["documents"])
-
-        text_embedder = SentenceTransformersTextEmbedder(
-            model="sentence-transformers/all-MiniLM-L6-v2"
-        )
-
-        retriever = InMemoryEmbeddingRetriever(document_store)
+        embedding_model = self.embedding_model_name
+        store_path = get_index_dir(__name__, "embeddings")
+        fingerprint = f"{embedding_model}:{self.valves.embedding_dtype}"
+        # Document and query embeddings are cached and batched by the shared embedding service.
+        # The model is shared with other pipelines using it, e.g. a semantic cache on the same model.
+        self.embedding_model = self.load_embedding_model()
+        embeddings = get_embedding_service(embedding_model, self.embedding_model)
+
+        # Embeddings persisted by an earlier run are memory-mapped, not recomputed.
+        try:
+            document_store = EmbeddingStore(store_path, fingerprint=fingerprint)
+        except ValueError:
+            document_store = None
+
+        if document_store is None or len(document_store) == 0:
+            docs_with_embeddings = embed_documents(embeddings, self.load_documents())
+            document_store = EmbeddingStore(
+                store_path,
+                dim=len(docs_with_embeddings[0].embedding),
+                dtype=self.valves.embedding_dtype,
+                fingerprint=fingerprint,
+            )
+            write_documents(document_store, docs_with_embeddings)
+
+        text_embedder = CachedTextEmbedder(embeddings)
+
+        self.document_store = document_store
+        self.retriever = EmbeddingStoreRetriever(document_store)
+        self.set_retrieval()
 
         template = """
         Given the following information, answer the question.
@@ -66,12 +112,12 @@ class Pipeline:
 
         prompt_builder = PromptBuilder(template=template)
 
-        generator = OpenAIGenerator(model="gpt-3.5-turbo")
+        generator = self.create_generator()
 
         self.basic_rag_pipeline = Pipeline()
         # Add components to your pipeline
         self.basic_rag_pipeline.add_component("text_embedder", text_embedder)
-        self.basic_rag_pipeline.add_component("retriever", retriever)
+        self.basic_rag_pipeline.add_component("retriever", self.retriever)
         self.basic_rag_pipeline.add_component("prompt_builder", prompt_builder)
         self.basic_rag_pipeline.add_component("llm", generator)
 
@@ -82,12 +128,91 @@ class Pipeline:
         self.basic_rag_pipeline.connect("retriever", "prompt_builder.documents")
         self.basic_rag_pipeline.connect("prompt_builder", "llm")
 
+        # A new index invalidates any cached answers.
+        self.set_semantic_cache()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
+        rerank = self.retriever.rerank if self.retriever else None
+        for model in [self.embedding_model, self.semantic_cache_model, rerank]:
+            if model:
+                model.release()
         pass
 
+    async def on_valves_updated(self):
+        # Cached answers may no longer match the new settings.
+        self.set_semantic_cache()
+        if self.retriever:
+            self.set_retrieval()
+
+    def load_embedding_model(self):
+        return load_sentence_transformer(self.embedding_model_name)
+
+    def load_documents(self) -> list:
+        from datasets import load_dataset
+        from haystack import Document
+
+        dataset = load_dataset("bilgeyucel/seven-wonders", split="train")
+        return [Document(content=doc["content"], meta=doc["meta"]) for doc in dataset]
+
+    def create_generator(self):
+        from haystack.components.generators import OpenAIGenerator
+
+        return OpenAIGenerator(model="gpt-3.5-turbo")
+
+    def set_retrieval(self):
+        from utils.pipelines.haystack import build_bm25
+
+        self.retriever.top_k = self.valves.top_k
+        self.retriever.candidates = self.valves.hybrid_candidates
+        self.retriever.rrf_k = self.valves.rrf_k
+        self.retriever.rerank_top_n = self.valves.rerank_top_n
+        # The new cross-encoder is acquired before the old one is released, so
+        # an unchanged model stays loaded.
+        previous_rerank = self.retriever.rerank
+        self.retriever.rerank = (
+            load_cross_encoder(self.valves.rerank_model)
+            if self.valves.rerank_model
+            else None
+        )
+        if previous_rerank:
+            previous_rerank.release()
+        # The keyword index is built over the stored documents once, when first enabled.
+        if not self.valves.hybrid_search:
+            self.retriever.bm25 = None
+        elif self.retriever.bm25 is None:
+            self.retriever.bm25 = build_bm25(self.document_store)
+
+    def set_semantic_cache(self):
+        if self.semantic_cache_model:
+            self.semantic_cache_model.release()
+        self.semantic_cache_model = (
+            load_sentence_transformer(self.valves.semantic_cache_model)
+            if self.valves.semantic_cache
+            else None
+        )
+        self.semantic_cache = (
+            SemanticCache(
+                get_embedding_service(
+                    self.valves.semantic_cache_model, self.semantic_cache_model
+                ).embed,
+                threshold=self.valves.semantic_cache_threshold,
+                max_size=self.valves.semantic_cache_size,
+                ttl=self.valves.semantic_cache_ttl or None,
+                verify_rate=self.valves.semantic_cache_verify_rate,
+            )
+            if self.valves.semantic_cache
+            else None
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "semantic_cache": (
+                self.semantic_cache.get_stats() if self.semantic_cache else None
+            )
+        }
+
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
@@ -97,10 +222,15 @@ class Pipeline:
         print(messages)
         print(user_message)
 
-        question = user_message
+        if self.semantic_cache:
+            return self.semantic_cache.wrap(user_message, lambda: self.query(user_message))
+        return self.query(user_message)
+
+    def query(self, question: str) -> str:
         response = self.basic_rag_pipeline.run(
             {
                 "text_embedder": {"text": question},
+                "retriever": {"query": question},
                 "prompt_builder": {"question": question},
             }
         )
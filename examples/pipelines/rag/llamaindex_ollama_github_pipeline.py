@@ -13,21 +13,33 @@ from schemas import OpenAIChatMessage
 import os
 import asyncio
 
+from utils.pipelines.llamaindex import (
+    CachedEmbedding,
+    get_index_dir,
+    load_documents_index,
+    stream_query,
+)
+
 
 class Pipeline:
     def __init__(self):
         self.documents = None
         self.index = None
+        self.query_engine = None
 
     async def on_startup(self):
         from llama_index.embeddings.ollama import OllamaEmbedding
         from llama_index.llms.ollama import Ollama
-        from llama_index.core import VectorStoreIndex, Settings
+        from llama_index.core import Settings
         from llama_index.readers.github import GithubRepositoryReader, GithubClient
 
-        Settings.embed_model = OllamaEmbedding(
-            model_name="nomic-embed-text",
-            base_url="http://localhost:11434",
+        # Embeddings are cached and batched by the shared embedding service. The model
+        # is given to the index rather than set on the process-wide Settings.
+        embed_model = CachedEmbedding(
+            OllamaEmbedding(
+                model_name="nomic-embed-text",
+                base_url="http://localhost:11434",
+            )
         )
         Settings.llm = Ollama(model="llama3")
 
@@ -68,7 +80,15 @@ class Pipeline:
         try:
             # Load data from the branch
             self.documents = await asyncio.to_thread(reader.load_data, branch=branch)
-            self.index = VectorStoreIndex.from_documents(self.documents)
+            # Only files whose content changed since the last run are re-embedded.
+            ingestor = await asyncio.to_thread(
+                load_documents_index,
+                self.documents,
+                get_index_dir(__name__),
+                embed_model=embed_model,
+            )
+            self.index = ingestor.index
+            self.query_engine = self.index.as_query_engine(streaming=True)
         finally:
             loop.close()
 
@@ -88,7 +108,4 @@ class Pipeline:
         print(messages)
         print(user_message)
 
-        query_engine = self.index.as_query_engine(streaming=True)
-        response = query_engine.query(user_message)
-
-        return response.response_gen
+        return stream_query(self.query_engine, user_message)
@@ -11,9 +11,21 @@ requirements: llama-index, llama-index-llms-ollama, llama-index-embeddings-ollam
 from typing import List, Union, Generator, Iterator
 from schemas import OpenAIChatMessage
 import os
+import asyncio
 
 from pydantic import BaseModel
 
+from utils.pipelines.llamaindex import (
+    CachedEmbedding,
+    get_index_dir,
+    get_query_engine,
+    load_directory_index,
+    stream_query,
+)
+from utils.pipelines.retrieval import load_cross_encoder
+
+DATA_DIR = "/app/backend/data"
+
 
 class Pipeline:
 
@@ -21,10 +33,31 @@ class Pipeline:
         LLAMAINDEX_OLLAMA_BASE_URL: str
         LLAMAINDEX_MODEL_NAME: str
         LLAMAINDEX_EMBEDDING_MODEL_NAME: str
+        # Incremental ingestion of the data directory
+        LLAMAINDEX_INGEST_BATCH_SIZE: int = 64
+        LLAMAINDEX_INGEST_CONCURRENCY: int = 2
+        # Seconds between re-scans, 0 disables scheduled ingestion
+        LLAMAINDEX_INGEST_INTERVAL: int = 0
+        # Re-ingest as soon as files change (needs the watchfiles package)
+        LLAMAINDEX_INGEST_WATCH: bool = False
+        # Retrieved chunks per query
+        LLAMAINDEX_SIMILARITY_TOP_K: int = 2
+        # Hybrid retrieval: fuse dense and BM25 keyword results, so exact terms such as
+        # ids and error codes match, optionally reranked by a local cross-encoder
+        LLAMAINDEX_HYBRID_SEARCH: bool = False
+        LLAMAINDEX_HYBRID_CANDIDATES: int = 20
+        LLAMAINDEX_RERANK_MODEL: str = ""
+        LLAMAINDEX_RERANK_TOP_N: int = 20
+        # Tokens generated ahead of a slow client
+        LLAMAINDEX_STREAM_BUFFER: int = 64
 
     def __init__(self):
         self.documents = None
         self.index = None
+        self.ingestor = None
+        self.query_engine = None
+        # Local cross-encoder held from the shared model registry, released on shutdown
+        self.rerank = None
 
         self.valves = self.Valves(
             **{
@@ -37,11 +70,15 @@ class Pipeline:
     async def on_startup(self):
         from llama_index.embeddings.ollama import OllamaEmbedding
         from llama_index.llms.ollama import Ollama
-        from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader
-
-        Settings.embed_model = OllamaEmbedding(
-            model_name=self.valves.LLAMAINDEX_EMBEDDING_MODEL_NAME,
-            base_url=self.valves.LLAMAINDEX_OLLAMA_BASE_URL,
+        from llama_index.core import Settings
+
+        # Embeddings are cached and batched by the shared embedding service. The model
+        # is given to the index rather than set on the process-wide Settings.
+        embed_model = CachedEmbedding(
+            OllamaEmbedding(
+                model_name=self.valves.LLAMAINDEX_EMBEDDING_MODEL_NAME,
+                base_url=self.valves.LLAMAINDEX_OLLAMA_BASE_URL,
+            )
         )
         Settings.llm = Ollama(
             model=self.valves.LLAMAINDEX_MODEL_NAME,
@@ -49,16 +86,77 @@ class Pipeline:
         )
 
         # This function is called when the server is started.
-        global documents, index
-
-        self.documents = SimpleDirectoryReader("/app/backend/data").load_data()
-        self.index = VectorStoreIndex.from_documents(self.documents)
+        # Reuses the index persisted by the previous run, re-embedding only changed files.
+        self.ingestor = await asyncio.to_thread(
+            load_directory_index,
+            DATA_DIR,
+            get_index_dir(__name__),
+            batch_size=self.valves.LLAMAINDEX_INGEST_BATCH_SIZE,
+            max_concurrency=self.valves.LLAMAINDEX_INGEST_CONCURRENCY,
+            on_synced=self.on_index_updated,
+            embed_model=embed_model,
+        )
+        self.index = self.ingestor.index
+        self.set_query_engine()
+        self.set_ingestion()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
+        if self.ingestor:
+            await self.ingestor.stop()
+        if self.rerank:
+            self.rerank.release()
         pass
 
+    async def on_valves_updated(self):
+        if self.index:
+            self.set_query_engine()
+        if self.ingestor:
+            await self.ingestor.stop()
+            self.set_ingestion()
+
+    def on_index_updated(self):
+        # The keyword index is built from the nodes, so it must be rebuilt too.
+        if self.index and self.valves.LLAMAINDEX_HYBRID_SEARCH:
+            self.set_query_engine()
+
+    def set_ingestion(self):
+        self.ingestor.batch_size = max(1, self.valves.LLAMAINDEX_INGEST_BATCH_SIZE)
+        self.ingestor.max_concurrency = max(1, self.valves.LLAMAINDEX_INGEST_CONCURRENCY)
+        self.ingestor.start(
+            interval=self.valves.LLAMAINDEX_INGEST_INTERVAL,
+            watch_path=DATA_DIR if self.valves.LLAMAINDEX_INGEST_WATCH else None,
+        )
+
+    def set_query_engine(self):
+        from llama_index.llms.ollama import Ollama
+
+        # The new cross-encoder is acquired before the old one is released, so
+        # an unchanged model stays loaded across rebuilds.
+        previous_rerank = self.rerank
+        self.rerank = (
+            load_cross_encoder(self.valves.LLAMAINDEX_RERANK_MODEL)
+            if self.valves.LLAMAINDEX_HYBRID_SEARCH and self.valves.LLAMAINDEX_RERANK_MODEL
+            else None
+        )
+        # Built once per valves update rather than on every request.
+        self.query_engine = get_query_engine(
+            self.index,
+            lock=self.ingestor.index_lock if self.ingestor else None,
+            similarity_top_k=self.valves.LLAMAINDEX_SIMILARITY_TOP_K,
+            hybrid=self.valves.LLAMAINDEX_HYBRID_SEARCH,
+            candidates=self.valves.LLAMAINDEX_HYBRID_CANDIDATES,
+            rerank=self.rerank,
+            rerank_top_n=self.valves.LLAMAINDEX_RERANK_TOP_N,
+            llm=Ollama(
+                model=self.valves.LLAMAINDEX_MODEL_NAME,
+                base_url=self.valves.LLAMAINDEX_OLLAMA_BASE_URL,
+            ),
+        )
+        if previous_rerank:
+            previous_rerank.release()
+
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
@@ -68,7 +166,6 @@ class Pipeline:
         print(messages)
         print(user_message)
 
-        query_engine = self.index.as_query_engine(streaming=True)
-        response = query_engine.query(user_message)
-
-        return response.response_gen
+        return stream_query(
+            self.query_engine, user_message, self.valves.LLAMAINDEX_STREAM_BUFFER
+        )
@@ -10,12 +10,63 @@ requirements: llama-index
 
 from typing import List, Union, Generator, Iterator
 from schemas import OpenAIChatMessage
+from pydantic import BaseModel
+import asyncio
+
+from utils.pipelines.llamaindex import (
+    cached_embedding,
+    get_index_dir,
+    get_query_engine,
+    load_directory_index,
+    stream_query,
+)
+from utils.pipelines.embeddings import get_embedding_service, load_sentence_transformer
+from utils.pipelines.retrieval import load_cross_encoder
+from utils.pipelines.semantic_cache import SemanticCache
 
 
 class Pipeline:
+    class Valves(BaseModel):
+        # Answer paraphrased repeats of earlier questions from a semantic cache
+        semantic_cache: bool = False
+        semantic_cache_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+        semantic_cache_threshold: float = 0.92
+        semantic_cache_size: int = 1024
+        # Seconds a cached answer stays valid, 0 keeps it until evicted
+        semantic_cache_ttl: int = 0
+        # Fraction of cache hits that are re-run to estimate the cache's precision
+        semantic_cache_verify_rate: float = 0.0
+        # Incremental ingestion of ./data
+        ingest_batch_size: int = 64
+        ingest_concurrency: int = 2
+        # Seconds between re-scans of ./data, 0 disables scheduled ingestion
+        ingest_interval: int = 0
+        # Re-ingest as soon as files change (needs the watchfiles package)
+        ingest_watch: bool = False
+        # Retrieved chunks per query
+        similarity_top_k: int = 2
+        # Hybrid retrieval: fuse hybrid_candidates dense and BM25 keyword results
+        # (reciprocal rank fusion), so exact terms such as ids and error codes match
+        hybrid_search: bool = False
+        hybrid_candidates: int = 20
+        rrf_k: int = 60
+        # Local cross-encoder that reranks the rerank_top_n fused results, empty disables
+        rerank_model: str = ""
+        rerank_top_n: int = 20
+        # Tokens generated ahead of a slow client
+        stream_buffer: int = 64
+
     def __init__(self):
         self.documents = None
         self.index = None
+        self.ingestor = None
+        self.query_engine = None
+        self.data_dir = "./data"
+        self.valves = self.Valves()
+        self.semantic_cache = None
+        # Local models held from the shared model registry, released on shutdown
+        self.semantic_cache_model = None
+        self.rerank = None
 
     async def on_startup(self):
         import os
@@ -23,17 +74,116 @@ class Pipeline:
         # Set the OpenAI API key
         os.environ["OPENAI_API_KEY"] = "your-api-key-here"
 
-        from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
+        from llama_index.core import Settings
+
+        # Embeddings are cached and batched by the shared embedding service. The model
+        # is given to the index rather than set on the process-wide Settings.
+        embed_model = cached_embedding(Settings.embed_model)
 
-        self.documents = SimpleDirectoryReader("./data").load_data()
-        self.index = VectorStoreIndex.from_documents(self.documents)
+        # Reuses the index persisted by the previous run, re-embedding only changed files.
+        self.ingestor = await asyncio.to_thread(
+            load_directory_index,
+            self.data_dir,
+            get_index_dir(__name__),
+            batch_size=self.valves.ingest_batch_size,
+            max_concurrency=self.valves.ingest_concurrency,
+            on_synced=self.on_index_updated,
+            embed_model=embed_model,
+        )
+        self.index = self.ingestor.index
+        self.set_query_engine()
+        self.set_ingestion()
+        self.set_semantic_cache()
         # This function is called when the server is started.
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
+        if self.ingestor:
+            await self.ingestor.stop()
+        for model in [self.semantic_cache_model, self.rerank]:
+            if model:
+                model.release()
         pass
 
+    async def on_valves_updated(self):
+        # Cached answers may no longer match the new settings.
+        self.set_semantic_cache()
+        if self.index:
+            self.set_query_engine()
+        if self.ingestor:
+            await self.ingestor.stop()
+            self.set_ingestion()
+
+    def on_index_updated(self):
+        # Answers cached before the corpus changed may be stale.
+        if self.semantic_cache:
+            self.semantic_cache.invalidate()
+        # The keyword index is built from the nodes, so it must be rebuilt too.
+        if self.index and self.valves.hybrid_search:
+            self.set_query_engine()
+
+    def set_query_engine(self):
+        # The new cross-encoder is acquired before the old one is released, so
+        # an unchanged model stays loaded across rebuilds.
+        previous_rerank = self.rerank
+        self.rerank = (
+            load_cross_encoder(self.valves.rerank_model)
+            if self.valves.hybrid_search and self.valves.rerank_model
+            else None
+        )
+        # Built once per valves update rather than on every request.
+        self.query_engine = get_query_engine(
+            self.index,
+            lock=self.ingestor.index_lock if self.ingestor else None,
+            similarity_top_k=self.valves.similarity_top_k,
+            hybrid=self.valves.hybrid_search,
+            candidates=self.valves.hybrid_candidates,
+            rrf_k=self.valves.rrf_k,
+            rerank=self.rerank,
+            rerank_top_n=self.valves.rerank_top_n,
+        )
+        if previous_rerank:
+            previous_rerank.release()
+
+    def set_ingestion(self):
+        self.ingestor.batch_size = max(1, self.valves.ingest_batch_size)
+        self.ingestor.max_concurrency = max(1, self.valves.ingest_concurrency)
+        self.ingestor.start(
+            interval=self.valves.ingest_interval,
+            watch_path=self.data_dir if self.valves.ingest_watch else None,
+        )
+
+    def set_semantic_cache(self):
+        if self.semantic_cache_model:
+            self.semantic_cache_model.release()
+        self.semantic_cache_model = (
+            load_sentence_transformer(self.valves.semantic_cache_model)
+            if self.valves.semantic_cache
+            else None
+        )
+        self.semantic_cache = (
+            SemanticCache(
+                get_embedding_service(
+                    self.valves.semantic_cache_model, self.semantic_cache_model
+                ).embed,
+                threshold=self.valves.semantic_cache_threshold,
+                max_size=self.valves.semantic_cache_size,
+                ttl=self.valves.semantic_cache_ttl or None,
+                verify_rate=self.valves.semantic_cache_verify_rate,
+            )
+            if self.valves.semantic_cache
+            else None
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "semantic_cache": (
+                self.semantic_cache.get_stats() if self.semantic_cache else None
+            ),
+            "ingestion": self.ingestor.stats if self.ingestor else None,
+        }
+
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
@@ -43,7 +193,9 @@ class Pipeline:
         print(messages)
         print(user_message)
 
-        query_engine = self.index.as_query_engine(streaming=True)
-        response = query_engine.query(user_message)
+        if self.semantic_cache:
+            return self.semantic_cache.wrap(user_message, lambda: self.query(user_message))
+        return self.query(user_message)
 
-        return response.response_gen
+    def query(self, user_message: str) -> Generator:
+        return stream_query(self.query_engine, user_message, self.valves.stream_buffer)
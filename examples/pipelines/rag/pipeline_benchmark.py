@@ -0,0 +1,390 @@
+"""
+End-to-end cost benchmark for the RAG pipelines: drives `Pipeline.pipe` of
+the Haystack and LlamaIndex pipelines over a corpus and a query set, with a
+local fake LLM, and reports per pipeline and configuration:
+
+- ingest: seconds spent in `on_startup` embedding and indexing the corpus
+- index: size of the persisted index on disk, and of the in-memory BM25 index
+- recall and retrieval p50/p95/p99 latency, measured on the pipeline's retriever
+- time to first token and total time of `pipe`, p50/p95/p99
+- peak RSS: high-water mark of the process running the configuration
+
+Run from the repository root:
+
+    python -m examples.pipelines.rag.pipeline_benchmark
+    python -m examples.pipelines.rag.pipeline_benchmark --pipelines llamaindex \
+        --model sentence-transformers/all-MiniLM-L6-v2 --rerank-model cross-encoder/ms-marco-MiniLM-L-6-v2
+    python -m examples.pipelines.rag.pipeline_benchmark --config top5='{"top_k": 5}' --config cached='{"semantic_cache": true}'
+
+--corpus and --queries take the JSON lines files of retrieval_benchmark;
+without them its synthetic corpus is used. Without --model, the hashing
+embedder is used, so nothing is downloaded. The fake LLM echoes the end of
+its prompt after --first-token-ms, one token every --token-ms, to separate
+the pipeline's own overhead from generation.
+
+Each configuration runs in a fresh process with its own PIPELINES_DIR and no
+persistent embedding cache, so that ingestion starts cold and the memory
+high-water mark is not shared between configurations.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Set, Tuple
+
+from utils.pipelines.benchmark import evaluate_retrieval, hash_embed, percentiles
+from examples.pipelines.rag.retrieval_benchmark import load_jsonl, synthetic_dataset
+
+
+PIPELINES = {
+    "haystack": "examples.pipelines.rag.haystack_pipeline",
+    "llamaindex": "examples.pipelines.rag.llamaindex_pipeline",
+}
+
+# Valves each retriever's k is read from, for recall@k
+TOP_K_VALVES = {"haystack": "top_k", "llamaindex": "similarity_top_k"}
+
+
+def fake_tokens(prompt: str, tokens: int, first_token_ms: float, token_ms: float) -> Iterator[str]:
+    time.sleep(first_token_ms / 1000)
+    for i, word in enumerate(prompt.split()[-tokens:]):
+        if i:
+            time.sleep(token_ms / 1000)
+        yield f"{word} "
+
+
+def peak_rss_mb() -> float:
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+
+
+def directory_mb(path: str) -> float:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return total / 1e6
+
+
+def load_embed(options: dict):
+    """
+    Returns `(model name, embed function)`. The function has a `release()`
+    like the registry-backed ones, so the pipelines can release it.
+    """
+    if options["model"]:
+        from utils.pipelines.embeddings import load_sentence_transformer
+
+        return options["model"], load_sentence_transformer(options["model"])
+
+    def embed(texts: List[str]):
+        return hash_embed(texts, options["dim"])
+
+    embed.release = lambda: None
+    return f"hash-{options['dim']}", embed
+
+
+def haystack_pipeline(module, documents: List[dict], options: dict):
+    from haystack import Document, component
+
+    @component
+    class FakeGenerator:
+        @component.output_types(replies=List[str], meta=List[dict])
+        def run(self, prompt: str):
+            reply = "".join(
+                fake_tokens(prompt, options["tokens"], options["first_token_ms"], options["token_ms"])
+            )
+            return {"replies": [reply], "meta": [{}]}
+
+    model_name, embed = load_embed(options)
+
+    class BenchmarkPipeline(module.Pipeline):
+        def load_embedding_model(self):
+            return embed
+
+        def load_documents(self) -> list:
+            return [Document(id=document["id"], content=document["text"]) for document in documents]
+
+        def create_generator(self):
+            return FakeGenerator()
+
+    pipeline = BenchmarkPipeline()
+    pipeline.embedding_model_name = model_name
+
+    embedder = None
+
+    def search(query: str, k: int) -> List[str]:
+        nonlocal embedder
+        embedder = embedder or pipeline.basic_rag_pipeline.get_component("text_embedder")
+        embedding = embedder.run(text=query)["embedding"]
+        results = pipeline.retriever.run(query_embedding=embedding, query=query, top_k=k)
+        return [document.id for document in results["documents"]]
+
+    def get_bm25():
+        return pipeline.retriever.bm25
+
+    return pipeline, search, get_bm25
+
+
+def llamaindex_pipeline(module, documents: List[dict], options: dict):
+    from llama_index.core import Settings
+    from llama_index.core.embeddings import BaseEmbedding
+    from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+    from llama_index.core.llms.callbacks import llm_completion_callback
+
+    model_name, embed = load_embed(options)
+
+    class FunctionEmbedding(BaseEmbedding):
+        @classmethod
+        def class_name(cls) -> str:
+            return "FunctionEmbedding"
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            return self._get_text_embeddings([query])[0]
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return self._get_query_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            return self._get_text_embeddings([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            return [[float(value) for value in embedding] for embedding in embed(texts)]
+
+    class FakeLLM(CustomLLM):
+        @property
+        def metadata(self) -> LLMMetadata:
+            return LLMMetadata(model_name="fake")
+
+        def tokens(self, prompt: str) -> Iterator[str]:
+            return fake_tokens(
+                prompt, options["tokens"], options["first_token_ms"], options["token_ms"]
+            )
+
+        @llm_completion_callback()
+        def complete(self, prompt: str, formatted: bool = False, **kwargs) -> CompletionResponse:
+            return CompletionResponse(text="".join(self.tokens(prompt)))
+
+        @llm_completion_callback()
+        def stream_complete(self, prompt: str, formatted: bool = False, **kwargs):
+            def generate():
+                text = ""
+                for token in self.tokens(prompt):
+                    text += token
+                    yield CompletionResponse(text=text, delta=token)
+
+            return generate()
+
+    # One file per document, named by position since ids may not be valid file names
+    data_dir = os.path.join(os.environ["PIPELINES_DIR"], "data")
+    os.makedirs(data_dir, exist_ok=True)
+    ids_by_file = {}
+    for i, document in enumerate(documents):
+        file_name = f"{i:06d}.txt"
+        with open(os.path.join(data_dir, file_name), "w") as f:
+            f.write(document["text"])
+        ids_by_file[file_name] = document["id"]
+
+    Settings.llm = FakeLLM()
+    Settings.embed_model = FunctionEmbedding(model_name=model_name)
+
+    pipeline = module.Pipeline()
+    pipeline.data_dir = data_dir
+
+    def search(query: str, k: int) -> List[str]:
+        results = pipeline.query_engine.retriever.retrieve(query)
+        return [ids_by_file.get(result.node.metadata.get("file_name")) for result in results[:k]]
+
+    def get_bm25():
+        return getattr(pipeline.query_engine.retriever, "bm25", None)
+
+    return pipeline, search, get_bm25
+
+
+# Builds the pipeline with the fake LLM and local embedder, a retrieval-only search and its BM25 index
+BUILDERS = {"haystack": haystack_pipeline, "llamaindex": llamaindex_pipeline}
+
+
+async def benchmark(
+    name: str,
+    valves: dict,
+    documents: List[dict],
+    queries: List[Tuple[str, Set[str]]],
+    options: dict,
+) -> dict:
+    module = importlib.import_module(PIPELINES[name])
+    pipeline, search, get_bm25 = BUILDERS[name](module, documents, options)
+    pipeline.valves = pipeline.Valves(**valves)
+    baseline_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    await pipeline.on_startup()
+    ingest_seconds = time.perf_counter() - start
+
+    ttft, totals = [], []
+    for query, _ in queries:
+        messages = [{"role": "user", "content": query}]
+        body = {"model": name, "messages": messages, "stream": True}
+
+        start = time.perf_counter()
+        first = None
+        result = pipeline.pipe(query, name, messages, body)
+        if isinstance(result, str):
+            first = time.perf_counter()
+        else:
+            for _ in result:
+                first = first or time.perf_counter()
+        end = time.perf_counter()
+        ttft.append(1000 * ((first or end) - start))
+        totals.append(1000 * (end - start))
+
+    # Both phases should embed every query, not read the first phase's embeddings.
+    from utils.pipelines import embeddings
+
+    if embeddings.embedding_cache is not None:
+        embeddings.embedding_cache.clear()
+
+    k = getattr(pipeline.valves, TOP_K_VALVES[name])
+    retrieval = evaluate_retrieval(search, queries, [k])
+    bm25 = get_bm25()
+
+    await pipeline.on_shutdown()
+
+    return {
+        "ingest_seconds": ingest_seconds,
+        "index_mb": directory_mb(os.environ["PIPELINES_DIR"]) - directory_mb(
+            os.path.join(os.environ["PIPELINES_DIR"], "data")
+        ),
+        "bm25_mb": bm25.nbytes / 1e6 if bm25 is not None else 0.0,
+        "k": k,
+        "recall": retrieval[f"recall@{k}"],
+        "retrieval_ms": retrieval["latency_ms"],
+        "ttft_ms": percentiles(ttft),
+        "total_ms": percentiles(totals),
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_benchmark(name: str, valves: dict, documents, queries, options: dict) -> dict:
+    # Runs in the configuration's own process; the pipelines print every request.
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(sys.stdout if options["verbose"] else devnull):
+            return asyncio.run(benchmark(name, valves, documents, queries, options))
+
+
+def parse_configs(args) -> Dict[str, dict]:
+    if args.config:
+        configs = {}
+        for config in args.config:
+            name, _, valves = config.partition("=")
+            configs[name] = json.loads(valves or "{}")
+        return configs
+
+    configs = {"dense": {}, "hybrid": {"hybrid_search": True}}
+    if args.rerank_model:
+        configs["hybrid+rerank"] = {"hybrid_search": True, "rerank_model": args.rerank_model}
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pipelines", default=",".join(PIPELINES))
+    parser.add_argument(
+        "--config",
+        action="append",
+        metavar="NAME=VALVES",
+        help="Configuration as a name and a JSON object of valves, repeatable. Default: dense and hybrid",
+    )
+    parser.add_argument("--corpus")
+    parser.add_argument("--queries")
+    parser.add_argument("--size", type=int, default=1000, help="Synthetic corpus size")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--model", default="", help="sentence-transformers model, default hashing")
+    parser.add_argument("--dim", type=int, default=256, help="Hashing embedder dimensions")
+    parser.add_argument("--rerank-model", default="")
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens per fake LLM answer")
+    parser.add_argument("--first-token-ms", type=float, default=0.0)
+    parser.add_argument("--token-ms", type=float, default=0.0)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipelines' output")
+    args = parser.parse_args()
+
+    if args.corpus and args.queries:
+        documents = [
+            {"id": str(document["id"]), "text": document["text"]}
+            for document in load_jsonl(args.corpus)
+        ]
+        queries = [(q["query"], set(map(str, q["relevant"]))) for q in load_jsonl(args.queries)]
+    else:
+        documents, queries = synthetic_dataset(args.size)
+    queries = queries[: args.num_queries]
+
+    options = {
+        "model": args.model,
+        "dim": args.dim,
+        "tokens": args.tokens,
+        "first_token_ms": args.first_token_ms,
+        "token_ms": args.token_ms,
+        "verbose": args.verbose,
+    }
+    configs = parse_configs(args)
+
+    print(f"{len(documents)} documents, {len(queries)} queries, embedder: {args.model or 'hashing'}")
+    print(
+        f"{'pipeline':<12}{'config':<16}{'ingest s':>9}{'index MB':>9}{'bm25 MB':>8}{'recall@k':>10}"
+        f"{'ret p50':>8}{'p95':>7}{'p99':>7}{'ttft p50':>9}{'p95':>7}{'p99':>7}{'peak MB':>8}"
+    )
+
+    root = tempfile.mkdtemp(prefix="pipeline-benchmark-")
+    results = []
+    try:
+        for name in args.pipelines.split(","):
+            for config, valves in configs.items():
+                # Set before the process starts, since config.py reads them on import.
+                os.environ["PIPELINES_DIR"] = os.path.join(root, f"{name}-{len(results)}")
+                os.environ["PIPELINES_EMBEDDING_CACHE_PATH"] = ""
+
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context("spawn")
+                ) as executor:
+                    try:
+                        result = executor.submit(
+                            run_benchmark, name, valves, documents, queries, options
+                        ).result()
+                    except Exception as e:
+                        print(f"{name:<12}{config:<16}failed: {type(e).__name__}: {e}")
+                        results.append({"pipeline": name, "config": config, "error": str(e)})
+                        continue
+
+                results.append({"pipeline": name, "config": config, "valves": valves, **result})
+                retrieval, ttft = result["retrieval_ms"], result["ttft_ms"]
+                print(
+                    f"{name:<12}{config:<16}{result['ingest_seconds']:>9.2f}{result['index_mb']:>9.1f}"
+                    f"{result['bm25_mb']:>8.1f}{result['recall']:>7.3f}@{result['k']:<2}"
+                    f"{retrieval['p50']:>8.1f}{retrieval['p95']:>7.1f}{retrieval['p99']:>7.1f}"
+                    f"{ttft['p50']:>9.1f}{ttft['p95']:>7.1f}{ttft['p99']:>7.1f}"
+                    f"{result['peak_rss_mb']:>8.0f}"
+                )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    print("Latencies in milliseconds; peak MB is the resident set high-water mark of the run.")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
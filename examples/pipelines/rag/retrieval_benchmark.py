@@ -0,0 +1,159 @@
+"""
+Recall@k and latency benchmark for the RAG retrievers: dense (EmbeddingStore),
+BM25 keyword search, their hybrid fusion and, with --rerank-model, hybrid
+retrieval reranked by a local cross-encoder.
+
+Run from the repository root:
+
+    python -m examples.pipelines.rag.retrieval_benchmark
+    python -m examples.pipelines.rag.retrieval_benchmark --corpus docs.jsonl --queries queries.jsonl \
+        --model sentence-transformers/all-MiniLM-L6-v2
+
+--corpus is a JSON lines file of {"id", "text"} documents and --queries one of
+{"query", "relevant": [ids]}. Without them a synthetic corpus is generated, in
+which half the queries look up an error code and half paraphrase a document.
+Without --model, documents are embedded with a hashing embedder, which needs
+no download but only captures word overlap.
+"""
+
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+
+from typing import List, Set, Tuple
+
+from utils.pipelines.benchmark import evaluate_retrieval, hash_embed
+from utils.pipelines.embedding_store import EmbeddingStore
+from utils.pipelines.retrieval import BM25Index, hybrid_search, load_cross_encoder
+
+
+TOPICS = [
+    "database connection pool exhausted while writing the session table",
+    "upload rejected because the file exceeds the configured size limit",
+    "authentication token expired and the refresh request failed",
+    "scheduled backup job could not reach the object storage bucket",
+    "model server returned an empty response during streaming",
+    "disk usage crossed the alert threshold on the worker node",
+    "certificate chain could not be verified for the upstream host",
+    "rate limit reached for the embeddings endpoint",
+]
+FILLER = "the service logs this condition and operators should check the dashboard before retrying".split()
+
+
+def synthetic_dataset(size: int, seed: int = 0) -> Tuple[List[dict], List[Tuple[str, Set[str]]]]:
+    rng = random.Random(seed)
+    documents, queries = [], []
+    for i in range(size):
+        code = f"ERR-{i:05d}"
+        topic = rng.choice(TOPICS)
+        words = topic.split() + rng.sample(FILLER, 6)
+        documents.append({"id": str(i), "text": f"{code}: {' '.join(words)}."})
+
+        if i % 2:
+            queries.append((f"What does {code} mean?", {str(i)}))
+        else:
+            paraphrase = rng.sample(topic.split(), min(5, len(topic.split())))
+            queries.append((f"{' '.join(paraphrase)} {code.lower()}", {str(i)}))
+    return documents, rng.sample(queries, min(len(queries), 500))
+
+
+def load_jsonl(path: str) -> List[dict]:
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus")
+    parser.add_argument("--queries")
+    parser.add_argument("--size", type=int, default=5000, help="Synthetic corpus size")
+    parser.add_argument("--model", default="", help="sentence-transformers model, default hashing")
+    parser.add_argument("--rerank-model", default="")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--rrf-k", type=int, default=60)
+    parser.add_argument("--k", default="1,5,10")
+    args = parser.parse_args()
+
+    if args.corpus and args.queries:
+        documents = load_jsonl(args.corpus)
+        queries = [(q["query"], set(map(str, q["relevant"]))) for q in load_jsonl(args.queries)]
+    else:
+        documents, queries = synthetic_dataset(args.size)
+    k_values = [int(k) for k in args.k.split(",")]
+
+    if args.model:
+        from utils.pipelines.embeddings import load_sentence_transformer
+
+        embed = load_sentence_transformer(args.model)
+    else:
+        embed = hash_embed
+
+    ids = [str(document["id"]) for document in documents]
+    texts = [document["text"] for document in documents]
+
+    start = time.perf_counter()
+    embeddings = embed(texts)
+    store_dir = tempfile.mkdtemp(prefix="retrieval-benchmark-")
+    store = EmbeddingStore(
+        store_dir,
+        dim=len(embeddings[0]),
+        dtype=args.dtype,
+    )
+    store.add(ids, embeddings, texts)
+    dense_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bm25 = BM25Index(ids, texts)
+    bm25_seconds = time.perf_counter() - start
+
+    text_by_id = dict(zip(ids, texts))
+
+    def dense(query: str, k: int) -> List[str]:
+        return [document["id"] for _, document in store.search(embed([query])[0], k)]
+
+    def keyword(query: str, k: int) -> List[str]:
+        return [id for id, _ in bm25.search(query, k)]
+
+    def hybrid(query: str, k: int, rerank=None) -> List[str]:
+        candidates = max(k, args.candidates)
+        results = hybrid_search(
+            query,
+            [dense(query, candidates), keyword(query, candidates)],
+            k,
+            rrf_k=args.rrf_k,
+            rerank=rerank,
+            rerank_top_n=candidates,
+            get_texts=lambda ids: [text_by_id[id] for id in ids],
+        )
+        return [id for id, _ in results]
+
+    retrievers = {"dense": dense, "bm25": keyword, "hybrid": hybrid}
+    if args.rerank_model:
+        rerank = load_cross_encoder(args.rerank_model)
+        retrievers["hybrid+rerank"] = lambda query, k: hybrid(query, k, rerank)
+
+    print(f"{len(documents)} documents, {len(queries)} queries")
+    print(f"dense index: {dense_seconds:.2f}s, bm25 index: {bm25_seconds:.2f}s, {bm25.nbytes / 1e6:.1f} MB")
+    print(
+        f"{'retriever':<15}"
+        + "".join(f"{f'recall@{k}':>11}" for k in k_values)
+        + f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    )
+    for name, search in retrievers.items():
+        result = evaluate_retrieval(search, queries, k_values)
+        latency = result["latency_ms"]
+        print(
+            f"{name:<15}"
+            + "".join(f"{result[f'recall@{k}']:>11.3f}" for k in k_values)
+            + f"{latency['p50']:>9.2f}{latency['p95']:>9.2f}{latency['p99']:>9.2f}"
+        )
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,41 @@ date: 2024-08-11
 version: 1.1
 license: MIT
 description: A pipeline for using text-to-SQL for retrieving relevant information from a database using the Llama Index library.
-requirements: llama_index, sqlalchemy, psycopg2-binary
+requirements: llama_index, sqlalchemy, psycopg2-binary, sqlglot
 """
 
 from typing import List, Union, Generator, Iterator
 import os 
+import asyncio
+import threading
 from pydantic import BaseModel
 from llama_index.llms.ollama import Ollama
 from llama_index.core.query_engine import NLSQLTableQueryEngine
-from llama_index.core import SQLDatabase, PromptTemplate
-from sqlalchemy import create_engine
+from llama_index.core import PromptTemplate
+
+from utils.pipelines.llamaindex import CachedSQLDatabase, stream_query
+from utils.pipelines.sql import create_pooled_engine
+
+# Set up the custom prompt used when generating SQL queries from text
+TEXT_TO_SQL_PROMPT = """
+Given an input question, first create a syntactically correct {dialect} query to run, then look at the results of the query and return the answer. 
+You can order the results by a relevant column to return the most interesting examples in the database.
+Unless the user specifies in the question a specific number of examples to obtain, query for at most 5 results using the LIMIT clause as per Postgres. You can order the results to return the most informative data in the database.
+Never query for all the columns from a specific table, only ask for a few relevant columns given the question.
+You should use DISTINCT statements and avoid returning duplicates wherever possible.
+Pay attention to use only the column names that you can see in the schema description. Be careful to not query for columns that do not exist. Pay attention to which column is in which table. Also, qualify column names with the table name when needed. You are required to use the following format, each taking one line:
+
+Question: Question here
+SQLQuery: SQL Query to run
+SQLResult: Result of the SQLQuery
+Answer: Final answer here
+
+Only use tables listed below.
+{schema}
+
+Question: {query_str}
+SQLQuery: 
+"""
 
 
 class Pipeline:
@@ -27,12 +52,27 @@ class Pipeline:
         DB_TABLE: str
         OLLAMA_HOST: str
         TEXT_TO_SQL_MODEL: str 
+        # Connection pool; connections are pinged before use and replaced after DB_POOL_RECYCLE seconds
+        DB_POOL_SIZE: int = 5
+        DB_MAX_OVERFLOW: int = 10
+        DB_POOL_RECYCLE: int = 1800
+        # Query results cached by normalized SQL; SQL_CACHE_SIZE 0 disables the cache
+        SQL_CACHE_SIZE: int = 256
+        SQL_CACHE_TTL: int = 300
+        # Guardrails: generated SQL must be a single read-only query; results are capped
+        # at SQL_MAX_ROWS rows and SQL_TIMEOUT seconds, and the LLM summarizes a sample
+        SQL_MAX_ROWS: int = 100
+        SQL_TIMEOUT: float = 30.0
+        SQL_SAMPLE_ROWS: int = 20
+        SQL_SAMPLE_COLUMNS: int = 10
 
 
     # Update valves/ environment variables based on your selected database 
     def __init__(self):
         self.name = "Database RAG Pipeline"
         self.engine = None
+        self.query_engine = None
+        self.query_engine_lock = threading.Lock()
         self.nlsql_response = ""
 
         # Initialize
@@ -52,52 +92,38 @@ class Pipeline:
 
     def init_db_connection(self):
         # Update your DB connection string based on selected DB engine - current connection string is for Postgres
-        self.engine = create_engine(f"postgresql+psycopg2://{self.valves.DB_USER}:{self.valves.DB_PASSWORD}@{self.valves.DB_HOST}:{self.valves.DB_PORT}/{self.valves.DB_DATABASE}")
+        if self.engine:
+            self.engine.dispose()
+        self.engine = create_pooled_engine(
+            f"postgresql+psycopg2://{self.valves.DB_USER}:{self.valves.DB_PASSWORD}@{self.valves.DB_HOST}:{self.valves.DB_PORT}/{self.valves.DB_DATABASE}",
+            pool_size=self.valves.DB_POOL_SIZE,
+            max_overflow=self.valves.DB_MAX_OVERFLOW,
+            pool_recycle=self.valves.DB_POOL_RECYCLE,
+        )
         return self.engine
 
-    async def on_startup(self):
-        # This function is called when the server is started.
+    def init_query_engine(self):
+        # Built once per valves update: reflects the table schema and sets up the LLM client.
         self.init_db_connection()
 
-    async def on_shutdown(self):
-        # This function is called when the server is stopped.
-        pass
-
-    def pipe(
-        self, user_message: str, model_id: str, messages: List[dict], body: dict
-    ) -> Union[str, Generator, Iterator]:
-        # Debug logging is required to see what SQL query is generated by the LlamaIndex library; enable on Pipelines server if needed
-
         # Create database reader for Postgres
-        sql_database = SQLDatabase(self.engine, include_tables=[self.valves.DB_TABLE])
+        sql_database = CachedSQLDatabase(
+            self.engine,
+            include_tables=[self.valves.DB_TABLE],
+            cache_size=self.valves.SQL_CACHE_SIZE,
+            cache_ttl=self.valves.SQL_CACHE_TTL,
+            max_rows=self.valves.SQL_MAX_ROWS,
+            timeout=self.valves.SQL_TIMEOUT,
+            sample_rows=self.valves.SQL_SAMPLE_ROWS,
+            sample_columns=self.valves.SQL_SAMPLE_COLUMNS,
+        )
 
         # Set up LLM connection; uses phi3 model with 128k context limit since some queries have returned 20k+ tokens
         llm = Ollama(model=self.valves.TEXT_TO_SQL_MODEL, base_url=self.valves.OLLAMA_HOST, request_timeout=180.0, context_window=30000)
 
-        # Set up the custom prompt used when generating SQL queries from text
-        text_to_sql_prompt = """
-        Given an input question, first create a syntactically correct {dialect} query to run, then look at the results of the query and return the answer. 
-        You can order the results by a relevant column to return the most interesting examples in the database.
-        Unless the user specifies in the question a specific number of examples to obtain, query for at most 5 results using the LIMIT clause as per Postgres. You can order the results to return the most informative data in the database.
-        Never query for all the columns from a specific table, only ask for a few relevant columns given the question.
-        You should use DISTINCT statements and avoid returning duplicates wherever possible.
-        Pay attention to use only the column names that you can see in the schema description. Be careful to not query for columns that do not exist. Pay attention to which column is in which table. Also, qualify column names with the table name when needed. You are required to use the following format, each taking one line:
-
-        Question: Question here
-        SQLQuery: SQL Query to run
-        SQLResult: Result of the SQLQuery
-        Answer: Final answer here
+        text_to_sql_template = PromptTemplate(TEXT_TO_SQL_PROMPT)
 
-        Only use tables listed below.
-        {schema}
-
-        Question: {query_str}
-        SQLQuery: 
-        """
-
-        text_to_sql_template = PromptTemplate(text_to_sql_prompt)
-
-        query_engine = NLSQLTableQueryEngine(
+        self.query_engine = NLSQLTableQueryEngine(
             sql_database=sql_database, 
             tables=[self.valves.DB_TABLE],
             llm=llm, 
@@ -105,7 +131,43 @@ class Pipeline:
             text_to_sql_prompt=text_to_sql_template, 
             streaming=True
         )
+        return self.query_engine
+
+    def try_init_query_engine(self):
+        # An unreachable database must not stop the server from starting; the
+        # engine is built on the first request instead, which reports the error.
+        try:
+            with self.query_engine_lock:
+                self.init_query_engine()
+        except Exception as e:
+            self.query_engine = None
+            print(f"Could not set up the text-to-SQL query engine, retrying on the next request: {e}")
+
+    def get_query_engine(self):
+        if self.query_engine is None:
+            with self.query_engine_lock:
+                if self.query_engine is None:
+                    self.init_query_engine()
+        return self.query_engine
+
+    async def on_startup(self):
+        # This function is called when the server is started.
+        await asyncio.to_thread(self.try_init_query_engine)
+
+    async def on_shutdown(self):
+        # This function is called when the server is stopped.
+        if self.engine:
+            self.engine.dispose()
 
-        response = query_engine.query(user_message)
+    async def on_valves_updated(self):
+        # Connection settings, tables or model may have changed; cached schema and results are dropped.
+        self.query_engine = None
+        await asyncio.to_thread(self.try_init_query_engine)
+
+    def pipe(
+        self, user_message: str, model_id: str, messages: List[dict], body: dict
+    ) -> Union[str, Generator, Iterator]:
+        # Debug logging is required to see what SQL query is generated by the LlamaIndex library; enable on Pipelines server if needed
 
-        return response.response_gen
+        # Schema reflection, LLM client and prompt are reused; only the query runs per request.
+        return stream_query(self.get_query_engine(), user_message)
@@ -1,20 +1,33 @@
 from fastapi import FastAPI, Request, Depends, status, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 
 
 from starlette.responses import StreamingResponse, Response
 from pydantic import BaseModel, ConfigDict
-from typing import List, Union, Generator, Iterator
+from typing import List, Union, AsyncIterator, Generator, Iterator
 
 
 from utils.pipelines.auth import bearer_security, get_current_user
-from utils.pipelines.main import get_last_user_message, stream_message_template
+from utils.pipelines.main import (
+    get_last_user_message,
+    stream_message_template,
+    split_stream_chunk,
+)
 from utils.pipelines.misc import convert_to_raw_url
+from utils.pipelines.tokenizer import estimate_usage
+from utils.pipelines.embeddings import get_embedding_stats
+from utils.pipelines.models import model_registry
+from utils.pipelines.response_cache import (
+    ResponseCache,
+    is_deterministic,
+    make_response_cache_key,
+)
 
+from collections import deque
 from contextlib import asynccontextmanager
 from concurrent.futures import ThreadPoolExecutor
-from schemas import FilterForm, OpenAIChatCompletionForm
+from schemas import FilterForm
 from urllib.parse import urlparse
 
 import shutil
@@ -29,7 +42,22 @@ import sys
 import subprocess
 
 
-from config import API_KEY, PIPELINES_DIR
+from config import (
+    API_KEY,
+    PIPELINES_DIR,
+    MAX_REQUEST_BODY_SIZE,
+    MAX_REQUEST_MESSAGES,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_PATH,
+)
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 if not os.path.exists(PIPELINES_DIR):
     os.makedirs(PIPELINES_DIR)
@@ -39,6 +67,12 @@ PIPELINES = {}
 PIPELINE_MODULES = {}
 PIPELINE_NAMES = {}
 
+response_cache = ResponseCache(
+    max_size=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL or None,
+    path=RESPONSE_CACHE_PATH or None,
+)
+
 
 def get_all_pipelines():
     pipelines = {}
@@ -107,6 +141,53 @@ def get_all_pipelines():
     return pipelines
 
 
+def get_stream_filters(model_id: str, body: dict) -> list:
+    """
+    Returns the filter pipelines connected to `model_id` that transform this
+    request's output stream, ordered by priority. A filter takes part only if
+    it has an `outlet_stream` and its `outlet_stream_enabled(body)` is true.
+    """
+    stream_filters = []
+    for pipeline in PIPELINE_MODULES.values():
+        if getattr(pipeline, "type", None) != "filter" or not hasattr(
+            pipeline, "outlet_stream"
+        ):
+            continue
+        enabled = getattr(pipeline, "outlet_stream_enabled", None)
+        if enabled is None or not enabled(body):
+            continue
+
+        valves = getattr(pipeline, "valves", None)
+        target_pipelines = getattr(valves, "pipelines", [])
+        if "*" in target_pipelines or model_id in target_pipelines:
+            stream_filters.append(pipeline)
+
+    return sorted(
+        stream_filters,
+        key=lambda pipeline: getattr(pipeline.valves, "priority", 0),
+    )
+
+
+def get_response_cache_key(module, model_id: str, body: dict):
+    """
+    Returns the response cache key for a request, or None if the pipeline has
+    not opted in with a truthy `response_cache` valve. Only deterministic
+    requests (temperature 0 or a seed) are cached, unless the pipeline also
+    sets `response_cache_sampled`. The valves are part of the key, so
+    updating them invalidates earlier responses.
+    """
+    valves = getattr(module, "valves", None)
+    if not getattr(valves, "response_cache", False):
+        return None
+    if not is_deterministic(body) and not getattr(
+        valves, "response_cache_sampled", False
+    ):
+        return None
+    return make_response_cache_key(
+        model_id, body["messages"], body, namespace=valves.model_dump_json()
+    )
+
+
 def parse_frontmatter(content):
     frontmatter = {}
     for line in content.split("\n"):
@@ -248,6 +329,7 @@ async def lifespan(app: FastAPI):
     await on_startup()
     yield
     await on_shutdown()
+    response_cache.close()
 
 
 app = FastAPI(docs_url="/docs", redoc_url=None, lifespan=lifespan)
@@ -545,6 +627,45 @@ async def get_valves_spec(pipeline_id: str):
     return pipeline.valves.schema()
 
 
+# Registered before /{pipeline_id}/stats, which would otherwise match them.
+@app.get("/v1/response_cache/stats")
+@app.get("/response_cache/stats")
+async def get_response_cache_stats(user: str = Depends(get_current_user)):
+    return response_cache.get_stats()
+
+
+@app.get("/v1/embeddings/stats")
+@app.get("/embeddings/stats")
+async def get_embeddings_stats(user: str = Depends(get_current_user)):
+    return get_embedding_stats()
+
+
+@app.get("/v1/model_registry/stats")
+@app.get("/model_registry/stats")
+async def get_model_registry_stats(user: str = Depends(get_current_user)):
+    return model_registry.get_stats()
+
+
+@app.get("/v1/{pipeline_id}/stats")
+@app.get("/{pipeline_id}/stats")
+async def get_pipeline_stats(pipeline_id: str, user: str = Depends(get_current_user)):
+    if pipeline_id not in PIPELINE_MODULES:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Pipeline {pipeline_id} not found",
+        )
+
+    pipeline = PIPELINE_MODULES[pipeline_id]
+
+    if hasattr(pipeline, "get_stats") is False:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Stats for {pipeline_id} not found",
+        )
+
+    return pipeline.get_stats()
+
+
 @app.post("/v1/{pipeline_id}/valves/update")
 @app.post("/{pipeline_id}/valves/update")
 async def update_valves(pipeline_id: str, form_data: dict):
@@ -652,98 +773,266 @@ async def filter_outlet(pipeline_id: str, form_data: FilterForm):
         )
 
 
+async def read_request_body(request: Request) -> bytes:
+    """
+    Reads the raw request body, rejecting it as soon as it exceeds MAX_REQUEST_BODY_SIZE.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit():
+        if int(content_length) > MAX_REQUEST_BODY_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Request body exceeds {MAX_REQUEST_BODY_SIZE} bytes",
+            )
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_REQUEST_BODY_SIZE:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Request body exceeds {MAX_REQUEST_BODY_SIZE} bytes",
+            )
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def parse_chat_completion_request(raw_body: bytes) -> dict:
+    """
+    Parses a chat completion request into a plain dict, validating only the
+    fields the server relies on: model, messages (role and content) and stream.
+    """
+
+    def invalid(detail: str):
+        return HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=detail
+        )
+
+    try:
+        body = json_loads(raw_body)
+    except ValueError as e:
+        raise invalid(f"Invalid JSON body: {e}")
+
+    if not isinstance(body, dict):
+        raise invalid("Request body must be a JSON object")
+    if not isinstance(body.get("model"), str):
+        raise invalid("'model' must be a string")
+
+    messages = body.get("messages")
+    if not isinstance(messages, list):
+        raise invalid("'messages' must be a list")
+    if len(messages) > MAX_REQUEST_MESSAGES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Too many messages, the limit is {MAX_REQUEST_MESSAGES}",
+        )
+    for message in messages:
+        if (
+            not isinstance(message, dict)
+            or not isinstance(message.get("role"), str)
+            or not isinstance(message.get("content"), (str, list))
+        ):
+            raise invalid("Each message needs a string 'role' and a string or list 'content'")
+
+    stream = body.get("stream", True)
+    if not isinstance(stream, bool):
+        raise invalid("'stream' must be a boolean")
+    body["stream"] = stream
+
+    return body
+
+
+@app.post("/v1/response_cache/clear")
+@app.post("/response_cache/clear")
+async def clear_response_cache(user: str = Depends(get_current_user)):
+    response_cache.clear()
+    return {"status": True}
+
+
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
-async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
-    messages = [message.model_dump() for message in form_data.messages]
+async def generate_openai_chat_completion(request: Request):
+    # Parsed once into plain dicts; `messages` is the same list object as body["messages"].
+    body = parse_chat_completion_request(await read_request_body(request))
+    messages = body["messages"]
+    model = body["model"]
     user_message = get_last_user_message(messages)
 
     if (
-        form_data.model not in app.state.PIPELINES
-        or app.state.PIPELINES[form_data.model]["type"] == "filter"
+        model not in app.state.PIPELINES
+        or app.state.PIPELINES[model]["type"] == "filter"
     ):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Pipeline {form_data.model} not found",
+            detail=f"Pipeline {model} not found",
         )
 
     def job():
-        print(form_data.model)
+        print(model)
 
-        pipeline = app.state.PIPELINES[form_data.model]
-        pipeline_id = form_data.model
+        pipeline = app.state.PIPELINES[model]
+        pipeline_id = model
 
         print(pipeline_id)
 
         if pipeline["type"] == "manifold":
             manifold_id, pipeline_id = pipeline_id.split(".", 1)
-            pipe = PIPELINE_MODULES[manifold_id].pipe
+            module = PIPELINE_MODULES[manifold_id]
         else:
-            pipe = PIPELINE_MODULES[pipeline_id].pipe
+            module = PIPELINE_MODULES[pipeline_id]
+        pipe = module.pipe
 
-        if form_data.stream:
+        cache_key = get_response_cache_key(module, model, body)
 
-            def stream_content():
-                res = pipe(
-                    user_message=user_message,
-                    model_id=pipeline_id,
-                    messages=messages,
-                    body=form_data.model_dump(),
-                )
+        def run_pipe():
+            # Cached responses come back as plain strings and are framed like any other string output.
+            if cache_key:
+                cached = response_cache.get(cache_key, model)
+                if cached is not None:
+                    return cached
 
-                logging.info(f"stream:true:{res}")
+            res = pipe(
+                user_message=user_message,
+                model_id=pipeline_id,
+                messages=messages,
+                body=body,
+            )
 
-                if isinstance(res, str):
-                    message = stream_message_template(form_data.model, res)
-                    logging.info(f"stream_content:str:{message}")
-                    yield f"data: {json.dumps(message)}\n\n"
+            if cache_key:
+                res = response_cache.record(cache_key, res, model)
+            return res
 
-                if isinstance(res, Iterator):
-                    for line in res:
-                        if isinstance(line, BaseModel):
-                            line = line.model_dump_json()
-                            line = f"data: {line}"
+        if body["stream"]:
 
-                        try:
-                            line = line.decode("utf-8")
-                        except:
-                            pass
+            def format_stream_line(line) -> str:
+                if isinstance(line, BaseModel):
+                    line = line.model_dump_json()
+                    line = f"data: {line}"
 
-                        logging.info(f"stream_content:Generator:{line}")
-
-                        if line.startswith("data:"):
-                            yield f"{line}\n\n"
-                        else:
-                            line = stream_message_template(form_data.model, line)
-                            yield f"data: {json.dumps(line)}\n\n"
-
-                if isinstance(res, str) or isinstance(res, Generator):
-                    finish_message = {
-                        "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": form_data.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "logprobs": None,
-                                "finish_reason": "stop",
-                            }
-                        ],
-                    }
+                try:
+                    line = line.decode("utf-8")
+                except:
+                    pass
+
+                logging.info(f"stream_content:Generator:{line}")
+
+                if line.startswith("data:"):
+                    return f"{line}\n\n"
+                else:
+                    line = stream_message_template(model, line)
+                    return f"data: {json.dumps(line)}\n\n"
+
+            def stream_finish():
+                finish_message = {
+                    "id": f"{model}-{str(uuid.uuid4())}",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {},
+                            "logprobs": None,
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+
+                yield f"data: {json.dumps(finish_message)}\n\n"
+                yield f"data: [DONE]"
+
+            def filter_stream(res, stream_filters):
+                # Filters transform only the text; other chunks (role, tool calls,
+                # usage, finish reason) are forwarded unchanged, the final ones last.
+                forward, final = deque(), []
+
+                def text_stream():
+                    for line in [res] if isinstance(res, str) else res:
+                        text, rest, is_final = split_stream_chunk(line)
+                        if text:
+                            yield text
+                        if rest is not None:
+                            (final if is_final else forward).append(rest)
+
+                stream = text_stream()
+                for stream_filter in stream_filters:
+                    stream = stream_filter.outlet_stream(stream, body)
+
+                for text in stream:
+                    while forward:
+                        yield forward.popleft()
+                    if text:
+                        yield text
+                yield from forward
+                yield from final
+
+            def stream_content(res):
+                source = res
+                try:
+                    stream_filters = get_stream_filters(model, body)
+                    if stream_filters and isinstance(res, (str, Iterator)):
+                        res = filter_stream(res, stream_filters)
+
+                    if isinstance(res, str):
+                        message = stream_message_template(model, res)
+                        logging.info(f"stream_content:str:{message}")
+                        yield f"data: {json.dumps(message)}\n\n"
+
+                    if isinstance(res, Iterator):
+                        for line in res:
+                            yield format_stream_line(line)
+
+                    if isinstance(res, str) or isinstance(res, Generator):
+                        yield from stream_finish()
+                finally:
+                    # Stops the pipe's producer (e.g. a PrefetchStream) when the client goes away.
+                    if hasattr(source, "close"):
+                        source.close()
+
+            async def stream_async_content(res):
+                # Read on the event loop, e.g. from a PrefetchStream, without a thread hop per chunk.
+                try:
+                    async for line in res:
+                        yield format_stream_line(line)
+                finally:
+                    if hasattr(res, "aclose"):
+                        await res.aclose()
+
+                if isinstance(res, Generator):
+                    for line in stream_finish():
+                        yield line
 
-                    yield f"data: {json.dumps(finish_message)}\n\n"
-                    yield f"data: [DONE]"
+            async def stream_response():
+                res = await run_in_threadpool(run_pipe)
 
-            return StreamingResponse(stream_content(), media_type="text/event-stream")
+                logging.info(f"stream:true:{res}")
+
+                content = None
+                if isinstance(res, AsyncIterator) and not get_stream_filters(
+                    model, body
+                ):
+                    stream = stream_async_content(res)
+                else:
+                    content = stream_content(res)
+                    stream = iterate_in_threadpool(content)
+
+                try:
+                    async for line in stream:
+                        yield line
+                finally:
+                    # iterate_in_threadpool does not close the generator it wraps on disconnect.
+                    if content is not None:
+                        try:
+                            content.close()
+                        except ValueError:
+                            # Still running in its worker thread; it is closed when collected.
+                            pass
+
+            return StreamingResponse(stream_response(), media_type="text/event-stream")
         else:
-            res = pipe(
-                user_message=user_message,
-                model_id=pipeline_id,
-                messages=messages,
-                body=form_data.model_dump(),
-            )
+            res = run_pipe()
             logging.info(f"stream:false:{res}")
 
             if isinstance(res, dict):
@@ -763,10 +1052,10 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
 
                 logging.info(f"stream:false:{message}")
                 return {
-                    "id": f"{form_data.model}-{str(uuid.uuid4())}",
+                    "id": f"{model}-{str(uuid.uuid4())}",
                     "object": "chat.completion",
                     "created": int(time.time()),
-                    "model": form_data.model,
+                    "model": model,
                     "choices": [
                         {
                             "index": 0,
@@ -778,6 +1067,7 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
                             "finish_reason": "stop",
                         }
                     ],
+                    "usage": estimate_usage(messages, message, model),
                 }
 
     return await run_in_threadpool(job)
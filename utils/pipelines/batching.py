@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from typing import Any, Callable, List, Optional
+
+
+class MicroBatcher:
+    """
+    Collects concurrent single-item requests into batches and runs them through
+    one batched call, then hands each caller back its own result.
+
+    A batch is dispatched once it holds `max_batch_size` items or the oldest
+    item has waited `max_wait_ms`, whichever comes first. Larger values favour
+    throughput, smaller values favour latency.
+
+    :param fn: Takes a list of inputs and returns a list of results in the same order.
+        Runs in a worker thread, so it may block (e.g. a CPU forward pass).
+    :param max_batch_size: Maximum number of items per call to `fn`.
+    :param max_wait_ms: Maximum time an item waits for the batch to fill.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10.0,
+    ):
+        self.fn = fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0.0, max_wait_ms)
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        # Items taken off the queue whose batch has not completed yet
+        self.inflight: list = []
+        self.stats = {"items": 0, "batches": 0}
+
+    async def submit(self, item: Any) -> Any:
+        """Queues an item and waits for its result."""
+        if self.task is None or self.task.done():
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def close(self):
+        try:
+            if self.task is not None:
+                self.task.cancel()
+                try:
+                    await self.task
+                except asyncio.CancelledError:
+                    pass
+        finally:
+            self.task = None
+
+            # Fail the batch being collected or run, and anything still queued,
+            # so that no caller waits forever.
+            pending, self.inflight = self.inflight, []
+            while self.queue is not None and not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(RuntimeError("Batcher closed"))
+
+    async def _collect(self) -> list:
+        batch = self.inflight = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+
+            # Skip items whose callers have already gone away.
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                self.inflight = []
+                continue
+
+            try:
+                results = await asyncio.to_thread(self.fn, [item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError(
+                        f"Batch function returned {len(results)} results for {len(batch)} inputs"
+                    )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self.inflight = []
+                continue
+
+            self.stats["items"] += len(batch)
+            self.stats["batches"] += 1
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.inflight = []
@@ -0,0 +1,66 @@
+import hashlib
+import time
+
+from typing import Callable, Dict, List, Sequence, Set, Tuple
+
+import numpy as np
+
+from utils.pipelines.retrieval import tokenize
+
+
+def percentiles(values: Sequence[float], ps: Sequence[int] = (50, 95, 99)) -> Dict[str, float]:
+    if not len(values):
+        return {f"p{p}": 0.0 for p in ps}
+    return {f"p{p}": float(np.percentile(values, p)) for p in ps}
+
+
+def hash_embed(texts: List[str], dim: int = 256) -> np.ndarray:
+    """
+    Deterministic feature-hashing embedder (signed bag of words), so that
+    benchmarks run without downloading a model. It captures word overlap,
+    not meaning.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        for token in tokenize(text):
+            value = int.from_bytes(
+                hashlib.blake2b(token.encode(), digest_size=8).digest(), "little"
+            )
+            vectors[i, value % dim] += 1.0 if value >> 63 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def recall_at_k(retrieved: List[str], relevant: Set[str], k: int) -> float:
+    if not relevant:
+        return 0.0
+    return len(set(retrieved[:k]) & relevant) / len(relevant)
+
+
+def evaluate_retrieval(
+    search: Callable[[str, int], List[str]],
+    queries: List[Tuple[str, Set[str]]],
+    k_values: Sequence[int] = (1, 5, 10),
+) -> dict:
+    """
+    Runs every query through `search` and returns the mean recall@k for each
+    k in `k_values` and the latency percentiles in milliseconds.
+
+    :param search: Returns the ids of the best documents for a query, best first.
+    :param queries: `(query, relevant ids)` pairs.
+    """
+    max_k = max(k_values)
+    recalls = {k: [] for k in k_values}
+    latencies = []
+
+    for query, relevant in queries:
+        start = time.perf_counter()
+        retrieved = search(query, max_k)
+        latencies.append(1000 * (time.perf_counter() - start))
+        for k in k_values:
+            recalls[k].append(recall_at_k(retrieved, relevant, k))
+
+    return {
+        **{f"recall@{k}": float(np.mean(values)) if values else 0.0 for k, values in recalls.items()},
+        "latency_ms": percentiles(latencies),
+    }
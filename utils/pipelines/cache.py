@@ -0,0 +1,198 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+
+def hash_text(*parts: str) -> str:
+    """
+    Returns a stable content hash for one or more strings, suitable as a cache key.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """
+    In-memory LRU cache with an optional TTL and an optional SQLite tier on disk.
+
+    Memory hits are served from an OrderedDict. Memory misses fall through to
+    the disk tier (if `path` is set) and are promoted back into memory. Values
+    must be picklable to be stored on disk.
+
+    The disk tier runs in WAL mode and `set_many` writes a whole batch in one
+    transaction. Expired rows, and beyond `max_disk_size` the least recently
+    used ones, are pruned every few writes.
+
+    With `max_bytes` and `sizeof` set, the memory tier is also bounded by the
+    total size of its values, for caches whose entries vary widely in size.
+
+    :param max_size: Maximum number of entries kept in memory.
+    :param ttl: Seconds an entry stays valid. 0 or None means no expiry.
+    :param path: SQLite file for the disk tier. Empty or None disables it.
+    :param max_disk_size: Maximum number of entries kept on disk. 0 means unbounded.
+    :param max_bytes: Maximum total size of the entries kept in memory. 0 means unbounded.
+    :param sizeof: Returns the size in bytes of a value, used with `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        path: str = None,
+        max_disk_size: int = 0,
+        max_bytes: int = 0,
+        sizeof: Callable[[Any], int] = None,
+    ):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl or None
+        self.path = path or None
+        self.max_disk_size = max(0, max_disk_size)
+        self.max_bytes = max(0, max_bytes) if sizeof else 0
+        self.sizeof = sizeof
+
+        self.entries: OrderedDict = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self.disk_writes = 0
+
+        self.db = None
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            # WAL with synchronous=NORMAL commits without an fsync per transaction.
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)"
+            )
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(cache)")]
+            if "accessed" not in columns:
+                self.db.execute("ALTER TABLE cache ADD COLUMN accessed REAL")
+            self.db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self._prune()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > now:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                self._pop_memory(key)
+
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT value, expires FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, expires = pickle.loads(row[0]), row[1]
+                    if expires is None or expires > now:
+                        self._set_memory(key, value, expires)
+                        self.stats["disk_hits"] += 1
+                        self.db.execute(
+                            "UPDATE cache SET accessed = ? WHERE key = ?", (now, key)
+                        )
+                        self.db.commit()
+                        return value
+                    self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self.db.commit()
+
+            self.stats["misses"] += 1
+            return default
+
+    def set(self, key: str, value: Any):
+        self.set_many([(key, value)])
+
+    def set_many(self, items: Iterable[Tuple[str, Any]]):
+        """
+        Stores several entries, writing them to disk in a single transaction.
+        """
+        items = list(items)
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        # Pickled outside the lock, so readers are not held up by serialization.
+        rows = (
+            [(key, pickle.dumps(value), expires, now) for key, value in items]
+            if self.db is not None
+            else []
+        )
+        with self.lock:
+            for key, value in items:
+                self._set_memory(key, value, expires)
+            if self.db is not None and rows:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self.db.commit()
+                self.disk_writes += len(rows)
+                if self.disk_writes >= max(100, self.max_disk_size // 10 or 1000):
+                    self._prune()
+
+    def __contains__(self, key: str) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            if self.db is not None:
+                self.db.execute("DELETE FROM cache")
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def _prune(self):
+        # Called with the lock held, or before the cache is shared.
+        self.disk_writes = 0
+        self.db.execute(
+            "DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (time.time(),)
+        )
+        if self.max_disk_size:
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_size,),
+            )
+        self.db.commit()
+
+    def _set_memory(self, key: str, value: Any, expires: Optional[float]):
+        self._pop_memory(key)
+        self.entries[key] = (value, expires)
+        if self.max_bytes:
+            self.sizes[key] = self.sizeof(value)
+            self.bytes += self.sizes[key]
+        # The newest entry is always kept, even if it alone exceeds max_bytes.
+        while len(self.entries) > self.max_size or (
+            self.max_bytes and self.bytes > self.max_bytes and len(self.entries) > 1
+        ):
+            self._pop_memory(next(iter(self.entries)))
+
+    def _pop_memory(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.bytes -= self.sizes.pop(key, 0)
@@ -0,0 +1,134 @@
+from typing import Callable, List, Literal, Optional
+
+from utils.pipelines.tokenizer import (
+    MESSAGE_OVERHEAD_TOKENS,
+    count_messages_tokens,
+    count_messages_tokens_batch,
+    count_tokens,
+)
+
+
+# Context window sizes in tokens, matched against model ids by substring.
+# More specific names must come before the families they belong to.
+MODEL_CONTEXT_LIMITS = [
+    ("claude-3", 200000),
+    ("claude", 200000),
+    ("gpt-4o", 128000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4.1", 1047576),
+    ("gpt-4-32k", 32768),
+    ("gpt-4", 8192),
+    ("gpt-3.5-turbo", 16385),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("gemini-1.5", 1048576),
+    ("gemini-2", 1048576),
+    ("gemini", 32768),
+    ("command-r", 128000),
+    ("deepseek", 65536),
+    ("llama-3.1", 128000),
+    ("llama3.1", 128000),
+    ("llama", 8192),
+    ("mixtral", 32768),
+    ("mistral", 32768),
+]
+DEFAULT_CONTEXT_LIMIT = 8192
+
+
+def get_context_limit(model_id: str, default: int = DEFAULT_CONTEXT_LIMIT) -> int:
+    model_id = model_id.lower()
+    for name, limit in MODEL_CONTEXT_LIMITS:
+        if name in model_id:
+            return limit
+    return default
+
+
+def truncate_message(message: dict, max_tokens: int) -> dict:
+    """
+    Returns a copy of `message` whose text keeps only its last `max_tokens` tokens (approximately).
+    """
+    content = message.get("content", "")
+    if not isinstance(content, str):
+        return message
+
+    tokens = count_tokens(content)
+    if tokens <= max_tokens:
+        return message
+
+    keep = max(0, len(content) * max_tokens // max(tokens, 1))
+    return {**message, "content": "..." + content[len(content) - keep :]}
+
+
+def fit_messages(
+    messages: List[dict],
+    max_tokens: int,
+    strategy: Literal["drop", "truncate", "summarize"] = "drop",
+    summarize: Optional[Callable[[List[dict]], str]] = None,
+) -> List[dict]:
+    """
+    Trims a conversation so it fits in `max_tokens`.
+
+    System messages and the latest message are always kept. The oldest other
+    turns are dropped until the rest fits. With "summarize", the dropped turns
+    are replaced by a system message holding `summarize(dropped_turns)`. With
+    "truncate", the latest message is cut down as a last resort if it still
+    does not fit on its own.
+
+    :param messages: The chat messages, oldest first.
+    :param max_tokens: Token budget for the prompt.
+    :param strategy: "drop", "truncate" or "summarize".
+    :param summarize: Summarizer for the "summarize" strategy.
+    :return: A new list of messages; `messages` is not modified.
+    """
+    if count_messages_tokens(messages) <= max_tokens or not messages:
+        return messages
+
+    system_messages = [message for message in messages if message.get("role") == "system"]
+    history = [message for message in messages if message.get("role") != "system"]
+    latest = history[-1:] if history else []
+    history = history[:-1]
+
+    budget = max_tokens - count_messages_tokens(system_messages) - count_messages_tokens(latest)
+    if strategy == "summarize" and summarize:
+        # Leave room for the summary itself
+        budget -= max_tokens // 10
+
+    # Keep the newest turns that fit
+    kept = []
+    for message, tokens in zip(
+        reversed(history), reversed(count_messages_tokens_batch(history))
+    ):
+        if tokens > budget:
+            break
+        kept.insert(0, message)
+        budget -= tokens
+
+    # Conversations must not resume on an assistant turn
+    while kept and kept[0].get("role") == "assistant":
+        kept.pop(0)
+
+    dropped = history[: len(history) - len(kept)]
+
+    if dropped and strategy == "summarize" and summarize:
+        try:
+            summary = summarize(dropped)
+            system_messages = system_messages + [
+                {
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation:\n{summary}",
+                }
+            ]
+        except Exception as e:
+            print(f"Failed to summarize dropped turns: {e}")
+
+    if strategy == "truncate" and latest:
+        latest_budget = (
+            max_tokens
+            - count_messages_tokens(system_messages)
+            - count_messages_tokens(kept)
+            - MESSAGE_OVERHEAD_TOKENS
+        )
+        if count_messages_tokens(latest) > latest_budget:
+            latest = [truncate_message(latest[0], max(latest_budget, 0))]
+
+    return system_messages + kept + latest
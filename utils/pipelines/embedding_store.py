@@ -0,0 +1,320 @@
+import json
+import os
+import threading
+
+from typing import Dict, List, Literal, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+HEADER_FILENAME = "header.json"
+VECTORS_FILENAME = "vectors.bin"
+SCALES_FILENAME = "scales.bin"
+LIVE_FILENAME = "live.bin"
+OFFSETS_FILENAME = "offsets.bin"
+DOCUMENTS_FILENAME = "documents.jsonl"
+
+# Rows scored per block when the matrix must be converted to float32 first
+SEARCH_BLOCK_SIZE = 65536
+
+# The document log is rewritten once replaced and deleted documents make up
+# more than this share of it, if it is at least COMPACT_MIN_BYTES.
+COMPACT_DEAD_RATIO = 0.5
+COMPACT_MIN_BYTES = 1 << 20
+
+
+class EmbeddingStore:
+    """
+    Compact on-disk embedding store for in-process retrieval.
+
+    Embeddings are L2-normalized and kept as one contiguous matrix in an
+    `np.memmap` file, as float32, float16 or int8 (symmetric per-row
+    quantization with a float32 scale). Documents (id, content, metadata) are
+    appended to a JSON lines file, and a separate memmapped array holds each
+    row's offset into it and whether the row is live. The file is compacted
+    on open and on `flush()` once it is mostly replaced or deleted documents.
+
+    Opening a store maps its files instead of reading them, so worker
+    processes share the same pages and startup builds no per-document
+    objects: a search parses only the documents it returns. Search is one
+    matrix-vector product followed by `argpartition`.
+
+    One process should write to a store at a time; others can open it with
+    `read_only=True`.
+
+    :param path: Directory holding the store's files.
+    :param dim: Embedding size. Required when creating a store.
+    :param dtype: Storage type of the matrix.
+    :param fingerprint: Identifies the embedding model. Opening an existing
+        store with another fingerprint (or dim) empties it.
+    :param read_only: Map the files read-only.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dim: Optional[int] = None,
+        dtype: Literal["float32", "float16", "int8"] = "float32",
+        fingerprint: str = "",
+        read_only: bool = False,
+    ):
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.ids: Optional[Dict[str, int]] = None
+        os.makedirs(path, exist_ok=True)
+
+        header = self.read_header()
+        if header and header["fingerprint"] == fingerprint and dim in (None, header["dim"]):
+            self.dim = header["dim"]
+            self.dtype = header["dtype"]
+            self.count = header["count"]
+            capacity = header["capacity"]
+        elif read_only:
+            raise ValueError(f"No matching embedding store in {path}")
+        elif dim is None:
+            raise ValueError(f"No embedding store in {path}; dim is required to create one")
+        else:
+            self.dim = dim
+            self.dtype = dtype
+            self.count = 0
+            capacity = 1024
+            for filename in [
+                VECTORS_FILENAME,
+                SCALES_FILENAME,
+                LIVE_FILENAME,
+                OFFSETS_FILENAME,
+                DOCUMENTS_FILENAME,
+            ]:
+                if os.path.exists(os.path.join(path, filename)):
+                    os.remove(os.path.join(path, filename))
+
+        self.fingerprint = fingerprint
+        self.capacity = 0
+        self.vectors = self.scales = self.live = self.offsets = None
+        self.map(capacity)
+        self.compact_documents()
+
+    def read_header(self) -> Optional[dict]:
+        header_path = os.path.join(self.path, HEADER_FILENAME)
+        if not os.path.exists(header_path):
+            return None
+        with open(header_path, "r") as f:
+            return json.load(f)
+
+    def map(self, capacity: int):
+        """
+        (Re)maps the array files with room for `capacity` rows, growing them if needed.
+        """
+        self.flush_arrays()
+        self.vectors = self.open_memmap(VECTORS_FILENAME, self.dtype, (capacity, self.dim))
+        if self.dtype == "int8":
+            self.scales = self.open_memmap(SCALES_FILENAME, "float32", (capacity,))
+        self.live = self.open_memmap(LIVE_FILENAME, "bool", (capacity,))
+        self.offsets = self.open_memmap(OFFSETS_FILENAME, "int64", (capacity, 2))
+        self.capacity = capacity
+
+    def open_memmap(self, filename: str, dtype: str, shape: Tuple[int, ...]) -> np.memmap:
+        file_path = os.path.join(self.path, filename)
+        if self.read_only:
+            return np.memmap(file_path, dtype=dtype, mode="r", shape=shape)
+
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        # Grow the file in place; existing rows keep their offsets and new ones read as zero.
+        with open(file_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(file_path, dtype=dtype, mode="r+", shape=shape)
+
+    def flush_arrays(self):
+        for array in [self.vectors, self.scales, self.live, self.offsets]:
+            if array is not None and not self.read_only:
+                array.flush()
+
+    def read_documents(self, rows: List[int]) -> List[dict]:
+        documents = []
+        if not rows:
+            return documents
+        with open(os.path.join(self.path, DOCUMENTS_FILENAME), "rb") as f:
+            for row in rows:
+                offset, length = self.offsets[row]
+                f.seek(offset)
+                documents.append(json.loads(f.read(length)))
+        return documents
+
+    def compact_documents(self):
+        """
+        Rewrites the document log with only the live documents, if dead ones
+        make up more than COMPACT_DEAD_RATIO of it. Rows keep their numbers.
+        """
+        # Called with the lock held, or before the store is shared.
+        documents_path = os.path.join(self.path, DOCUMENTS_FILENAME)
+        if self.read_only or not os.path.exists(documents_path):
+            return
+        size = os.path.getsize(documents_path)
+        rows = np.flatnonzero(self.live[: self.count])
+        live_bytes = int((self.offsets[rows, 1] + 1).sum())
+        if size < COMPACT_MIN_BYTES or size - live_bytes <= size * COMPACT_DEAD_RATIO:
+            return
+
+        offsets = np.empty((len(rows), 2), dtype=np.int64)
+        with open(documents_path, "rb") as source, open(f"{documents_path}.tmp", "wb") as target:
+            for i, row in enumerate(rows.tolist()):
+                offset, length = self.offsets[row]
+                source.seek(offset)
+                offsets[i] = (target.tell(), length)
+                target.write(source.read(length) + b"\n")
+        os.replace(f"{documents_path}.tmp", documents_path)
+        self.offsets[rows] = offsets
+        self.offsets.flush()
+
+    def get_ids(self) -> Dict[str, int]:
+        """
+        Maps document ids to rows. Built on first use, as only writers need it.
+        """
+        if self.ids is None:
+            rows = np.flatnonzero(self.live[: self.count]).tolist()
+            self.ids = {
+                document["id"]: row
+                for row, document in zip(rows, self.read_documents(rows))
+            }
+        return self.ids
+
+    def get(self, ids: List[str]) -> Dict[str, dict]:
+        """
+        Returns the stored documents with the given ids, by id.
+        """
+        with self.lock:
+            existing = self.get_ids()
+            rows = [existing[id] for id in ids if id in existing]
+            return {document["id"]: document for document in self.read_documents(rows)}
+
+    def documents(self) -> List[dict]:
+        """
+        Returns every live document, e.g. to build a keyword index over the store.
+        """
+        with self.lock:
+            return self.read_documents(np.flatnonzero(self.live[: self.count]).tolist())
+
+    def add(
+        self,
+        ids: List[str],
+        embeddings: Sequence[Sequence[float]],
+        contents: List[str],
+        metadata: Optional[List[dict]] = None,
+    ):
+        """
+        Adds documents, replacing any that already exist under the same id.
+        If `ids` repeats an id, its last occurrence wins.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        metadata = metadata or [{} for _ in ids]
+
+        last = {id: i for i, id in enumerate(ids)}
+        if len(last) < len(ids):
+            keep = sorted(last.values())
+            ids = [ids[i] for i in keep]
+            contents = [contents[i] for i in keep]
+            metadata = [metadata[i] for i in keep]
+            vectors = vectors[keep]
+
+        with self.lock:
+            existing = self.get_ids()
+            self.delete_rows([existing[id] for id in ids if id in existing])
+
+            # Reuse deleted rows before appending new ones.
+            rows = np.flatnonzero(~self.live[: self.count])[: len(ids)].tolist()
+            rows += list(range(self.count, self.count + len(ids) - len(rows)))
+            self.count = max(self.count, max(rows, default=-1) + 1)
+            if self.count > self.capacity:
+                self.map(max(self.count, self.capacity * 2))
+
+            if self.dtype == "int8":
+                scales = np.abs(vectors).max(axis=1) / 127
+                scales[scales == 0] = 1
+                self.vectors[rows] = np.round(vectors / scales[:, None]).astype(np.int8)
+                self.scales[rows] = scales
+            else:
+                self.vectors[rows] = vectors.astype(self.dtype)
+
+            with open(os.path.join(self.path, DOCUMENTS_FILENAME), "ab") as f:
+                for row, id, content, meta in zip(rows, ids, contents, metadata):
+                    line = json.dumps({"id": id, "content": content, "meta": meta}).encode()
+                    self.offsets[row] = (f.tell(), len(line))
+                    f.write(line + b"\n")
+                    self.ids[id] = row
+            self.live[rows] = True
+
+    def delete(self, ids: List[str]):
+        with self.lock:
+            existing = self.get_ids()
+            self.delete_rows([existing[id] for id in ids if id in existing])
+
+    def delete_rows(self, rows: List[int]):
+        ids = self.get_ids()
+        for document in self.read_documents(rows):
+            ids.pop(document["id"], None)
+        self.live[rows] = False
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        matrix = self.vectors[: self.count]
+        if self.dtype == "float32":
+            scores = matrix @ query
+        else:
+            # float16/int8 matmuls are slow in NumPy; convert a block at a time.
+            scores = np.empty(self.count, dtype=np.float32)
+            for start in range(0, self.count, SEARCH_BLOCK_SIZE):
+                block = matrix[start : start + SEARCH_BLOCK_SIZE].astype(np.float32)
+                scores[start : start + len(block)] = block @ query
+            if self.dtype == "int8":
+                scores *= self.scales[: self.count]
+        scores[~self.live[: self.count]] = -np.inf
+        return scores
+
+    def search(
+        self, embedding: Sequence[float], top_k: int = 10
+    ) -> List[Tuple[float, dict]]:
+        """
+        Returns up to `top_k` `(cosine similarity, document)` pairs, best first.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        with self.lock:
+            live_count = int(np.count_nonzero(self.live[: self.count]))
+            k = min(top_k, live_count)
+            if k <= 0:
+                return []
+
+            scores = self.scores(query)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])].tolist()
+            return list(zip(scores[top].tolist(), self.read_documents(top)))
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.live[: self.count]))
+
+    def flush(self):
+        """
+        Writes the arrays and the header to disk.
+        """
+        with self.lock:
+            self.compact_documents()
+            self.flush_arrays()
+            header_path = os.path.join(self.path, HEADER_FILENAME)
+            with open(f"{header_path}.tmp", "w") as f:
+                json.dump(
+                    {
+                        "dim": self.dim,
+                        "dtype": self.dtype,
+                        "count": self.count,
+                        "capacity": self.capacity,
+                        "fingerprint": self.fingerprint,
+                    },
+                    f,
+                )
+            os.replace(f"{header_path}.tmp", header_path)
@@ -0,0 +1,213 @@
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import EMBEDDING_CACHE_DISK_SIZE, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE
+from utils.pipelines.cache import LRUCache, hash_text
+from utils.pipelines.models import model_registry
+
+
+EmbedFn = Callable[[List[str]], Sequence[Sequence[float]]]
+
+
+def load_sentence_transformer(model_name: str) -> EmbedFn:
+    """
+    Returns an embedding function backed by a local sentence-transformers
+    model from the shared model registry. The model is loaded on the first
+    call, not here; call `release()` on the function when done with it.
+    """
+
+    def load():
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(model_name)
+
+    model = model_registry.acquire(f"sentence-transformers:{model_name}", load)
+
+    def embed(texts: List[str]):
+        return model.run(lambda model: model.encode(texts, normalize_embeddings=True))
+
+    embed.release = model.release
+    return embed
+
+
+class EmbeddingService:
+    """
+    Cached, batching front end for one embedding model.
+
+    Embeddings are stored as float32 arrays in a cache keyed by (model, text
+    hash), shared by every service in the process and backed by an SQLite
+    file so they survive restarts. Texts missed by concurrent callers are
+    gathered for up to `max_wait_ms` and sent to the backend together in
+    batches of at most `max_batch_size`; identical in-flight texts are
+    embedded once.
+
+    :param model: Name of the model, used in cache keys.
+    :param embed: Backend that embeds a list of texts.
+    :param cache: Cache shared between services.
+    :param max_batch_size: Maximum texts per backend call.
+    :param max_wait_ms: How long the first caller waits for others to join its batch.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        embed: EmbedFn,
+        cache: LRUCache,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        self.model = model
+        self.backend = embed
+        self.cache = cache
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+
+        self.lock = threading.Lock()
+        self.pending: List[tuple] = []
+        self.inflight: Dict[str, Future] = {}
+        self.flushing = False
+        self.stats = {
+            "requests": 0,
+            "texts": 0,
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "backend_calls": 0,
+            "backend_texts": 0,
+            "backend_seconds": 0.0,
+        }
+
+    def embed(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Embeds `texts`, returning one float32 array per text in order.
+        """
+        keys = [hash_text(self.model, text) for text in texts]
+        embeddings: List[Optional[np.ndarray]] = [self.cache.get(key) for key in keys]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["hits"] += len(texts) - len(misses)
+            self.stats["misses"] += len(misses)
+
+            futures = {}
+            for i in misses:
+                future = self.inflight.get(keys[i])
+                if future is None:
+                    future = Future()
+                    self.inflight[keys[i]] = future
+                    self.pending.append((keys[i], texts[i], future))
+                else:
+                    self.stats["coalesced"] += 1
+                futures[i] = future
+
+            leader = bool(self.pending) and not self.flushing
+            if leader:
+                self.flushing = True
+
+        if leader:
+            # Let concurrent callers add their texts to this batch.
+            if self.max_wait_ms:
+                time.sleep(self.max_wait_ms / 1000)
+            self.flush()
+
+        for i, future in futures.items():
+            embeddings[i] = future.result()
+        return embeddings
+
+    def embed_one(self, text: str) -> np.ndarray:
+        return self.embed([text])[0]
+
+    def flush(self):
+        while True:
+            with self.lock:
+                batch = self.pending[: self.max_batch_size]
+                self.pending = self.pending[self.max_batch_size :]
+                if not batch:
+                    self.flushing = False
+                    return
+
+            start = time.perf_counter()
+            try:
+                vectors = self.backend([text for _, text, _ in batch])
+                results = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+                error = None
+            except Exception as e:
+                error = e
+            elapsed = time.perf_counter() - start
+
+            # One disk transaction per batch, before the texts stop being in flight.
+            if error is None:
+                self.cache.set_many(
+                    (key, result) for (key, _, _), result in zip(batch, results)
+                )
+
+            with self.lock:
+                self.stats["backend_calls"] += 1
+                self.stats["backend_texts"] += len(batch)
+                self.stats["backend_seconds"] += elapsed
+                for i, (key, _, future) in enumerate(batch):
+                    self.inflight.pop(key, None)
+                    if error is None:
+                        future.set_result(results[i])
+                    else:
+                        future.set_exception(error)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "hit_rate": stats["hits"] / stats["texts"] if stats["texts"] else 0.0,
+            "avg_batch_size": (
+                stats["backend_texts"] / stats["backend_calls"]
+                if stats["backend_calls"]
+                else 0.0
+            ),
+        }
+
+
+embedding_cache: Optional[LRUCache] = None
+embedding_services: Dict[str, EmbeddingService] = {}
+embedding_services_lock = threading.Lock()
+
+
+def get_embedding_service(model: str, embed: EmbedFn, **kwargs) -> EmbeddingService:
+    """
+    Returns the process-wide service for `model`, backed by `embed`.
+    Pipelines that name the same model share one service, its batches and
+    its cache entries.
+    """
+    global embedding_cache
+
+    with embedding_services_lock:
+        if embedding_cache is None:
+            embedding_cache = LRUCache(
+                max_size=EMBEDDING_CACHE_SIZE,
+                path=EMBEDDING_CACHE_PATH or None,
+                max_disk_size=EMBEDDING_CACHE_DISK_SIZE,
+            )
+
+        service = embedding_services.get(model)
+        if service is None:
+            service = EmbeddingService(model, embed, embedding_cache, **kwargs)
+            embedding_services[model] = service
+        else:
+            # The latest caller's backend wins, e.g. after a pipeline is reloaded.
+            service.backend = embed
+        return service
+
+
+def get_embedding_stats() -> dict:
+    with embedding_services_lock:
+        services = dict(embedding_services)
+    return {
+        "cache": embedding_cache.stats if embedding_cache else None,
+        "models": {model: service.get_stats() for model, service in services.items()},
+    }
@@ -0,0 +1,131 @@
+from typing import List, Optional
+
+from haystack import Document, component
+
+from utils.pipelines.embedding_store import EmbeddingStore
+from utils.pipelines.embeddings import EmbeddingService
+from utils.pipelines.retrieval import BM25Index, RerankFn, hybrid_search
+
+
+@component
+class CachedTextEmbedder:
+    """
+    Haystack text embedder backed by an `EmbeddingService`, a drop-in for
+    SentenceTransformersTextEmbedder whose embeddings are cached and batched
+    with every other user of the same model.
+    """
+
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        return {"embedding": self.service.embed_one(text).tolist()}
+
+
+def embed_documents(service: EmbeddingService, documents: List[Document]) -> List[Document]:
+    """
+    Sets the embedding of each document's content through `service`.
+    """
+    embeddings = service.embed([document.content or "" for document in documents])
+    for document, embedding in zip(documents, embeddings):
+        document.embedding = embedding.tolist()
+    return documents
+
+
+@component
+class EmbeddingStoreRetriever:
+    """
+    Haystack retriever backed by an `EmbeddingStore`, a drop-in for
+    InMemoryEmbeddingRetriever that scores all documents with one matmul.
+
+    With a `bm25` index over the same documents and the query text as input,
+    retrieval is hybrid: `candidates` dense and keyword results are fused
+    with reciprocal rank fusion and optionally reranked, see `hybrid_search`.
+    """
+
+    def __init__(
+        self,
+        store: EmbeddingStore,
+        top_k: int = 10,
+        bm25: Optional[BM25Index] = None,
+        candidates: int = 20,
+        rrf_k: int = 60,
+        rerank: Optional[RerankFn] = None,
+        rerank_top_n: int = 20,
+    ):
+        self.store = store
+        self.top_k = top_k
+        self.bm25 = bm25
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.rerank = rerank
+        self.rerank_top_n = rerank_top_n
+
+    @component.output_types(documents=List[Document])
+    def run(
+        self,
+        query_embedding: List[float],
+        query: Optional[str] = None,
+        top_k: Optional[int] = None,
+    ):
+        top_k = top_k or self.top_k
+        if self.bm25 is None or not query:
+            results = self.store.search(query_embedding, top_k)
+        else:
+            results = self.hybrid_search(query_embedding, query, top_k)
+
+        return {
+            "documents": [
+                Document(
+                    id=document["id"],
+                    content=document["content"],
+                    meta=document["meta"],
+                    score=score,
+                )
+                for score, document in results
+            ]
+        }
+
+    def hybrid_search(self, query_embedding: List[float], query: str, top_k: int):
+        candidates = max(top_k, self.candidates)
+        dense = self.store.search(query_embedding, candidates)
+        keyword = self.bm25.search(query, candidates)
+
+        documents = {document["id"]: document for _, document in dense}
+        documents.update(self.store.get([id for id, _ in keyword if id not in documents]))
+
+        results = hybrid_search(
+            query,
+            [[document["id"] for _, document in dense], [id for id, _ in keyword]],
+            top_k,
+            rrf_k=self.rrf_k,
+            rerank=self.rerank,
+            rerank_top_n=self.rerank_top_n,
+            get_texts=lambda ids: [documents[id]["content"] for id in ids],
+        )
+        return [(score, documents[id]) for id, score in results if id in documents]
+
+
+def build_bm25(store: EmbeddingStore) -> BM25Index:
+    """
+    Builds a keyword index over the documents of `store`.
+    """
+    documents = store.documents()
+    return BM25Index(
+        [document["id"] for document in documents],
+        [document["content"] for document in documents],
+    )
+
+
+def write_documents(store: EmbeddingStore, documents: List[Document]):
+    """
+    Adds embedded Haystack documents to `store` and flushes it to disk.
+    """
+    store.add(
+        [document.id for document in documents],
+        [document.embedding for document in documents],
+        [document.content for document in documents],
+        [document.meta for document in documents],
+    )
+    store.flush()
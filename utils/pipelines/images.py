@@ -0,0 +1,214 @@
+import base64
+import binascii
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import requests
+
+from utils.pipelines.cache import LRUCache, hash_text
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Magic numbers of the image formats accepted by the providers
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+
+def detect_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """
+    Detects the MIME type of image bytes from their header instead of trusting
+    the data URI or file extension.
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    return default
+
+
+def parse_data_uri(url: str) -> Tuple[str, str]:
+    """
+    Splits a `data:<mime>;base64,<data>` URI into its declared MIME type and base64 payload.
+    """
+    header, _, data = url.partition(",")
+    mime_type = header[len("data:") :].split(";")[0] or "image/jpeg"
+    return mime_type, data
+
+
+class ImageData:
+    """
+    A decoded image. The base64 form is computed once, on first use.
+    """
+
+    def __init__(self, data: bytes, mime_type: str, base64_data: str = None):
+        self.data = data
+        self.mime_type = mime_type
+        self._base64 = base64_data
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("ascii")
+        return self._base64
+
+    @property
+    def format(self) -> str:
+        return self.mime_type.split("/")[-1]
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def memory_size(self) -> int:
+        """
+        Bytes held once the base64 form exists, whether or not it has been computed yet.
+        """
+        return len(self.data) + (len(self.data) + 2) // 3 * 4
+
+    def to_data_uri(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+
+def downscale_image(image: ImageData, max_dimension: int) -> ImageData:
+    """
+    Shrinks an image so neither side exceeds `max_dimension`, re-encoding it in
+    its own format. Returns the image unchanged if it already fits, if it is
+    animated, or if Pillow is not installed.
+    """
+    if not max_dimension or Image is None:
+        return image
+
+    try:
+        with Image.open(BytesIO(image.data)) as img:
+            if max(img.size) <= max_dimension or getattr(img, "is_animated", False):
+                return image
+
+            image_format = img.format or "PNG"
+            img.thumbnail((max_dimension, max_dimension))
+            if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+
+            output = BytesIO()
+            img.save(output, format=image_format, quality=85, optimize=True)
+    except Exception as e:
+        print(f"Could not downscale image: {e}")
+        return image
+
+    return ImageData(output.getvalue(), image.mime_type)
+
+
+class ImageStore:
+    """
+    Content-addressed cache of decoded images shared by pipelines and filters.
+
+    Data URIs and raw base64 strings are decoded (and optionally downscaled)
+    once, then served from memory on every later turn of the conversation.
+    Remote images are fetched concurrently through one pooled HTTP session.
+
+    :param max_size: Maximum number of decoded images kept in memory.
+    :param max_bytes: Maximum memory held by those images, raw and base64 forms included.
+    :param max_workers: Maximum number of concurrent remote fetches.
+    :param timeout: Seconds to wait for a remote image.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_workers: int = 8,
+        timeout: float = 30,
+    ):
+        self.cache = LRUCache(
+            max_size=max_size,
+            max_bytes=max_bytes,
+            sizeof=lambda image: image.memory_size,
+        )
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount(
+            "http://", requests.adapters.HTTPAdapter(pool_maxsize=self.max_workers)
+        )
+        self.session.mount(
+            "https://", requests.adapters.HTTPAdapter(pool_maxsize=self.max_workers)
+        )
+
+    def load_base64(
+        self, data: str, mime_type: str = None, max_dimension: int = None
+    ) -> ImageData:
+        cache_key = hash_text("base64", str(max_dimension or 0), data)
+        image = self.cache.get(cache_key)
+        if image is None:
+            try:
+                raw = base64.b64decode(data)
+            except (binascii.Error, ValueError) as e:
+                raise ValueError(f"Invalid base64 image data: {e}")
+
+            image = ImageData(raw, detect_mime_type(raw, mime_type or "image/jpeg"), data)
+            image = downscale_image(image, max_dimension)
+            self.cache.set(cache_key, image)
+        return image
+
+    def load_url(self, url: str, max_dimension: int = None) -> ImageData:
+        """
+        Loads an image from a data URI or a remote URL.
+        """
+        if url.startswith("data:"):
+            mime_type, data = parse_data_uri(url)
+            return self.load_base64(data, mime_type, max_dimension)
+
+        cache_key = hash_text("url", str(max_dimension or 0), url)
+        image = self.cache.get(cache_key)
+        if image is None:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            image = ImageData(
+                response.content,
+                detect_mime_type(
+                    response.content,
+                    response.headers.get("content-type", "image/jpeg").split(";")[0],
+                ),
+            )
+            image = downscale_image(image, max_dimension)
+            self.cache.set(cache_key, image)
+        return image
+
+    def load_urls(self, urls: List[str], max_dimension: int = None) -> List[ImageData]:
+        """
+        Loads several images, fetching remote ones concurrently. Results keep the order of `urls`.
+        """
+        remote = [url for url in urls if not url.startswith("data:")]
+        if len(remote) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(remote))
+            ) as executor:
+                # Warm the cache; errors surface again from load_url below.
+                list(
+                    executor.map(
+                        lambda url: self._try_load_url(url, max_dimension), remote
+                    )
+                )
+        return [self.load_url(url, max_dimension) for url in urls]
+
+    def _try_load_url(self, url: str, max_dimension: int = None) -> Optional[ImageData]:
+        try:
+            return self.load_url(url, max_dimension)
+        except Exception:
+            return None
+
+
+# Process-wide store, so every pipeline decodes a given image only once
+image_store = ImageStore()
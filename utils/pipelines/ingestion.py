@@ -0,0 +1,352 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from config import PIPELINES_DIR
+
+try:
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
+
+def get_index_dir(module_name: str, name: str = "index") -> str:
+    """
+    Returns the directory a pipeline persists its index in: PIPELINES_DIR/<module>/<name>.
+    """
+    return os.path.join(PIPELINES_DIR, module_name, name)
+
+
+class CorpusManifest:
+    """
+    JSON record of what an index was built from: one entry per source (a
+    file path or a document id) with its mtime, size, content hash and the
+    ids of the documents it produced. `fingerprint` identifies the settings the
+    index depends on, such as the embedding model; a mismatch means rebuild.
+
+    :param path: JSON file the manifest is loaded from and saved to.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fingerprint = ""
+        self.sources: Dict[str, dict] = {}
+        self.dirty = False
+
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                self.fingerprint = data.get("fingerprint", "")
+                self.sources = data.get("sources", {})
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {path}: {e}")
+
+    def reset(self, fingerprint: str = ""):
+        self.fingerprint = fingerprint
+        self.sources = {}
+        self.dirty = True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"fingerprint": self.fingerprint, "sources": self.sources}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def scan_directory(
+    input_dir: str, recursive: bool = False, required_exts: Optional[List[str]] = None
+) -> Dict[str, dict]:
+    """
+    Lists the files under `input_dir` with their mtime and size, skipping
+    hidden files like SimpleDirectoryReader does. Paths are absolute.
+    """
+    files = {}
+    for root, dirs, names in os.walk(input_dir):
+        dirs[:] = [name for name in dirs if not name.startswith(".")] if recursive else []
+        for name in names:
+            if name.startswith("."):
+                continue
+            if required_exts and os.path.splitext(name)[1] not in required_exts:
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            stat = os.stat(path)
+            files[path] = {"mtime": stat.st_mtime, "size": stat.st_size}
+    return files
+
+
+def diff_sources(
+    manifest: CorpusManifest, sources: Dict[str, dict]
+) -> Tuple[Dict[str, dict], List[str]]:
+    """
+    Compares the current sources against the manifest.
+
+    Sources are either files, given by `{"mtime", "size"}`, or in-memory
+    documents, given by `{"hash"}`. Files whose mtime and size match are
+    skipped without being read; others are hashed, and a file that was only
+    touched has its manifest entry refreshed in place.
+
+    :return: The added or changed sources (with their hash), and the removed ones.
+    """
+    changed = {}
+    for source, stat in sources.items():
+        entry = manifest.sources.get(source)
+        if "hash" not in stat:
+            if (
+                entry
+                and entry.get("mtime") == stat["mtime"]
+                and entry.get("size") == stat["size"]
+            ):
+                continue
+            stat = {**stat, "hash": hash_file(source)}
+
+        if entry and entry.get("hash") == stat["hash"]:
+            entry.update(stat)
+            manifest.dirty = True
+            continue
+
+        changed[source] = stat
+
+    removed = [source for source in manifest.sources if source not in sources]
+    return changed, removed
+
+
+class ReadWriteLock:
+    """
+    Lets any number of readers hold the lock at once, or a single writer.
+    Waiting writers go first, so a steady flow of queries cannot starve a
+    sync. Not reentrant: do not take `read()` while already holding it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            try:
+                while self.writer or self.readers:
+                    self.condition.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class Ingestor:
+    """
+    Keeps a vector store in step with a corpus, doing work proportional to
+    what changed rather than to the size of the corpus.
+
+    Each sync diffs the corpus against the manifest. It then loads the
+    changed sources, embeds their documents in batches (several batches at
+    a time), deletes what the changed and removed sources used to contain,
+    and upserts the new documents. Nothing is deleted if loading or
+    embedding fails, so a failed sync leaves the store as it was.
+
+    Deletes and upserts hold `index_lock` for writing, and readers of the
+    store take it for reading, so a query never sees a source half-replaced
+    while queries still run concurrently with each other. The manifest is
+    saved only after `on_synced` (e.g. persisting the store) succeeded, so a
+    crash in between makes the next run ingest the changes again.
+
+    :param manifest: Record of the sources in the store.
+    :param scan: Returns the current sources, see `diff_sources`.
+    :param load: Loads the documents of the given sources as `{source: [document]}`.
+    :param embed: Embeds a list of texts.
+    :param upsert: Stores one source's documents with their embeddings and returns their ids.
+    :param delete: Deletes documents by id.
+    :param get_text: Returns the text to embed for a document.
+    :param batch_size: Texts per embedding call.
+    :param max_concurrency: Embedding calls in flight at once.
+    :param on_synced: Called after a sync that changed the store, e.g. to persist it.
+    """
+
+    def __init__(
+        self,
+        manifest: CorpusManifest,
+        scan: Callable[[], Dict[str, dict]],
+        load: Callable[[List[str]], Dict[str, list]],
+        embed: Callable[[List[str]], Sequence[Sequence[float]]],
+        upsert: Callable[[str, list, list], List[str]],
+        delete: Callable[[List[str]], None],
+        get_text: Callable[[Any], str] = lambda document: document["text"],
+        batch_size: int = 64,
+        max_concurrency: int = 2,
+        on_synced: Optional[Callable[[], None]] = None,
+    ):
+        self.manifest = manifest
+        self.scan = scan
+        self.load = load
+        self.embed = embed
+        self.upsert = upsert
+        self.delete = delete
+        self.get_text = get_text
+        self.batch_size = max(1, batch_size)
+        self.max_concurrency = max(1, max_concurrency)
+        self.on_synced = on_synced
+
+        self.lock = threading.Lock()
+        self.index_lock = ReadWriteLock()
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {
+            "syncs": 0,
+            "sources_changed": 0,
+            "sources_removed": 0,
+            "documents_embedded": 0,
+            "embedding_calls": 0,
+            "last_sync_seconds": 0.0,
+        }
+
+    def embed_texts(self, texts: List[str]) -> list:
+        batches = [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+        self.stats["embedding_calls"] += len(batches)
+        if self.max_concurrency == 1 or len(batches) < 2:
+            results = [self.embed(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(batches))
+            ) as executor:
+                results = list(executor.map(self.embed, batches))
+        return [embedding for result in results for embedding in result]
+
+    def sync(self) -> dict:
+        """
+        Brings the store up to date with the corpus and returns what changed.
+        """
+        with self.lock:
+            start = time.perf_counter()
+            changed, removed = diff_sources(self.manifest, self.scan())
+
+            if not changed and not removed:
+                if self.manifest.dirty:
+                    self.manifest.save()
+                return {"changed": 0, "removed": 0}
+
+            documents_by_source = self.load(list(changed)) if changed else {}
+            documents = [
+                document
+                for source in changed
+                for document in documents_by_source.get(source, [])
+            ]
+            embeddings = self.embed_texts([self.get_text(doc) for doc in documents])
+
+            previous_sources = {source: dict(entry) for source, entry in self.manifest.sources.items()}
+            with self.index_lock.write():
+                for source in [*removed, *changed]:
+                    entry = self.manifest.sources.pop(source, None)
+                    if entry and entry.get("doc_ids"):
+                        self.delete(entry["doc_ids"])
+
+                offset = 0
+                for source, stat in changed.items():
+                    source_documents = documents_by_source.get(source, [])
+                    source_embeddings = embeddings[offset : offset + len(source_documents)]
+                    offset += len(source_documents)
+                    doc_ids = (
+                        self.upsert(source, source_documents, source_embeddings)
+                        if source_documents
+                        else []
+                    )
+                    self.manifest.sources[source] = {**stat, "doc_ids": doc_ids}
+
+            try:
+                if self.on_synced:
+                    self.on_synced()
+            except Exception:
+                # The store changed but was not persisted: forget the changes so the next sync redoes them.
+                self.manifest.sources = previous_sources
+                raise
+            self.manifest.save()
+
+            self.stats["syncs"] += 1
+            self.stats["sources_changed"] += len(changed)
+            self.stats["sources_removed"] += len(removed)
+            self.stats["documents_embedded"] += len(documents)
+            self.stats["last_sync_seconds"] = time.perf_counter() - start
+            print(
+                f"Ingested {len(changed)} changed and {len(removed)} removed sources "
+                f"({len(documents)} documents) in {self.stats['last_sync_seconds']:.2f}s"
+            )
+            return {"changed": len(changed), "removed": len(removed)}
+
+    async def sync_async(self) -> Optional[dict]:
+        try:
+            return await asyncio.to_thread(self.sync)
+        except Exception as e:
+            print(f"Ingestion failed: {e}")
+            return None
+
+    def start(self, interval: float = 0, watch_path: Optional[str] = None):
+        """
+        Keeps syncing in the background: on every change under `watch_path`
+        (if the optional `watchfiles` package is installed), or otherwise
+        every `interval` seconds. Does nothing if neither is set.
+        """
+        if self.task or not (interval or watch_path):
+            return
+        if watch_path and awatch is None:
+            print("watchfiles is not installed, polling for changes instead")
+            interval = interval or 10
+            watch_path = None
+        self.task = asyncio.create_task(self.run(interval, watch_path))
+
+    async def run(self, interval: float, watch_path: Optional[str]):
+        if watch_path:
+            async for _ in awatch(watch_path):
+                await self.sync_async()
+        else:
+            while True:
+                await asyncio.sleep(interval)
+                await self.sync_async()
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
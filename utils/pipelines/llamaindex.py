@@ -0,0 +1,498 @@
+import asyncio
+import contextlib
+import os
+
+from typing import Callable, Dict, List, Optional
+
+from llama_index.core import (
+    Settings,
+    SimpleDirectoryReader,
+    SQLDatabase,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from sqlalchemy.exc import DBAPIError
+
+from utils.pipelines.cache import LRUCache, hash_text
+from utils.pipelines.embeddings import EmbeddingService, get_embedding_service
+from utils.pipelines.ingestion import (
+    CorpusManifest,
+    Ingestor,
+    ReadWriteLock,
+    get_index_dir,
+    scan_directory,
+)
+from utils.pipelines.retrieval import BM25Index, RerankFn, hybrid_search
+from utils.pipelines.sql import (
+    SQLGuardError,
+    format_sample,
+    guard_sql,
+    normalize_sql,
+    run_guarded_sql,
+)
+from utils.pipelines.streaming import PrefetchStream
+
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps a LlamaIndex embedding model so that its embeddings go through the
+    shared EmbeddingService: cached across pipelines and restarts, and
+    batched across concurrent callers. Query and text embeddings are cached
+    separately since some models embed them differently.
+    """
+
+    _texts: EmbeddingService = PrivateAttr()
+    _queries: EmbeddingService = PrivateAttr()
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, **kwargs):
+        model = f"{type(embed_model).__name__}:{embed_model.model_name}"
+        super().__init__(
+            model_name=model, embed_batch_size=embed_model.embed_batch_size, **kwargs
+        )
+        self._embed_model = embed_model
+        self._texts = get_embedding_service(
+            f"{model}:text", embed_model.get_text_embedding_batch
+        )
+        self._queries = get_embedding_service(
+            f"{model}:query",
+            lambda queries: [embed_model.get_query_embedding(query) for query in queries],
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._queries.embed_one(query).tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._texts.embed_one(text).tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [embedding.tolist() for embedding in self._texts.embed(texts)]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self._get_text_embedding, text)
+
+
+def cached_embedding(embed_model: Optional[BaseEmbedding] = None) -> CachedEmbedding:
+    """
+    Wraps `embed_model` (default `Settings.embed_model`) in a CachedEmbedding,
+    unless it already is one. Pass the result to the index explicitly rather
+    than assigning it to the process-wide Settings, which other pipelines and
+    reloads of this one would wrap again.
+    """
+    embed_model = embed_model or Settings.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model
+    return CachedEmbedding(embed_model)
+
+
+def get_embed_fingerprint(embed_model: Optional[BaseEmbedding] = None) -> str:
+    """
+    Identifies the embedding model, so that switching models rebuilds the
+    index. Caching wrappers are looked through, since they embed the same.
+    """
+    embed_model = embed_model or Settings.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        embed_model = embed_model._embed_model
+    return f"{type(embed_model).__name__}:{getattr(embed_model, 'model_name', '')}"
+
+
+def load_persisted_index(
+    persist_dir: str,
+    manifest: CorpusManifest,
+    fingerprint: str,
+    embed_model: Optional[BaseEmbedding] = None,
+):
+    """
+    Loads the index stored in `persist_dir`, or returns a new empty index
+    (and resets the manifest) if there is none or it was built with other settings.
+    """
+    if manifest.fingerprint == fingerprint and os.path.exists(
+        os.path.join(persist_dir, "docstore.json")
+    ):
+        try:
+            return load_index_from_storage(
+                StorageContext.from_defaults(persist_dir=persist_dir),
+                embed_model=embed_model,
+            )
+        except Exception as e:
+            print(f"Could not load index from {persist_dir}, rebuilding: {e}")
+
+    manifest.reset(fingerprint)
+    return VectorStoreIndex(nodes=[], embed_model=embed_model)
+
+
+class LlamaIndexIngestor(Ingestor):
+    """
+    Ingestor for a persisted VectorStoreIndex. Documents are split into nodes
+    with the configured node parser and embedded in batches with
+    `embed_model` (default `Settings.embed_model`), which the index also
+    uses for queries; the index is persisted after every change.
+
+    :param persist_dir: Directory holding the index and its manifest.
+    :param scan: Returns the current sources, see `diff_sources`.
+    :param load_documents: Loads the LlamaIndex documents of the given sources.
+    :param get_source: Returns the source a document belongs to.
+    :param fingerprint: Settings the index depends on. Defaults to the embedding model.
+    :param embed_model: Embedding model of the index.
+    """
+
+    def __init__(
+        self,
+        persist_dir: str,
+        scan: Callable[[], Dict[str, dict]],
+        load_documents: Callable[[List[str]], list],
+        get_source: Callable[[object], str],
+        fingerprint: Optional[str] = None,
+        batch_size: int = 64,
+        max_concurrency: int = 2,
+        on_synced: Optional[Callable[[], None]] = None,
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        embed_model = embed_model or Settings.embed_model
+        self.persist_dir = persist_dir
+        self.load_documents = load_documents
+        self.get_source = get_source
+        self.after_sync = on_synced
+
+        manifest = CorpusManifest(os.path.join(persist_dir, MANIFEST_FILENAME))
+        fingerprint = fingerprint if fingerprint is not None else get_embed_fingerprint(embed_model)
+        self.index = load_persisted_index(persist_dir, manifest, fingerprint, embed_model)
+
+        super().__init__(
+            manifest,
+            scan=scan,
+            load=self.load_nodes,
+            embed=embed_model.get_text_embedding_batch,
+            upsert=self.upsert_nodes,
+            delete=self.delete_documents,
+            get_text=lambda node: node.get_content(metadata_mode=MetadataMode.EMBED),
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            on_synced=self.persist,
+        )
+
+    def load_nodes(self, sources: List[str]) -> Dict[str, list]:
+        documents = self.load_documents(sources)
+        document_sources = {doc.doc_id: self.get_source(doc) for doc in documents}
+
+        nodes_by_source = {}
+        for node in Settings.node_parser.get_nodes_from_documents(documents):
+            source = document_sources.get(node.ref_doc_id)
+            nodes_by_source.setdefault(source, []).append(node)
+        return nodes_by_source
+
+    def upsert_nodes(self, source: str, nodes: list, embeddings: list) -> List[str]:
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        # Nodes that already have an embedding are not embedded again by the index.
+        self.index.insert_nodes(nodes)
+        return list(dict.fromkeys(node.ref_doc_id for node in nodes))
+
+    def delete_documents(self, doc_ids: List[str]):
+        for doc_id in doc_ids:
+            self.index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+    def persist(self):
+        self.index.storage_context.persist(persist_dir=self.persist_dir)
+        if self.after_sync:
+            self.after_sync()
+
+
+def load_directory_index(
+    input_dir: str,
+    persist_dir: str,
+    fingerprint: Optional[str] = None,
+    recursive: bool = False,
+    batch_size: int = 64,
+    max_concurrency: int = 2,
+    on_synced: Optional[Callable[[], None]] = None,
+    embed_model: Optional[BaseEmbedding] = None,
+) -> LlamaIndexIngestor:
+    """
+    Returns a synced ingestor whose `index` covers the files in `input_dir`
+    and is persisted in `persist_dir`.
+
+    If no file was added, removed or modified since the last run, the index
+    is loaded from disk without reading or embedding anything. Otherwise only
+    the added and modified files are read and embedded. Call `sync()` or
+    `start()` on the ingestor to pick up later changes.
+    """
+    def load_documents(paths: List[str]) -> list:
+        return SimpleDirectoryReader(input_files=paths, filename_as_id=True).load_data()
+
+    ingestor = LlamaIndexIngestor(
+        persist_dir,
+        scan=lambda: scan_directory(input_dir, recursive),
+        load_documents=load_documents,
+        get_source=lambda doc: os.path.abspath(doc.metadata.get("file_path", "")),
+        fingerprint=fingerprint,
+        batch_size=batch_size,
+        max_concurrency=max_concurrency,
+        on_synced=on_synced,
+        embed_model=embed_model,
+    )
+    ingestor.sync()
+    return ingestor
+
+
+def load_documents_index(
+    documents: list,
+    persist_dir: str,
+    fingerprint: Optional[str] = None,
+    batch_size: int = 64,
+    max_concurrency: int = 2,
+    embed_model: Optional[BaseEmbedding] = None,
+) -> LlamaIndexIngestor:
+    """
+    Returns a synced ingestor whose `index` covers already loaded documents
+    (e.g. from a GitHub reader), persisted in `persist_dir`. Documents are
+    matched to the manifest by id and only those whose content hash changed
+    are re-embedded.
+    """
+    documents_by_id = {document.doc_id: document for document in documents}
+
+    ingestor = LlamaIndexIngestor(
+        persist_dir,
+        scan=lambda: {
+            doc_id: {"hash": document.hash}
+            for doc_id, document in documents_by_id.items()
+        },
+        load_documents=lambda doc_ids: [documents_by_id[doc_id] for doc_id in doc_ids],
+        get_source=lambda doc: doc.doc_id,
+        fingerprint=fingerprint,
+        batch_size=batch_size,
+        max_concurrency=max_concurrency,
+        embed_model=embed_model,
+    )
+    ingestor.sync()
+    return ingestor
+
+
+def stream_query(query_engine, query: str, max_buffer: int = 64) -> PrefetchStream:
+    """
+    Streams the answer of a streaming query engine to `query`. Retrieval,
+    synthesis and token generation all run on a producer thread, up to
+    `max_buffer` tokens ahead of the reader.
+    """
+    return PrefetchStream(lambda: query_engine.query(query).response_gen, max_buffer)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever that fuses the dense results of a VectorStoreIndex with a
+    BM25Index over the same nodes, see `hybrid_search`. Call `refresh()`
+    after the index changes to rebuild the keyword index.
+    """
+
+    def __init__(
+        self,
+        index: VectorStoreIndex,
+        similarity_top_k: int = 2,
+        candidates: int = 20,
+        rrf_k: int = 60,
+        rerank: Optional[RerankFn] = None,
+        rerank_top_n: int = 20,
+    ):
+        self.index = index
+        self.similarity_top_k = similarity_top_k
+        self.candidates = max(candidates, similarity_top_k)
+        self.rrf_k = rrf_k
+        self.rerank = rerank
+        self.rerank_top_n = rerank_top_n
+        self.vector_retriever = index.as_retriever(similarity_top_k=self.candidates)
+        self.bm25: Optional[BM25Index] = None
+        self.refresh()
+        super().__init__()
+
+    def refresh(self):
+        nodes = list(self.index.docstore.docs.values())
+        self.bm25 = BM25Index(
+            [node.node_id for node in nodes],
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes],
+        )
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        dense = self.vector_retriever.retrieve(query_bundle)
+        keyword = self.bm25.search(query_bundle.query_str, self.candidates)
+
+        nodes = {result.node.node_id: result.node for result in dense}
+        for node_id, _ in keyword:
+            if node_id not in nodes:
+                nodes[node_id] = self.index.docstore.get_node(node_id, raise_error=False)
+
+        results = hybrid_search(
+            query_bundle.query_str,
+            [[result.node.node_id for result in dense], [node_id for node_id, _ in keyword]],
+            self.similarity_top_k,
+            rrf_k=self.rrf_k,
+            rerank=self.rerank,
+            rerank_top_n=self.rerank_top_n,
+            get_texts=lambda node_ids: [nodes[node_id].get_content() for node_id in node_ids],
+        )
+        return [
+            NodeWithScore(node=nodes[node_id], score=score)
+            for node_id, score in results
+            if nodes.get(node_id) is not None
+        ]
+
+
+class LockedRetriever(BaseRetriever):
+    """
+    Runs another retriever under the read side of a ReadWriteLock, such as
+    an ingestor's `index_lock`, so that it never reads the index while a
+    background sync modifies it. Queries still run concurrently, and the
+    query is embedded with `embed_model` before the lock is taken.
+    """
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        lock: ReadWriteLock,
+        embed_model: Optional[BaseEmbedding] = None,
+    ):
+        self.retriever = retriever
+        self.lock = lock
+        self.embed_model = embed_model
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self.embed_model is not None and query_bundle.embedding is None:
+            query_bundle.embedding = self.embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        with self.lock.read():
+            return self.retriever.retrieve(query_bundle)
+
+
+def get_query_engine(
+    index: VectorStoreIndex,
+    similarity_top_k: int = 2,
+    hybrid: bool = False,
+    candidates: int = 20,
+    rrf_k: int = 60,
+    rerank: Optional[RerankFn] = None,
+    rerank_top_n: int = 20,
+    lock: Optional[ReadWriteLock] = None,
+    **kwargs,
+):
+    """
+    Returns a streaming query engine over `index`. With `hybrid`, retrieval
+    fuses dense and BM25 keyword results and reranks them with `rerank` (see
+    `load_cross_encoder`) if one is given; the caller keeps ownership of it.
+    Retrieval holds the read side of `lock` if one is given, e.g. the
+    ingestor's `index_lock`. Other arguments go to the engine.
+    """
+    if not hybrid:
+        if lock is None:
+            return index.as_query_engine(
+                streaming=True, similarity_top_k=similarity_top_k, **kwargs
+            )
+        retriever = index.as_retriever(similarity_top_k=similarity_top_k)
+        return RetrieverQueryEngine.from_args(
+            LockedRetriever(retriever, lock, index._embed_model), streaming=True, **kwargs
+        )
+
+    # Building the keyword index reads every node, so it must not race a sync either.
+    with lock.read() if lock is not None else contextlib.nullcontext():
+        retriever = HybridRetriever(
+            index,
+            similarity_top_k=similarity_top_k,
+            candidates=candidates,
+            rrf_k=rrf_k,
+            rerank=rerank,
+            rerank_top_n=rerank_top_n,
+        )
+    if lock is not None:
+        retriever = LockedRetriever(retriever, lock, index._embed_model)
+    return RetrieverQueryEngine.from_args(retriever, streaming=True, **kwargs)
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """
+    SQLDatabase for text-to-SQL engines that reflects the schema once, then
+    serves table descriptions from memory and caches query results by
+    normalized SQL for `cache_ttl` seconds (0 keeps them until evicted).
+    A `cache_size` of 0 disables the result cache. Build a new instance to
+    drop everything, e.g. when the valves change.
+
+    Generated SQL goes through `guard_sql` and `run_guarded_sql`: only one
+    read-only query runs, with at most `max_rows` rows and a `timeout`, and
+    the LLM is shown a sample of `sample_rows` rows and `sample_columns`
+    columns. Rejected or failed queries are reported back to the engine as
+    errors, which it hands to the LLM like any other SQL error.
+    """
+
+    def __init__(
+        self,
+        *args,
+        cache_size: int = 256,
+        cache_ttl: float = 300,
+        max_rows: int = 100,
+        timeout: float = 30.0,
+        sample_rows: int = 20,
+        sample_columns: int = 10,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.table_info: Dict[str, str] = {}
+        self.result_cache = (
+            LRUCache(max_size=cache_size, ttl=cache_ttl or None) if cache_size else None
+        )
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.sample_rows = sample_rows
+        self.sample_columns = sample_columns
+
+    def get_single_table_info(self, table_name: str) -> str:
+        if table_name not in self.table_info:
+            self.table_info[table_name] = super().get_single_table_info(table_name)
+        return self.table_info[table_name]
+
+    def run_sql(self, command: str):
+        try:
+            sql = guard_sql(command, self.engine.dialect.name, self.max_rows)
+        except SQLGuardError as e:
+            # Raised as NotImplementedError, which the SQL retrievers report instead of failing on.
+            raise NotImplementedError(f"Statement {command!r} was rejected: {e}") from e
+
+        if self.result_cache is None:
+            return self.execute(sql)
+
+        cache_key = hash_text(normalize_sql(sql))
+        result = self.result_cache.get(cache_key)
+        if result is None:
+            result = self.execute(sql)
+            self.result_cache.set(cache_key, result)
+        return result
+
+    def execute(self, sql: str):
+        try:
+            result = run_guarded_sql(self.engine, sql, self.max_rows, self.timeout)
+        except (SQLGuardError, DBAPIError) as e:
+            raise NotImplementedError(f"Statement {sql!r} failed: {e}") from e
+
+        sample = format_sample(
+            result["columns"],
+            result["rows"],
+            result["truncated"],
+            max_rows=self.sample_rows,
+            max_columns=self.sample_columns,
+        )
+        return sample, {"result": result["rows"], "col_keys": result["columns"]}
@@ -1,8 +1,11 @@
+import copy
 import uuid
 import time
+import json
 
-from typing import List
+from typing import Iterator, List, Optional
 from schemas import OpenAIChatMessage
+from pydantic import BaseModel
 
 import inspect
 from typing import get_type_hints, Literal, Tuple
@@ -25,6 +28,92 @@ def stream_message_template(model: str, message: str):
     }
 
 
+def iter_text_deltas(res) -> Iterator[str]:
+    """
+    Normalizes a pipe's output (a string, or an iterator of strings, bytes,
+    pydantic chunks or OpenAI-style "data:" SSE lines) into plain text deltas.
+    """
+    if isinstance(res, str):
+        yield res
+        return
+
+    for line in res:
+        if isinstance(line, BaseModel):
+            line = line.model_dump()
+        elif isinstance(line, bytes):
+            line = line.decode("utf-8")
+
+        if isinstance(line, str):
+            if not line.startswith("data:"):
+                yield line
+                continue
+
+            line = line[len("data:") :].strip()
+            if not line or line == "[DONE]":
+                continue
+            try:
+                line = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+        if isinstance(line, dict):
+            for choice in line.get("choices") or []:
+                content = (choice.get("delta") or choice.get("message") or {}).get(
+                    "content"
+                )
+                if content:
+                    yield content
+
+
+def split_stream_chunk(line) -> Tuple[str, Optional[str], bool]:
+    """
+    Splits one item of a pipe's output stream into its text content and the
+    rest of the chunk (role, tool calls, finish reason, usage, ...), so that
+    stream filters only see the text and everything else is forwarded as is.
+
+    Returns `(text, rest, final)`. `rest` is None if the chunk carried only
+    text, otherwise an SSE "data:" line with the text removed. `final` tells
+    whether the rest ends the message (finish reason, usage or [DONE]) and
+    should follow all of the text.
+    """
+    if isinstance(line, BaseModel):
+        line = line.model_dump()
+    elif isinstance(line, bytes):
+        line = line.decode("utf-8")
+
+    if isinstance(line, str):
+        if not line.startswith("data:"):
+            return line, None, False
+
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return "", line, True
+        try:
+            line = json.loads(data)
+        except json.JSONDecodeError:
+            return "", line, False
+
+    if not isinstance(line, dict):
+        return "", f"data: {json.dumps(line)}", False
+
+    chunk = copy.deepcopy(line)
+    text = ""
+    has_rest = bool(chunk.get("usage"))
+    final = has_rest
+    for choice in chunk.get("choices") or []:
+        delta = choice.get("delta") or choice.get("message") or {}
+        text += delta.pop("content", None) or ""
+        if any(value is not None for value in delta.values()):
+            has_rest = True
+        if choice.get("finish_reason") is not None:
+            has_rest = final = True
+
+    if not chunk.get("choices") and not has_rest:
+        # Not a chat completion chunk, forward it untouched.
+        return "", f"data: {json.dumps(line)}", False
+    return text, f"data: {json.dumps(chunk)}" if has_rest else None, final
+
+
 def get_last_user_message(messages: List[dict]) -> str:
     for message in reversed(messages):
         if message["role"] == "user":
@@ -0,0 +1,239 @@
+import gc
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+from config import MODEL_CONCURRENCY, MODEL_MEMORY_BUDGET_MB, MODEL_THREADS
+
+
+def estimate_model_bytes(model: Any) -> int:
+    """
+    Size of a model's torch parameters and buffers, looking through wrappers
+    such as Detoxify or CrossEncoder that keep the module in `.model`.
+    """
+    for module in (model, getattr(model, "model", None)):
+        if hasattr(module, "parameters") and hasattr(module, "buffers"):
+            tensors = [*module.parameters(), *module.buffers()]
+            return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return 0
+
+
+class ModelHandle:
+    """
+    A pipeline's reference to a model in the registry. The model itself may
+    be evicted while idle and is reloaded transparently on the next use.
+    """
+
+    def __init__(self, registry: "ModelRegistry", key: str):
+        self.registry = registry
+        self.key = key
+        self.released = False
+
+    def get(self) -> Any:
+        return self.registry.load(self.key)
+
+    @contextmanager
+    def use(self):
+        """
+        Holds an inference slot and the model for the duration of the block.
+        """
+        with self.registry.slots:
+            with self.registry.in_use(self.key) as model:
+                yield model
+
+    def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Calls `fn(model, *args, **kwargs)` in an inference slot.
+        """
+        with self.use() as model:
+            return fn(model, *args, **kwargs)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.registry.release(self.key)
+
+
+class ModelRegistry:
+    """
+    Loads each local model (sentence-transformers, cross-encoders, Detoxify,
+    ...) once per process and shares it between every pipeline and filter
+    that asks for the same key.
+
+    Pipelines `acquire()` a handle for as long as they need a model and
+    `release()` it on shutdown. A model is unloaded once its last handle is
+    released and it is not running, whatever the budget. Loaded models count
+    against `memory_budget_mb`; when a load goes over budget, models not
+    currently running are unloaded, least recently used first, until the
+    total fits again. Handles reload evicted models on their next use.
+
+    Inference runs in at most `max_concurrency` slots, and torch is limited to
+    `num_threads` intra-op threads, so that concurrent forward passes share
+    the CPU cores instead of oversubscribing them.
+
+    :param memory_budget_mb: Budget for loaded models; 0 means unlimited.
+    :param max_concurrency: Forward passes running at once, across all models.
+    :param num_threads: Torch threads per forward pass; 0 divides the cores between the slots.
+    """
+
+    def __init__(
+        self,
+        memory_budget_mb: float = 0,
+        max_concurrency: int = 2,
+        num_threads: int = 0,
+    ):
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.max_concurrency = max(1, max_concurrency)
+        self.num_threads = num_threads or max(1, (os.cpu_count() or 1) // self.max_concurrency)
+        self.slots = threading.BoundedSemaphore(self.max_concurrency)
+
+        self.lock = threading.Lock()
+        self.models: Dict[str, dict] = {}
+        self.torch_configured = False
+        self.stats = {"loads": 0, "evictions": 0, "load_seconds": 0.0}
+
+    def acquire(self, key: str, load: Callable[[], Any]) -> ModelHandle:
+        """
+        Returns a handle on the model `key`, registering `load` as its loader
+        if the key is new. The model is loaded on first use.
+        """
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is None:
+                entry = {
+                    "load": load,
+                    "model": None,
+                    "bytes": 0,
+                    "refs": 0,
+                    "in_use": 0,
+                    "last_used": 0.0,
+                    "loads": 0,
+                    "lock": threading.Lock(),
+                }
+                self.models[key] = entry
+            entry["refs"] += 1
+        return ModelHandle(self, key)
+
+    def release(self, key: str):
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is None:
+                return
+            entry["refs"] = max(0, entry["refs"] - 1)
+            unloaded = self.unload_unused(entry)
+        if unloaded:
+            gc.collect()
+            print(f"Unloaded model {key}, no pipeline uses it anymore")
+
+    def unload_unused(self, entry: dict) -> bool:
+        # Called with the lock held.
+        if entry["refs"] or entry["in_use"] or entry["model"] is None:
+            return False
+        entry["model"] = None
+        self.stats["evictions"] += 1
+        return True
+
+    def configure_torch(self):
+        # Only touch torch if a model already imported it.
+        torch = sys.modules.get("torch")
+        if torch is not None and not self.torch_configured:
+            torch.set_num_threads(self.num_threads)
+            self.torch_configured = True
+
+    def load(self, key: str) -> Any:
+        entry = self.models[key]
+        with entry["lock"]:
+            if entry["model"] is None:
+                start = time.perf_counter()
+                model = entry["load"]()
+                self.configure_torch()
+                elapsed = time.perf_counter() - start
+                print(f"Loaded model {key} in {elapsed:.2f}s")
+
+                with self.lock:
+                    entry["model"] = model
+                    entry["bytes"] = estimate_model_bytes(model)
+                    entry["loads"] += 1
+                    entry["last_used"] = time.time()
+                    self.stats["loads"] += 1
+                    self.stats["load_seconds"] += elapsed
+                self.evict(keep=key)
+                return model
+            return entry["model"]
+
+    @contextmanager
+    def in_use(self, key: str):
+        entry = self.models[key]
+        with self.lock:
+            entry["in_use"] += 1
+        try:
+            yield self.load(key)
+        finally:
+            with self.lock:
+                entry["in_use"] -= 1
+                entry["last_used"] = time.time()
+                # Released while it was running, e.g. by a valves update mid-query.
+                unloaded = self.unload_unused(entry)
+            if unloaded:
+                gc.collect()
+                print(f"Unloaded model {key}, no pipeline uses it anymore")
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Unloads idle models until the loaded ones fit in the budget.
+        """
+        if not self.memory_budget:
+            return
+
+        evicted = []
+        with self.lock:
+            total = sum(entry["bytes"] for entry in self.models.values() if entry["model"] is not None)
+            idle = sorted(
+                (
+                    (key, entry)
+                    for key, entry in self.models.items()
+                    if entry["model"] is not None and not entry["in_use"] and key != keep
+                ),
+                key=lambda item: (item[1]["refs"] > 0, item[1]["last_used"]),
+            )
+            for key, entry in idle:
+                if total <= self.memory_budget:
+                    break
+                total -= entry["bytes"]
+                entry["model"] = None
+                self.stats["evictions"] += 1
+                evicted.append(key)
+
+        if evicted:
+            gc.collect()
+            print(f"Evicted idle models over the memory budget: {', '.join(evicted)}")
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "memory_budget_mb": self.memory_budget / (1024 * 1024),
+                "max_concurrency": self.max_concurrency,
+                "num_threads": self.num_threads,
+                "models": {
+                    key: {
+                        "loaded": entry["model"] is not None,
+                        "mb": entry["bytes"] / (1024 * 1024),
+                        "refs": entry["refs"],
+                        "in_use": entry["in_use"],
+                        "loads": entry["loads"],
+                    }
+                    for key, entry in self.models.items()
+                },
+            }
+
+
+model_registry = ModelRegistry(
+    memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+    max_concurrency=MODEL_CONCURRENCY,
+    num_threads=MODEL_THREADS,
+)
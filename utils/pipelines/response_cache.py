@@ -0,0 +1,154 @@
+import json
+
+from typing import Generator, Optional
+
+from pydantic import BaseModel
+
+from utils.pipelines.cache import LRUCache, hash_text
+from utils.pipelines.main import iter_text_deltas
+from utils.pipelines.streaming import tap_stream
+
+
+# Request fields that change what a model returns. Everything else in the
+# body (stream, user, chat_id, metadata, ...) is left out of the cache key.
+SAMPLING_PARAMS = [
+    "temperature",
+    "top_p",
+    "top_k",
+    "min_p",
+    "max_tokens",
+    "max_completion_tokens",
+    "seed",
+    "stop",
+    "n",
+    "frequency_penalty",
+    "presence_penalty",
+    "repeat_penalty",
+    "logit_bias",
+    "response_format",
+    "tools",
+    "tool_choice",
+    "reasoning_effort",
+]
+
+
+# Pipes report failures as a reply starting with this, which must not be replayed.
+ERROR_PREFIX = "Error:"
+
+
+def canonical_json(value) -> str:
+    return json.dumps(
+        value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+
+
+def make_response_cache_key(
+    model: str, messages: list, body: dict, namespace: str = ""
+) -> str:
+    """
+    Hashes the canonical JSON of (model, messages, sampling params).
+
+    :param namespace: Extra state the response depends on, such as the
+        pipeline's valves, so that updating them invalidates old entries.
+    """
+    params = {name: body[name] for name in SAMPLING_PARAMS if body.get(name) is not None}
+    return hash_text(
+        namespace, model, canonical_json(messages), canonical_json(params)
+    )
+
+
+def is_deterministic(body: dict) -> bool:
+    """
+    Whether a request asks for a reproducible response: greedy decoding
+    (temperature 0) or a fixed seed. Sampled responses are not cached, or
+    "regenerate" would keep returning the same text.
+    """
+    if body.get("seed") is not None:
+        return True
+    try:
+        return float(body.get("temperature")) == 0
+    except (TypeError, ValueError):
+        # Missing or not a number; the pipe decides what to make of it.
+        return False
+
+
+class ResponseCache:
+    """
+    Exact-match cache of completion text, placed in front of `pipe`.
+
+    A hit is returned as a plain string, which the server replays like any
+    other string response: as one SSE chunk plus the finish frame when
+    streaming, or as a chat.completion object otherwise.
+
+    Entries live in an LRUCache with an optional TTL and SQLite tier. Only
+    complete responses are stored: a stream that fails or is abandoned by the
+    client half-way is not cached, nor are empty replies or "Error: ..."
+    replies, so a transient upstream failure is not replayed for the TTL.
+
+    :param max_size: Maximum number of responses kept in memory.
+    :param ttl: Seconds a response stays valid. 0 or None means no expiry.
+    :param path: SQLite file for the persistent tier. Empty or None disables it.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None, path: str = None):
+        self.cache = LRUCache(max_size=max_size, ttl=ttl, path=path)
+        self.stats = {"hits": 0, "misses": 0, "stores": 0}
+        self.model_stats = {}
+
+    def count(self, model: str, name: str):
+        self.stats[name] += 1
+        model_stats = self.model_stats.setdefault(
+            model, {"hits": 0, "misses": 0, "stores": 0}
+        )
+        model_stats[name] += 1
+
+    def get(self, key: str, model: str = "") -> Optional[str]:
+        content = self.cache.get(key)
+        self.count(model, "misses" if content is None else "hits")
+        return content
+
+    def set(self, key: str, content: str, model: str = ""):
+        if not content or not content.strip() or content.lstrip().startswith(ERROR_PREFIX):
+            return
+        self.cache.set(key, content)
+        self.count(model, "stores")
+
+    def record(self, key: str, res, model: str = ""):
+        """
+        Passes a pipe's output through unchanged while collecting its text,
+        and stores the text once the output has been fully consumed. Outputs
+        other than strings, generators and completion objects are not cached.
+        Streams keep their async interface and are closed along with the tap.
+        """
+        if isinstance(res, str):
+            self.set(key, res, model)
+            return res
+
+        if isinstance(res, (dict, BaseModel)):
+            self.set(key, "".join(iter_text_deltas([res])), model)
+            return res
+
+        if not isinstance(res, Generator):
+            return res
+
+        parts = []
+        return tap_stream(
+            res,
+            lambda line: parts.extend(iter_text_deltas([line])),
+            lambda: self.set(key, "".join(parts), model),
+        )
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "size": len(self.cache),
+            "models": self.model_stats,
+        }
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.cache.close()
@@ -0,0 +1,207 @@
+import math
+import re
+
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+RerankFn = Callable[[str, List[str]], Sequence[float]]
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[-.:/]\w+)*")
+TOKEN_SEPARATORS = re.compile(r"[-.:/]")
+
+
+def cosine_similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def mmr_select(
+    relevance: List[float],
+    embeddings: List[Sequence[float]],
+    k: int,
+    lambda_mult: float = 0.7,
+) -> List[int]:
+    """
+    Maximal marginal relevance: picks up to `k` indices that balance relevance
+    against similarity to what has already been picked.
+
+    :param relevance: Relevance score of each candidate (higher is better).
+    :param embeddings: Embedding of each candidate, used for the redundancy term.
+    :param k: Number of candidates to select.
+    :param lambda_mult: 1.0 ranks purely by relevance, 0.0 purely by diversity.
+    :return: Selected candidate indices, best first.
+    """
+    remaining = list(range(len(relevance)))
+    selected: List[int] = []
+
+    while remaining and len(selected) < k:
+        best, best_score = None, -math.inf
+        for i in remaining:
+            redundancy = max(
+                (cosine_similarity(embeddings[i], embeddings[j]) for j in selected),
+                default=0.0,
+            )
+            score = lambda_mult * relevance[i] - (1 - lambda_mult) * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+        remaining.remove(best)
+
+    return selected
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased word tokens for keyword search. Compound tokens such as error
+    codes, versions or paths ("ERR-1042", "v2.3.1") are kept whole and also
+    split into their parts, so both exact and partial matches score.
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        tokens.append(token)
+        parts = TOKEN_SEPARATORS.split(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class BM25Index:
+    """
+    In-process BM25 keyword index.
+
+    Postings are kept in compact arrays in CSR layout: the documents
+    containing term `t` are `rows[offsets[t]:offsets[t + 1]]` (int32), next
+    to their precomputed BM25 term weights (float32). A query only touches
+    the postings of its own terms. The index is immutable; build a new one
+    when the corpus changes, which takes a single sort over all postings.
+
+    :param ids: Document ids.
+    :param texts: Document texts, in the same order.
+    """
+
+    def __init__(self, ids: List[str], texts: List[str], k1: float = 1.5, b: float = 0.75):
+        self.ids = list(ids)
+        self.vocab: Dict[str, int] = {}
+
+        terms, rows, tfs = [], [], []
+        lengths = np.zeros(len(self.ids), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text or ""))
+            lengths[row] = sum(counts.values())
+            for term, tf in counts.items():
+                terms.append(self.vocab.setdefault(term, len(self.vocab)))
+                rows.append(row)
+                tfs.append(tf)
+
+        terms = np.asarray(terms, dtype=np.int32)
+        order = np.argsort(terms, kind="stable")
+        self.rows = np.asarray(rows, dtype=np.int32)[order]
+        self.offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.vocab)), out=self.offsets[1:])
+
+        count = len(self.ids)
+        df = np.diff(self.offsets)
+        self.idf = np.log(1 + (count - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        tf = np.asarray(tfs, dtype=np.float32)[order]
+        avg_length = float(lengths.mean()) if count else 0.0
+        norms = k1 * (1 - b + b * lengths / avg_length) if avg_length else np.full(count, k1)
+        self.weights = (tf * (k1 + 1) / (tf + norms[self.rows])).astype(np.float32)
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Returns up to `top_k` `(id, score)` pairs of documents sharing a term with `query`, best first.
+        """
+        terms = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+        if not terms:
+            return []
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in terms:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            scores[self.rows[start:end]] += self.idf[term] * self.weights[start:end]
+
+        matched = np.flatnonzero(scores)
+        k = min(top_k, len(matched))
+        if k <= 0:
+            return []
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float(scores[row])) for row in top]
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows.nbytes + self.weights.nbytes + self.offsets.nbytes + self.idf.nbytes
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[str]], k: int = 60, weights: Optional[List[float]] = None
+) -> List[Tuple[str, float]]:
+    """
+    Merges ranked id lists by summing `weight / (k + rank)` for each id,
+    which needs no calibration between the retrievers' score scales.
+
+    :return: `(id, score)` pairs, best first.
+    """
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def load_cross_encoder(model_name: str) -> RerankFn:
+    """
+    Returns a rerank function backed by a local sentence-transformers
+    cross-encoder from the shared model registry. The model is loaded on the
+    first call, not here; call `release()` on the function when done with it.
+    """
+    from utils.pipelines.models import model_registry
+
+    def load():
+        from sentence_transformers import CrossEncoder
+
+        return CrossEncoder(model_name)
+
+    model = model_registry.acquire(f"cross-encoder:{model_name}", load)
+
+    def rerank(query: str, texts: List[str]) -> Sequence[float]:
+        return model.run(lambda model: model.predict([(query, text) for text in texts]))
+
+    rerank.release = model.release
+    return rerank
+
+
+def hybrid_search(
+    query: str,
+    rankings: List[List[str]],
+    top_k: int,
+    rrf_k: int = 60,
+    rerank: Optional[RerankFn] = None,
+    rerank_top_n: int = 20,
+    get_texts: Optional[Callable[[List[str]], List[str]]] = None,
+) -> List[Tuple[str, float]]:
+    """
+    Fuses the rankings of several retrievers (e.g. dense and BM25) with
+    reciprocal rank fusion, then optionally re-scores the best
+    `rerank_top_n` with a cross-encoder. Keep `top_k <= rerank_top_n` when
+    reranking, as reranked and fused scores are not comparable.
+
+    :param get_texts: Returns the texts of the given ids, needed to rerank.
+    :return: Up to `top_k` `(id, score)` pairs, best first.
+    """
+    fused = reciprocal_rank_fusion(rankings, rrf_k)
+    if rerank and fused:
+        head = [id for id, _ in fused[:rerank_top_n]]
+        scores = [float(score) for score in rerank(query, get_texts(head))]
+        reranked = sorted(zip(head, scores), key=lambda item: item[1], reverse=True)
+        fused = reranked + fused[rerank_top_n:]
+    return fused[:top_k]
@@ -0,0 +1,221 @@
+import random
+import threading
+import time
+
+from typing import Callable, Generator, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+
+from utils.pipelines.streaming import tap_stream
+
+
+EmbedFn = Callable[[List[str]], Sequence[Sequence[float]]]
+
+
+class SemanticCache:
+    """
+    Answers near-duplicate queries with a previously generated response.
+
+    Queries are embedded and compared by cosine similarity against every
+    cached query with one matrix-vector product (brute force, which is fast
+    enough for tens of thousands of entries). A hit needs a similarity of at
+    least `threshold`. When full, the least recently used entry is replaced.
+
+    Precision is estimated by shadow verification: a `verify_rate` fraction of
+    hits still runs the pipeline, and the hit counts as correct if the fresh
+    answer is as similar to the cached one as `threshold` requires.
+
+    :param embed: Maps a list of texts to their embeddings.
+    :param threshold: Minimum cosine similarity for a hit.
+    :param max_size: Maximum number of cached responses.
+    :param ttl: Seconds a response stays valid. 0 or None means no expiry.
+    :param verify_rate: Fraction of hits re-run to measure precision.
+    """
+
+    def __init__(
+        self,
+        embed: EmbedFn,
+        threshold: float = 0.92,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        verify_rate: float = 0.0,
+    ):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.verify_rate = verify_rate
+        self.lock = threading.Lock()
+
+        self.vectors: Optional[np.ndarray] = None
+        self.entries: List[Optional[dict]] = []
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "verified": 0,
+            "verified_correct": 0,
+            "lookup_seconds": 0.0,
+            "latency_saved_seconds": 0.0,
+        }
+
+    def embed_one(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embed([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, query: str, vector: np.ndarray = None) -> Optional[dict]:
+        """
+        Returns the closest cached entry for `query` if it clears the threshold.
+        """
+        start = time.perf_counter()
+        if vector is None:
+            vector = self.embed_one(query)
+
+        with self.lock:
+            self.stats["lookups"] += 1
+            entry = None
+
+            if self.vectors is not None and self.entries:
+                similarities = self.vectors[: len(self.entries)] @ vector
+                while True:
+                    best = int(np.argmax(similarities))
+                    if similarities[best] < self.threshold:
+                        break
+                    candidate = self.entries[best]
+                    if candidate is None:
+                        similarities[best] = -np.inf
+                        continue
+                    if self.ttl and time.time() - candidate["created"] > self.ttl:
+                        self.remove(best)
+                        self.stats["expirations"] += 1
+                        similarities[best] = -np.inf
+                        continue
+                    entry = candidate
+                    entry["last_used"] = time.time()
+                    entry["hits"] += 1
+                    entry["similarity"] = float(similarities[best])
+                    break
+
+            self.stats["hits" if entry else "misses"] += 1
+            self.stats["lookup_seconds"] += time.perf_counter() - start
+            return entry
+
+    def store(self, query: str, response: str, latency: float = 0.0, vector: np.ndarray = None):
+        if not response:
+            return
+        if vector is None:
+            vector = self.embed_one(query)
+
+        with self.lock:
+            if self.vectors is None or self.vectors.shape[1] != vector.shape[0]:
+                self.vectors = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+                self.entries = []
+
+            if None in self.entries:
+                slot = self.entries.index(None)
+            elif len(self.entries) < self.max_size:
+                slot = len(self.entries)
+                self.entries.append(None)
+            else:
+                slot = min(
+                    range(len(self.entries)),
+                    key=lambda i: self.entries[i]["last_used"],
+                )
+                self.stats["evictions"] += 1
+
+            now = time.time()
+            self.vectors[slot] = vector
+            self.entries[slot] = {
+                "query": query,
+                "response": response,
+                "latency": latency,
+                "created": now,
+                "last_used": now,
+                "hits": 0,
+            }
+            self.stats["stores"] += 1
+
+    def remove(self, slot: int):
+        self.entries[slot] = None
+        self.vectors[slot] = 0
+
+    def invalidate(self):
+        """
+        Drops every cached response, e.g. after the index or the valves change.
+        """
+        with self.lock:
+            self.vectors = None
+            self.entries = []
+            self.stats["invalidations"] += 1
+
+    def verify(self, entry: dict, response: str):
+        similarity = float(self.embed_one(entry["response"]) @ self.embed_one(response))
+        with self.lock:
+            self.stats["verified"] += 1
+            if similarity >= self.threshold:
+                self.stats["verified_correct"] += 1
+
+    def wrap(
+        self, query: str, run: Callable[[], Union[str, Generator, Iterator]]
+    ) -> Union[str, Generator, Iterator]:
+        """
+        Serves `query` from the cache, or calls `run()` and caches its output.
+        A streamed output is cached once it has been fully consumed.
+        """
+        if not query:
+            return run()
+
+        vector = self.embed_one(query)
+        entry = self.lookup(query, vector)
+        verify = entry is not None and random.random() < self.verify_rate
+        if entry is not None and not verify:
+            with self.lock:
+                self.stats["latency_saved_seconds"] += entry["latency"]
+            return entry["response"]
+
+        start = time.perf_counter()
+        res = run()
+
+        def finish(response: str):
+            if verify:
+                self.verify(entry, response)
+            else:
+                self.store(query, response, time.perf_counter() - start, vector)
+
+        if isinstance(res, str):
+            finish(res)
+            return res
+
+        parts = []
+
+        def end():
+            # Only plain text streams can be replayed as a cached string.
+            if all(isinstance(part, str) for part in parts):
+                finish("".join(parts))
+
+        return tap_stream(res, parts.append, end)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            size = sum(entry is not None for entry in self.entries)
+        return {
+            **stats,
+            "size": size,
+            "hit_rate": stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0,
+            "precision": (
+                stats["verified_correct"] / stats["verified"]
+                if stats["verified"]
+                else None
+            ),
+            "avg_lookup_ms": (
+                1000 * stats["lookup_seconds"] / stats["lookups"]
+                if stats["lookups"]
+                else 0.0
+            ),
+        }
@@ -0,0 +1,253 @@
+import re
+import threading
+import time
+
+from typing import Any, List, Optional, Sequence
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+
+
+QUOTED_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+# SQLAlchemy dialect names that sqlglot spells differently
+SQLGLOT_DIALECTS = {"postgresql": "postgres", "mssql": "tsql"}
+
+# Statements and clauses that write, change the schema or take locks
+FORBIDDEN_EXPRESSIONS = [
+    "Insert",
+    "Update",
+    "Delete",
+    "Merge",
+    "Drop",
+    "Create",
+    "Alter",
+    "Command",
+    "Into",
+    "Lock",
+    "Copy",
+    "Pragma",
+    "Set",
+    "Transaction",
+    "Commit",
+    "Rollback",
+]
+
+
+class SQLGuardError(ValueError):
+    """
+    Generated SQL was rejected, or could not run within its limits.
+    """
+
+
+def create_pooled_engine(
+    url: str,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_recycle: int = 1800,
+    pool_timeout: float = 30,
+    **kwargs,
+) -> Engine:
+    """
+    Creates an SQLAlchemy engine with a sized connection pool. Connections
+    are pinged before use and replaced after `pool_recycle` seconds, so
+    connections dropped by the server or a proxy are never handed out.
+    """
+    return create_engine(
+        url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=pool_recycle,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=True,
+        **kwargs,
+    )
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Collapses whitespace outside quoted literals and drops trailing
+    semicolons, so that trivially different renderings of one statement
+    share a cache key.
+    """
+    parts = QUOTED_PATTERN.split(sql)
+    normalized = "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)
+    )
+    return normalized.strip().rstrip(";").strip()
+
+
+def guard_sql(sql: str, dialect: Optional[str] = None, max_rows: int = 100) -> str:
+    """
+    Parses generated SQL with sqlglot and returns it rewritten for execution:
+    exactly one read-only query (SELECT, set operations and CTEs) whose LIMIT
+    is at most `max_rows`. A missing or larger LIMIT becomes `max_rows + 1`,
+    so that the caller can tell the result was cut off.
+
+    :param dialect: SQLAlchemy dialect name of the target database.
+    :raises SQLGuardError: If the SQL does not parse or is not read-only.
+    """
+    import sqlglot
+    from sqlglot import exp
+
+    read = SQLGLOT_DIALECTS.get(dialect, dialect)
+    try:
+        statements = [statement for statement in sqlglot.parse(sql, read=read) if statement]
+    except sqlglot.errors.ParseError as e:
+        reason = e.errors[0].get("description") if e.errors else str(e)
+        raise SQLGuardError(f"Could not parse SQL: {reason}") from e
+
+    if len(statements) != 1:
+        raise SQLGuardError(f"Expected one statement, got {len(statements)}")
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        raise SQLGuardError(f"Only SELECT queries are allowed, got {statement.key.upper()}")
+
+    forbidden = tuple(
+        getattr(exp, name) for name in FORBIDDEN_EXPRESSIONS if hasattr(exp, name)
+    )
+    for node in statement.walk():
+        if isinstance(node, forbidden):
+            raise SQLGuardError(f"{node.key.upper()} is not allowed in a read-only query")
+
+    limit = statement.args.get("limit")
+    value = limit.expression if limit else None
+    if not (isinstance(value, exp.Literal) and value.is_int and int(value.this) <= max_rows):
+        statement = statement.limit(max_rows + 1)
+
+    return statement.sql(dialect=read)
+
+
+def begin_read_only(connection, timeout: float):
+    """
+    Makes the connection's transaction read-only where the database supports
+    it, as a second line of defense behind `guard_sql`, and sets a
+    server-side statement timeout on PostgreSQL.
+    """
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+    elif dialect == "sqlite":
+        connection.exec_driver_sql("PRAGMA query_only = ON")
+
+
+def end_read_only(connection):
+    # Pooled SQLite connections keep pragmas, so give the connection back writable.
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql("PRAGMA query_only = OFF")
+
+
+def cancel_query(dbapi_connection):
+    # psycopg2 and sqlite3 can abort a running statement from another thread.
+    for method in ("cancel", "interrupt"):
+        if hasattr(dbapi_connection, method):
+            getattr(dbapi_connection, method)()
+            return
+
+
+def run_guarded_sql(
+    engine: Engine,
+    sql: str,
+    max_rows: int = 100,
+    timeout: float = 30.0,
+    fetch_size: int = 50,
+) -> dict:
+    """
+    Runs a query checked by `guard_sql` in a read-only transaction and
+    returns `{"columns", "rows", "truncated"}`.
+
+    Rows are streamed from a server-side cursor (where the driver supports
+    one) in batches of `fetch_size`, and at most `max_rows` are kept, so
+    memory stays bounded whatever the query returns. The query is cancelled
+    after `timeout` seconds, including the time spent fetching.
+
+    :raises SQLGuardError: If the query timed out.
+    """
+    deadline = time.monotonic() + timeout
+    timed_out = threading.Event()
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            stream_results=True, max_row_buffer=fetch_size
+        )
+        begin_read_only(connection, timeout)
+
+        dbapi_connection = connection.connection.dbapi_connection
+
+        def on_timeout():
+            timed_out.set()
+            cancel_query(dbapi_connection)
+
+        timer = threading.Timer(timeout, on_timeout)
+        timer.start()
+        try:
+            result = connection.execute(text(sql))
+            columns = list(result.keys())
+            rows: List[tuple] = []
+            while len(rows) <= max_rows:
+                batch = result.fetchmany(fetch_size)
+                if not batch:
+                    break
+                rows.extend(tuple(row) for row in batch)
+                if time.monotonic() > deadline:
+                    timed_out.set()
+                    break
+            result.close()
+        except DBAPIError as e:
+            if timed_out.is_set():
+                raise SQLGuardError(f"Query exceeded the {timeout:g}s timeout") from e
+            raise
+        finally:
+            timer.cancel()
+            connection.rollback()
+            end_read_only(connection)
+
+    if timed_out.is_set():
+        raise SQLGuardError(f"Query exceeded the {timeout:g}s timeout")
+    return {
+        "columns": columns,
+        "rows": rows[:max_rows],
+        "truncated": len(rows) > max_rows,
+    }
+
+
+def format_sample(
+    columns: Sequence[str],
+    rows: Sequence[Sequence[Any]],
+    truncated: bool = False,
+    max_rows: int = 20,
+    max_columns: int = 10,
+    max_value_chars: int = 80,
+) -> str:
+    """
+    Renders a compact sample of a result for the LLM to summarize. Columns
+    that are empty in every row are dropped, at most `max_columns` columns
+    and `max_rows` rows are shown and long values are cut. A closing note
+    says what was left out, so the answer does not claim to be complete.
+    """
+    keep = [
+        i
+        for i in range(len(columns))
+        if any(row[i] is not None and row[i] != "" for row in rows)
+    ] or list(range(len(columns)))
+    omitted_columns = len(columns) - min(len(keep), max_columns)
+    keep = keep[:max_columns]
+
+    def cell(value) -> str:
+        value = str(value)
+        return value if len(value) <= max_value_chars else f"{value[: max_value_chars - 3]}..."
+
+    lines = [" | ".join(str(columns[i]) for i in keep)]
+    lines += [" | ".join(cell(row[i]) for i in keep) for row in rows[:max_rows]]
+
+    notes = []
+    if truncated or len(rows) > max_rows:
+        total = f"more than {len(rows)}" if truncated else str(len(rows))
+        notes.append(f"showing {min(len(rows), max_rows)} of {total} rows")
+    if omitted_columns:
+        notes.append(f"{omitted_columns} empty or extra columns omitted")
+    if notes:
+        lines.append(f"({'; '.join(notes)})")
+    return "\n".join(lines)
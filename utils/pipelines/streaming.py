@@ -0,0 +1,221 @@
+import asyncio
+import queue
+import threading
+import weakref
+
+from collections.abc import AsyncIterator, Generator
+from typing import Any, Callable, Iterable, Optional
+
+
+ITEM, END, ERROR = "item", "end", "error"
+
+
+class Channel:
+    """
+    State shared by a PrefetchStream and its producer thread. The thread only
+    holds the channel, not the stream, so that an abandoned stream can still
+    be garbage collected, which closes the channel and stops the thread.
+    """
+
+    def __init__(self, max_buffer: int):
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, max_buffer))
+        self.closed = threading.Event()
+
+        # Set when the stream is read with `async for`, to wake the reader up.
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.ready: Optional[asyncio.Event] = None
+
+    def put(self, kind: str, value: Any = None) -> bool:
+        # Blocks while the queue is full, giving up once the reader has closed the stream.
+        while not self.closed.is_set():
+            try:
+                self.queue.put((kind, value), timeout=0.1)
+            except queue.Full:
+                continue
+
+            if self.loop is not None:
+                try:
+                    self.loop.call_soon_threadsafe(self.ready.set)
+                except RuntimeError:
+                    # The event loop is gone, so is the reader.
+                    self.closed.set()
+            return True
+        return False
+
+
+def produce_into(produce: Callable[[], Iterable], channel: Channel):
+    try:
+        for item in produce():
+            if not channel.put(ITEM, item):
+                return
+    except Exception as e:
+        channel.put(ERROR, e)
+    else:
+        channel.put(END)
+
+
+class PrefetchStream(Generator):
+    """
+    Runs a blocking stream on its own producer thread and hands its items to
+    the reader through a bounded queue. Generation runs ahead of a slow
+    reader by up to `max_buffer` items, and a slow generator does not hold a
+    server thread while the reader waits for it.
+
+    The stream is a regular generator, so every existing consumer of
+    pipeline output keeps working. It can also be read with `async for`
+    straight from the event loop, without a thread hop per item. The
+    producer starts on the first read and stops once the stream is closed.
+
+    :param produce: Returns the iterable to stream. It is called on the
+        producer thread, so it can do blocking setup work such as retrieval.
+    :param max_buffer: Items the producer may run ahead of the reader.
+    """
+
+    def __init__(self, produce: Callable[[], Iterable], max_buffer: int = 64):
+        self.produce = produce
+        self.channel = Channel(max_buffer)
+        self.queue = self.channel.queue
+        self.thread: Optional[threading.Thread] = None
+        self.done = False
+        # Backstop for readers that drop the stream without closing it.
+        weakref.finalize(self, self.channel.closed.set)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=produce_into, args=(self.produce, self.channel), daemon=True
+            )
+            self.thread.start()
+
+    def unpack(self, kind: str, value: Any, stop: type):
+        if kind == ITEM:
+            return value
+        self.done = True
+        if kind == ERROR:
+            raise value
+        raise stop
+
+    def send(self, value):
+        if self.done:
+            raise StopIteration
+        self.start()
+        return self.unpack(*self.queue.get(), StopIteration)
+
+    def throw(self, typ, val=None, tb=None):
+        self.close()
+        if val is None:
+            val = typ() if isinstance(typ, type) else typ
+        raise val.with_traceback(tb) if tb else val
+
+    def close(self):
+        self.done = True
+        self.channel.closed.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        channel = self.channel
+        if channel.loop is None:
+            channel.ready = asyncio.Event()
+            channel.loop = asyncio.get_running_loop()
+        self.start()
+
+        while True:
+            try:
+                entry = self.queue.get_nowait()
+                break
+            except queue.Empty:
+                # The producer sets `ready` after every put, so a put racing this clear is not lost.
+                channel.ready.clear()
+                if self.queue.empty():
+                    await channel.ready.wait()
+        return self.unpack(*entry, StopAsyncIteration)
+
+    async def aclose(self):
+        self.close()
+
+
+class TapStream(Generator):
+    """
+    Passes the items of `stream` through unchanged, calling `on_item` on
+    each and `on_end` once the stream is exhausted (not when it fails or is
+    closed early). Closing the tap closes `stream`, so a PrefetchStream's
+    producer still stops when the client goes away. Use `tap_stream`, which
+    keeps async streams readable with `async for`.
+    """
+
+    def __init__(
+        self,
+        stream: Iterable,
+        on_item: Callable[[Any], None],
+        on_end: Callable[[], None],
+    ):
+        self.stream = stream
+        self.iterator = iter(stream)
+        self.on_item = on_item
+        self.on_end = on_end
+        self.done = False
+
+    def next_item(self, item: Any) -> Any:
+        self.on_item(item)
+        return item
+
+    def end(self):
+        if not self.done:
+            self.done = True
+            self.on_end()
+
+    def send(self, value):
+        try:
+            item = next(self.iterator)
+        except StopIteration:
+            self.end()
+            raise
+        return self.next_item(item)
+
+    def throw(self, typ, val=None, tb=None):
+        self.close()
+        if val is None:
+            val = typ() if isinstance(typ, type) else typ
+        raise val.with_traceback(tb) if tb else val
+
+    def close(self):
+        self.done = True
+        if hasattr(self.stream, "close"):
+            self.stream.close()
+
+
+class AsyncTapStream(TapStream):
+    """
+    TapStream over a stream that can also be read with `async for`, such as
+    a PrefetchStream.
+    """
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            item = await self.stream.__anext__()
+        except StopAsyncIteration:
+            self.end()
+            raise
+        return self.next_item(item)
+
+    async def aclose(self):
+        self.done = True
+        if hasattr(self.stream, "aclose"):
+            await self.stream.aclose()
+        else:
+            self.close()
+
+
+def tap_stream(
+    stream: Iterable, on_item: Callable[[Any], None], on_end: Callable[[], None]
+) -> TapStream:
+    if isinstance(stream, AsyncIterator):
+        return AsyncTapStream(stream, on_item, on_end)
+    return TapStream(stream, on_item, on_end)
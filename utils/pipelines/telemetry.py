@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+
+from typing import Any, Callable, List, Literal, Optional
+
+
+DropPolicy = Literal["drop_newest", "drop_oldest", "block"]
+
+
+class TelemetryExporter:
+    """
+    Buffers telemetry events on a bounded in-process queue and exports them
+    in batches from a background task, so filters never wait on an SDK
+    round trip inside `inlet`/`outlet`.
+
+    :param export: Called with a list of events. Runs in a worker thread, so it may block.
+    :param max_queue_size: Maximum number of pending events.
+    :param max_batch_size: Maximum number of events handed to `export` at once.
+    :param flush_interval: Seconds to wait for a batch to fill before exporting it.
+    :param drop_policy: What to do when the queue is full:
+        "drop_newest" discards the incoming event, "drop_oldest" evicts the
+        oldest pending event, "block" waits for room (backpressure).
+    :param on_flush: Optional callable run in a worker thread after each batch.
+    """
+
+    def __init__(
+        self,
+        export: Callable[[List[Any]], None],
+        max_queue_size: int = 1000,
+        max_batch_size: int = 64,
+        flush_interval: float = 1.0,
+        drop_policy: DropPolicy = "drop_oldest",
+        on_flush: Optional[Callable[[], None]] = None,
+    ):
+        self.export = export
+        self.max_batch_size = max(1, max_batch_size)
+        self.flush_interval = flush_interval
+        self.drop_policy = drop_policy
+        self.on_flush = on_flush
+
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_queue_size))
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {"submitted": 0, "exported": 0, "dropped": 0, "failed": 0}
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Exports everything still queued, then stops the background task."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def submit(self, event: Any) -> bool:
+        """Queues an event. Returns False if it was dropped."""
+        self.stats["submitted"] += 1
+
+        if self.drop_policy == "block":
+            await self.queue.put(event)
+            return True
+
+        if self.queue.full():
+            if self.drop_policy == "drop_newest":
+                self.stats["dropped"] += 1
+                return False
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.stats["dropped"] += 1
+            except asyncio.QueueEmpty:
+                pass
+
+        self.queue.put_nowait(event)
+        return True
+
+    async def flush(self):
+        """Exports all currently queued events immediately."""
+        while not self.queue.empty():
+            await self._export_batch(self._drain([]))
+
+    def _drain(self, batch: List[Any]) -> List[Any]:
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _export_batch(self, batch: List[Any]):
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self.export, batch)
+            if self.on_flush:
+                await asyncio.to_thread(self.on_flush)
+            self.stats["exported"] += len(batch)
+        except Exception as e:
+            self.stats["failed"] += len(batch)
+            logging.error(f"Telemetry export failed for {len(batch)} events: {e}")
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # Give the batch a chance to fill up before exporting it.
+            try:
+                while len(batch) < self.max_batch_size:
+                    self._drain(batch)
+                    remaining = deadline - time.monotonic()
+                    if len(batch) >= self.max_batch_size or remaining <= 0:
+                        break
+                    try:
+                        batch.append(
+                            await asyncio.wait_for(self.queue.get(), timeout=remaining)
+                        )
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                await self._export_batch(batch)
+                raise
+
+            await self._export_batch(batch)
@@ -0,0 +1,214 @@
+import threading
+
+from typing import Dict, List, Optional
+
+from utils.pipelines.cache import LRUCache, hash_text
+
+
+DEFAULT_ENCODING = "tiktoken:cl100k_base"
+
+# Rough cost of one image and of the per-message chat framing
+IMAGE_TOKENS = 1600
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class HeuristicTokenizer:
+    """Dependency-free estimate of about `chars_per_token` characters per token."""
+
+    def __init__(self, chars_per_token: float = 4.0):
+        self.name = f"heuristic:{chars_per_token}"
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return int((len(text) + self.chars_per_token - 1) // self.chars_per_token)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+
+class TiktokenTokenizer:
+    """OpenAI BPE encodings through tiktoken. The encoding file loads on first use."""
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        import tiktoken
+
+        self.name = f"tiktoken:{encoding_name}"
+        self.encoding_name = encoding_name
+        self.tiktoken = tiktoken
+        self.encoding = None
+
+    def get_encoding(self):
+        if self.encoding is None:
+            self.encoding = self.tiktoken.get_encoding(self.encoding_name)
+        return self.encoding
+
+    def count(self, text: str) -> int:
+        return len(self.get_encoding().encode(text, disallowed_special=()))
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [
+            len(tokens)
+            for tokens in self.get_encoding().encode_batch(texts, disallowed_special=())
+        ]
+
+
+class HFTokenizer:
+    """Hugging Face `tokenizers`. The tokenizer file is downloaded/loaded on first use."""
+
+    def __init__(self, identifier: str):
+        from tokenizers import Tokenizer
+
+        self.name = f"hf:{identifier}"
+        self.identifier = identifier
+        self.tokenizer_class = Tokenizer
+        self.tokenizer = None
+
+    def get_tokenizer(self):
+        if self.tokenizer is None:
+            self.tokenizer = self.tokenizer_class.from_pretrained(self.identifier)
+        return self.tokenizer
+
+    def count(self, text: str) -> int:
+        return len(self.get_tokenizer().encode(text, add_special_tokens=False).ids)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [
+            len(encoding.ids)
+            for encoding in self.get_tokenizer().encode_batch(
+                texts, add_special_tokens=False
+            )
+        ]
+
+
+BACKENDS = {
+    "heuristic": lambda arg: HeuristicTokenizer(float(arg) if arg else 4.0),
+    "tiktoken": lambda arg: TiktokenTokenizer(arg or "cl100k_base"),
+    "hf": lambda arg: HFTokenizer(arg),
+}
+
+tokenizers: Dict[str, object] = {}
+tokenizers_lock = threading.Lock()
+token_cache = LRUCache(max_size=65536)
+
+
+def register_tokenizer(encoding: str, tokenizer):
+    """
+    Registers a custom backend under `encoding`. It needs a `name`, `count(text)` and `count_batch(texts)`.
+    """
+    with tokenizers_lock:
+        tokenizers[encoding] = tokenizer
+
+
+def get_tokenizer(encoding: str = DEFAULT_ENCODING):
+    """
+    Returns the backend for an encoding spec such as "tiktoken:o200k_base",
+    "hf:bert-base-uncased" or "heuristic". Falls back to the heuristic when
+    the backend's library is not installed.
+    """
+    with tokenizers_lock:
+        tokenizer = tokenizers.get(encoding)
+        if tokenizer is None:
+            backend, _, arg = encoding.partition(":")
+            try:
+                tokenizer = BACKENDS[backend](arg)
+            except (ImportError, KeyError) as e:
+                print(f"Tokenizer {encoding} unavailable ({e}), using heuristic")
+                tokenizer = HeuristicTokenizer()
+            tokenizers[encoding] = tokenizer
+        return tokenizer
+
+
+def count_tokens_batch(texts: List[str], encoding: str = DEFAULT_ENCODING) -> List[int]:
+    """
+    Counts tokens for many texts at once. Cached counts are reused, keyed by
+    (encoding, text hash), and only the misses go to the backend in one batch.
+    """
+    tokenizer = get_tokenizer(encoding)
+    keys = [hash_text(tokenizer.name, text) for text in texts]
+    counts: List[Optional[int]] = [token_cache.get(key) for key in keys]
+
+    misses = [i for i, count in enumerate(counts) if count is None]
+    if misses:
+        try:
+            missing_counts = tokenizer.count_batch([texts[i] for i in misses])
+        except Exception as e:
+            # e.g. the tokenizer file could not be downloaded. Switch for good, so that
+            # air-gapped servers do not wait for the download again on every request.
+            print(f"Tokenizer {tokenizer.name} failed ({e}), using heuristic from now on")
+            tokenizer = HeuristicTokenizer()
+            register_tokenizer(encoding, tokenizer)
+            keys = [hash_text(tokenizer.name, text) for text in texts]
+            missing_counts = tokenizer.count_batch([texts[i] for i in misses])
+        for i, count in zip(misses, missing_counts):
+            counts[i] = count
+            token_cache.set(keys[i], count)
+
+    return counts
+
+
+def count_tokens(text: str, encoding: str = DEFAULT_ENCODING) -> int:
+    return count_tokens_batch([text], encoding)[0]
+
+
+def count_messages_tokens_batch(
+    messages: List[dict], encoding: str = DEFAULT_ENCODING
+) -> List[int]:
+    """
+    Counts the tokens of every message in a conversation with a single batched
+    tokenizer call. Images are counted at a flat rate without looking at their data.
+    """
+    texts = []
+    owners = []
+    counts = []
+
+    for i, message in enumerate(messages):
+        content = message.get("content", "")
+        counts.append(MESSAGE_OVERHEAD_TOKENS)
+        if isinstance(content, list):
+            for item in content:
+                if item.get("type") == "text":
+                    texts.append(item.get("text", ""))
+                    owners.append(i)
+                elif item.get("type") == "image_url":
+                    counts[i] += IMAGE_TOKENS
+        else:
+            texts.append(str(content or ""))
+            owners.append(i)
+
+    for i, count in zip(owners, count_tokens_batch(texts, encoding)):
+        counts[i] += count
+
+    return counts
+
+
+def count_message_tokens(message: dict, encoding: str = DEFAULT_ENCODING) -> int:
+    return count_messages_tokens_batch([message], encoding)[0]
+
+
+def count_messages_tokens(messages: List[dict], encoding: str = DEFAULT_ENCODING) -> int:
+    return sum(count_messages_tokens_batch(messages, encoding))
+
+
+def get_encoding_for_model(model_id: str) -> str:
+    """
+    Picks an encoding spec for a model id: o200k for the GPT-4o/o-series family,
+    cl100k otherwise (a close enough estimate for most other chat models).
+    """
+    model_id = model_id.lower()
+    if any(name in model_id for name in ["gpt-4o", "gpt-4.1", "o1", "o3", "o4"]):
+        return "tiktoken:o200k_base"
+    return DEFAULT_ENCODING
+
+
+def estimate_usage(messages: List[dict], completion: str, model_id: str = "") -> dict:
+    """
+    Estimates an OpenAI-style `usage` object for backends that do not report one.
+    """
+    encoding = get_encoding_for_model(model_id)
+    prompt_tokens = count_messages_tokens(messages, encoding)
+    completion_tokens = count_tokens(completion, encoding)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
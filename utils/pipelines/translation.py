@@ -0,0 +1,305 @@
+import asyncio
+import inspect
+import re
+import threading
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from utils.pipelines.cache import LRUCache, hash_text
+
+
+TranslateFn = Callable[[str, str, str], Union[str, Awaitable[str]]]
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes text for cache lookups: trims it and collapses runs of spaces
+    and tabs. Newlines are kept since they carry markdown structure.
+    """
+    return re.sub(r"[ \t]+", " ", text.strip())
+
+
+class TranslationCache:
+    """
+    Bounded translation cache shared by the translate filters.
+
+    Entries are keyed by (source, target, backend, normalized text) and kept in
+    an LRUCache, optionally backed by an SQLite file. Concurrent requests for
+    the same key are coalesced so the backend is only called once.
+
+    :param max_size: Maximum number of translations kept in memory.
+    :param ttl: Seconds a translation stays valid. 0 or None means no expiry.
+    :param path: SQLite file for the persistent tier. Empty or None disables it.
+    """
+
+    def __init__(self, max_size: int = 2048, ttl: Optional[float] = None, path: str = None):
+        self.cache = LRUCache(max_size=max_size, ttl=ttl, path=path)
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.inflight_sync: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.stats = {"coalesced": 0, "backend_calls": 0}
+
+    def make_key(self, text: str, source: str, target: str, backend: str) -> str:
+        return hash_text(source or "", target or "", backend, normalize_text(text))
+
+    async def translate(
+        self,
+        text: str,
+        source: str,
+        target: str,
+        backend: str,
+        translate_fn: TranslateFn,
+    ) -> str:
+        """
+        Returns the cached translation of `text`, calling `translate_fn(text, source, target)`
+        on a miss. Sync functions run in a worker thread. Exceptions are not cached.
+        """
+        if not text or not text.strip():
+            return text
+
+        key = self.make_key(text, source, target, backend)
+
+        translated = self.cache.get(key)
+        if translated is not None:
+            return translated
+
+        if key in self.inflight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        # Mark errors as retrieved even when no one else was waiting on them.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = future
+
+        try:
+            self.stats["backend_calls"] += 1
+            if inspect.iscoroutinefunction(translate_fn):
+                translated = await translate_fn(text, source, target)
+            else:
+                translated = await asyncio.to_thread(translate_fn, text, source, target)
+
+            self.cache.set(key, translated)
+            future.set_result(translated)
+            return translated
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+    def translate_sync(
+        self,
+        text: str,
+        source: str,
+        target: str,
+        backend: str,
+        translate_fn: Callable[[str, str, str], str],
+    ) -> str:
+        """
+        Blocking variant of `translate` for code running in worker threads,
+        such as a pipe's output stream. Identical concurrent requests are coalesced too.
+        """
+        if not text or not text.strip():
+            return text
+
+        key = self.make_key(text, source, target, backend)
+
+        translated = self.cache.get(key)
+        if translated is not None:
+            return translated
+
+        with self.lock:
+            future = self.inflight_sync.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight_sync[key] = future
+
+        if not owner:
+            self.stats["coalesced"] += 1
+            return future.result()
+
+        try:
+            self.stats["backend_calls"] += 1
+            translated = translate_fn(text, source, target)
+            self.cache.set(key, translated)
+            future.set_result(translated)
+            return translated
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight_sync.pop(key, None)
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.cache.close()
+
+
+class StreamedReplies:
+    """
+    Remembers the replies an `outlet_stream` already translated, so that the
+    filter's `outlet`, which Open WebUI calls afterwards with the whole reply,
+    skips exactly those and still translates non-streamed replies and those
+    of models the server did not stream.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def make_key(self, text: str) -> str:
+        return hash_text(normalize_text(text))
+
+    def track(self, stream: Iterable[str]) -> Iterator[str]:
+        parts = []
+        for text in stream:
+            parts.append(text)
+            yield text
+        self.cache.set(self.make_key("".join(parts)), True)
+
+    def seen(self, text: Optional[str]) -> bool:
+        return bool(text) and self.make_key(text) in self.cache
+
+
+def split_text_around_table(text: str) -> List[str]:
+    """
+    Splits text into the part before the first markdown table and the rest.
+    """
+    table_regex = r"((?:^.*?\|.*?\n)+)(?=\n[^\|\s].*?\|)"
+    matches = re.split(table_regex, text, flags=re.MULTILINE)
+
+    if len(matches) > 1:
+        return [matches[0], matches[1]]
+    else:
+        return [text, ""]
+
+
+def clean_table_delimiters(text: str) -> str:
+    # Remove extra spaces from table delimiters
+    return re.sub(r"(\|\s*-+\s*)+", lambda m: m.group(0).replace(" ", "-"), text)
+
+
+CLOSING_FENCE_REGEX = re.compile(r"^[ \t]*```[ \t]*\n", re.MULTILINE)
+SENTENCE_END_REGEX = re.compile(r"[.!?\u3002\uff01\uff1f]+[\"')\]]*\s+")
+
+
+def split_markdown_stream(chunks: Iterable[str]) -> Iterator[Tuple[str, bool]]:
+    """
+    Regroups a stream of text deltas into segments that can be translated on
+    their own, yielding `(segment, translatable)` pairs in order.
+
+    Text is cut at line ends and sentence ends. Code fences are held back
+    until they close and yielded whole, and markdown table lines are yielded
+    as they complete; both come out with `translatable=False`.
+    """
+    buffer = ""
+    in_code_block = False
+
+    for chunk in chunks:
+        buffer += chunk
+
+        while buffer:
+            line_end = buffer.find("\n")
+            line = buffer if line_end == -1 else buffer[: line_end + 1]
+            stripped = line.lstrip()
+
+            if in_code_block:
+                # The buffer starts at the opening fence; wait for a complete closing fence line.
+                closing = (
+                    CLOSING_FENCE_REGEX.search(buffer, line_end + 1)
+                    if line_end != -1
+                    else None
+                )
+                if closing is None:
+                    break
+                yield buffer[: closing.end()], False
+                buffer = buffer[closing.end() :]
+                in_code_block = False
+                continue
+
+            # A line that may still turn into a fence or table row must be complete.
+            if line_end == -1 and (stripped == "" or stripped[0] in "`|"):
+                break
+
+            if stripped.startswith("```"):
+                in_code_block = True
+                continue
+
+            if stripped.startswith("|"):
+                yield clean_table_delimiters(line), False
+                buffer = buffer[len(line) :]
+                continue
+
+            if line_end != -1:
+                yield line, True
+                buffer = buffer[len(line) :]
+                continue
+
+            sentence_end = None
+            for match in SENTENCE_END_REGEX.finditer(buffer):
+                sentence_end = match.end()
+            if sentence_end is None:
+                break
+            yield buffer[:sentence_end], True
+            buffer = buffer[sentence_end:]
+
+    if buffer:
+        yield buffer, not in_code_block and not buffer.lstrip().startswith("|")
+
+
+def translate_stream(
+    chunks: Iterable[str],
+    translate: Callable[[str], str],
+    max_concurrency: int = 4,
+) -> Iterator[str]:
+    """
+    Translates a stream of text deltas segment by segment.
+
+    Segments from `split_markdown_stream` are sent to `translate` on a thread
+    pool with at most `max_concurrency` in flight, and yielded back in their
+    original order as soon as each one (and everything before it) is done.
+    Surrounding whitespace is preserved; code fences and tables pass through.
+    """
+    max_concurrency = max(1, max_concurrency)
+
+    def translate_segment(segment: str) -> str:
+        core = segment.strip()
+        if not core:
+            return segment
+        leading = segment[: len(segment) - len(segment.lstrip())]
+        trailing = segment[len(segment.rstrip()) :]
+        try:
+            return f"{leading}{translate(core).strip()}{trailing}"
+        except Exception as e:
+            print(f"Error translating text: {e}")
+            return segment
+
+    def done(segment: str) -> Future:
+        future = Future()
+        future.set_result(segment)
+        return future
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for segment, translatable in split_markdown_stream(chunks):
+            pending.append(
+                executor.submit(translate_segment, segment)
+                if translatable
+                else done(segment)
+            )
+
+            # Flush everything that is ready, and apply backpressure once the window is full.
+            while pending and (pending[0].done() or len(pending) > max_concurrency):
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()